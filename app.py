@@ -1,66 +1,499 @@
 """
 Main module og the qc_tool service.
+
+Importing the module has no side effects: the logger, the Google Sheet
+connection and the heavy dependencies are created and imported by main().
 """
 
-from dotenv import dotenv_values
+import argparse
+import logging
+import os
+from typing import TYPE_CHECKING, Iterable
 
-from complete_stages import complete_qc_stages
-from service_settings.service_config import QCToolConfig, ServiceConfig
-from spreadsheet.spreadsheet_client import (
-    connect_to_google_sheet,
-    get_sheet_data,
-    sheet_data_to_df,
-)
-from utilities import create_logger, save_qc_tool_result_locally
-
-# Constants
-# The title of the Google Sheet
-SHEET_TITLE = "cfDNA_samples"
-
-# Create the logger
-service_config = ServiceConfig()
-logger = create_logger(
-    name=service_config.logger_name,
-    file_path=service_config.logger_file_path,
-    file_name=service_config.logger_file_name,
+from qc_pipeline import (
+    SHEET_TITLE,
+    connect_to_sheet,
+    create_artifact_source,
+    create_io_policy,
+    create_s3_client,
+    create_trend_store,
+    index_sheet_df,
+    process_samples,
+    read_sheet_df,
+    save_run_summary,
 )
 
-# Create the QCToolConfig object
-qctool_config = QCToolConfig()
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from s3_client import S3ArtifactClient
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    :return: The command line arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="QC tool for the liquid biopsy samples.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of the samples processed at the same time.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help="The number of the next samples whose files are prefetched from S3.",
+    )
+    parser.add_argument(
+        "--s3-concurrency",
+        type=int,
+        default=None,
+        help="The number of the files downloaded from S3 at the same time.",
+    )
+    parser.add_argument(
+        "--no-artifact-cache",
+        action="store_true",
+        help="Download the files from S3 without the local cache.",
+    )
+    parser.add_argument(
+        "--no-result-memo",
+        action="store_true",
+        help="Run the stages for all samples, even if their inputs have not changed.",
+    )
+    parser.add_argument(
+        "--no-sheet-snapshot",
+        action="store_true",
+        help="Read the whole Google Sheet instead of updating its local snapshot.",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="Process the samples in chunks of this number of rows of the local snapshot "
+        "of the Google Sheet, so only one chunk is in memory at a time.",
+    )
+    parser.add_argument(
+        "--result-sink",
+        choices=["json", "jsonl", "parquet"],
+        default=None,
+        help="The format of the results: a JSON file per sample, one JSON Lines file "
+        "or one Parquet file; the value from the service config is used if it is not provided.",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running, poll the Google Sheet and process the newly added samples.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=None,
+        help="The time between the polls of the Google Sheet in the daemon mode, in seconds.",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve the QC results of single samples over HTTP.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="The port of the HTTP service; the value from the service config "
+        "is used if it is not provided.",
+    )
 
-# Load the environment variables
-config = dotenv_values(".env")
+    return parser.parse_args()
 
-# Get the credentials for the Google Sheet API
-spreadsheet_credentials = config["GDRIVE_API_CREDENTIALS"]
 
-# Connect to the Google Sheet
-sheet = connect_to_google_sheet(spreadsheet_credentials, SHEET_TITLE)
-logger.info("Connected to the Google Sheet.")
+def run_qc_tool(
+    df: "pd.DataFrame",
+    qctool_config: "QCToolConfig",
+    service_config: "ServiceConfig",
+    logger: logging.Logger,
+    s3_client: "S3ArtifactClient",
+    workers: int = 1,
+    prefetch_samples: int = 0,
+    s3_max_concurrency: int = 8,
+    use_artifact_cache: bool = True,
+    use_result_memo: bool = True,
+) -> None:
+    """
+    Complete the QC stages for all samples of the Google Sheet data
+    and save the results.
 
-# Get the data from the Google Sheet
-data = get_sheet_data(sheet)
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qctool_config: The configuration for the qc_tool.
+    :type qctool_config: QCToolConfig
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param s3_client: The client for the files on the S3 bucket.
+    :type s3_client: S3ArtifactClient
+    :param workers: The number of the samples processed at the same time.
+    :type workers: int
+    :param prefetch_samples: The number of the next samples whose files are prefetched.
+    :type prefetch_samples: int
+    :param s3_max_concurrency: The number of the files downloaded from S3 at the same time.
+    :type s3_max_concurrency: int
+    :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+    :type use_artifact_cache: bool
+    :param use_result_memo: Whether the stored results are used for the samples
+        whose inputs have not changed.
+    :type use_result_memo: bool
+    """
+    run_qc_tool_chunked(
+        [df],
+        qctool_config,
+        service_config,
+        logger,
+        s3_client,
+        workers,
+        prefetch_samples,
+        s3_max_concurrency,
+        use_artifact_cache,
+        use_result_memo,
+    )
 
-# Convert the data to a pandas DataFrame
-df = sheet_data_to_df(data)
 
+def run_qc_tool_chunked(
+    chunks: "Iterable[pd.DataFrame]",
+    qctool_config: "QCToolConfig",
+    service_config: "ServiceConfig",
+    logger: logging.Logger,
+    s3_client: "S3ArtifactClient",
+    workers: int = 1,
+    prefetch_samples: int = 0,
+    s3_max_concurrency: int = 8,
+    use_artifact_cache: bool = True,
+    use_result_memo: bool = True,
+) -> None:
+    """
+    Complete the QC stages for the samples of the Google Sheet data chunk by chunk
+    and save the results. Every chunk is indexed, processed, flushed to the sink
+    and released before the next one is read, so only one chunk is in memory.
+    The chunks must hold all rows of their samples, e.g. from
+    SheetSnapshot.iter_sample_chunks; the results are then the same
+    as for the whole sheet.
 
-def main():
+    :param chunks: The chunks of the data from the Google Sheet.
+    :type chunks: Iterable[pd.DataFrame]
+    :param qctool_config: The configuration for the qc_tool.
+    :type qctool_config: QCToolConfig
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param s3_client: The client for the files on the S3 bucket.
+    :type s3_client: S3ArtifactClient
+    :param workers: The number of the samples processed at the same time.
+    :type workers: int
+    :param prefetch_samples: The number of the next samples whose files are prefetched.
+    :type prefetch_samples: int
+    :param s3_max_concurrency: The number of the files downloaded from S3 at the same time.
+    :type s3_max_concurrency: int
+    :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+    :type use_artifact_cache: bool
+    :param use_result_memo: Whether the stored results are used for the samples
+        whose inputs have not changed.
+    :type use_result_memo: bool
+    """
+    import pandas as pd
+
+    from artifact_fetcher import AsyncArtifactFetcher
+    from result_memo import ResultMemoStore
+    from result_sink import create_result_sink
+    from run_summary import get_sheet_metrics
+    from stage_metrics import RunMetrics
+    from values import BUCKET_NAME
+
+    run_metrics = RunMetrics()
+    stage_outcomes = {} if service_config.run_summary else None
+    # The metrics of the samples for the summary are kept instead of their chunks
+    sheet_metrics = []
+    trend_store = create_trend_store(service_config)
+
+    artifact_source = create_artifact_source(service_config, s3_client, use_artifact_cache)
+
+    # Skip the samples whose inputs have not changed since the previous runs
+    memo_store = None
+    if use_result_memo:
+        memo_store = ResultMemoStore(service_config.result_memo_path, BUCKET_NAME, s3_client)
+
+    with AsyncArtifactFetcher(
+        BUCKET_NAME, s3_max_concurrency, artifact_source
+    ) as artifact_fetcher, create_result_sink(
+        service_config.result_sink, service_config.result_file_path
+    ) as result_sink:
+        for df in chunks:
+            sample_index, batch_checks = index_sheet_df(df, qctool_config, logger)
+            process_samples(
+                list(sample_index),
+                df,
+                sample_index,
+                batch_checks,
+                qctool_config,
+                service_config,
+                logger,
+                artifact_fetcher,
+                result_sink,
+                run_metrics,
+                memo_store,
+                workers,
+                prefetch_samples,
+                stage_outcomes,
+                trend_store,
+            )
+            # The results of the chunk are written before the chunk is released
+            result_sink.flush()
+            if stage_outcomes is not None:
+                sheet_metrics.append(get_sheet_metrics(df))
+            del df, sample_index, batch_checks
+
+    if stage_outcomes is not None and sheet_metrics:
+        save_run_summary(pd.concat(sheet_metrics), stage_outcomes, service_config, logger)
+
+    if trend_store is not None:
+        trend_store.save()
+        logger.info("The baselines of the metrics are saved to %s.", trend_store.file_path)
+
+    if memo_store is not None:
+        logger.info(
+            "Stored results: %d hits, %d misses.",
+            memo_store.hits,
+            memo_store.misses,
+        )
+
+    # Save the metrics of the run, e.g. for the textfile collector of the node exporter
+    if service_config.metrics_file_path is not None:
+        run_metrics.save(service_config.metrics_file_path)
+        logger.info("The metrics of the run are saved to %s.", service_config.metrics_file_path)
+
+
+def main(
+    workers: int = 1,
+    prefetch_samples: int | None = None,
+    s3_max_concurrency: int | None = None,
+    use_artifact_cache: bool = True,
+    use_result_memo: bool = True,
+    use_sheet_snapshot: bool = True,
+    result_sink: str | None = None,
+    daemon: bool = False,
+    poll_interval: float | None = None,
+    serve: bool = False,
+    port: int | None = None,
+    chunk_rows: int | None = None,
+):
     """
     The main function.
+
+    :param workers: The number of the samples processed at the same time.
+    :type workers: int
+    :param prefetch_samples: The number of the next samples whose files are prefetched;
+        the value from the service config is used if it is not provided.
+    :type prefetch_samples: int | None
+    :param s3_max_concurrency: The number of the files downloaded from S3 at the same time;
+        the value from the service config is used if it is not provided.
+    :type s3_max_concurrency: int | None
+    :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+    :type use_artifact_cache: bool
+    :param use_result_memo: Whether the stored results are used for the samples
+        whose inputs have not changed.
+    :type use_result_memo: bool
+    :param use_sheet_snapshot: Whether the Google Sheet is read into its local snapshot.
+    :type use_sheet_snapshot: bool
+    :param result_sink: The format of the results: json, jsonl or parquet;
+        the value from the service config is used if it is not provided.
+    :type result_sink: str | None
+    :param daemon: Whether the tool keeps running and processes the newly added samples.
+    :type daemon: bool
+    :param poll_interval: The time between the polls of the Google Sheet in the daemon mode;
+        the value from the service config is used if it is not provided.
+    :type poll_interval: float | None
+    :param serve: Whether the QC results of single samples are served over HTTP.
+    :type serve: bool
+    :param port: The port of the HTTP service;
+        the value from the service config is used if it is not provided.
+    :type port: int | None
+    :param chunk_rows: The number of the rows of the snapshot of the Google Sheet
+        processed at a time; the whole sheet is loaded if it is not provided.
+    :type chunk_rows: int | None
     """
-    for sample in df["Sample sheet_Sample_ID"]:
-        result = complete_qc_stages(sample, df, qctool_config, logger)
-        logger.info("The checking and estimation stages are completed.")
-
-        # Save the result of the qc_tool to a file
-        save_qc_tool_result_locally(
-            result,
-            service_config.result_file_path,
-            f"{result['meta']['sample_id']}_qc_tool_result.json",
+    # The heavy dependencies are imported when the tool runs, not when the module is imported
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+    from spreadsheet.sheet_snapshot import SheetSnapshot
+    from utilities import create_logger
+
+    if chunk_rows is not None and not use_sheet_snapshot:
+        raise ValueError("The Google Sheet is read in chunks only from its local snapshot.")
+
+    # Create the logger
+    service_config = ServiceConfig()
+    logger = create_logger(
+        name=service_config.logger_name,
+        file_path=service_config.logger_file_path,
+        file_name=service_config.logger_file_name,
+        json_format=service_config.logger_json_format,
+        stage_debug_sample_rate=service_config.logger_stage_debug_sample_rate,
+    )
+
+    if prefetch_samples is None:
+        prefetch_samples = service_config.prefetch_samples
+    if s3_max_concurrency is None:
+        s3_max_concurrency = service_config.s3_max_concurrency
+    if result_sink is not None:
+        service_config.result_sink = result_sink
+    if poll_interval is None:
+        poll_interval = service_config.daemon_poll_interval
+    if port is None:
+        port = service_config.http_port
+
+    # Create the QCToolConfig object
+    qctool_config = QCToolConfig()
+
+    # The deadlines, the retries and the circuit breakers of the S3 and the Google Sheets requests
+    io_policy = create_io_policy(service_config)
+
+    # The per-gene coverage tables are kept for the queries across the samples
+    if service_config.gene_coverage_index_path is not None:
+        from gene_coverage_index import GeneCoverageIndex, set_gene_coverage_index
+
+        set_gene_coverage_index(
+            GeneCoverageIndex(
+                service_config.gene_coverage_index_path,
+                service_config.gene_coverage_index_passed_panels,
+            )
+        )
+
+    # Get the data from the Google Sheet
+    snapshot = None
+    if use_sheet_snapshot:
+        snapshot = SheetSnapshot(
+            os.path.join(service_config.sheet_snapshot_path, f"{SHEET_TITLE}.feather"),
+            service_config.sheet_snapshot_recheck_rows,
+            service_config.sheet_snapshot_full_sync_interval,
+            io_policy,
+            service_config.sheet_snapshot_chunk_rows,
         )
-        logger.info("The result is saved to a file.")
+    sheet = connect_to_sheet(logger, io_policy)
+
+    # Create the S3 client shared by the samples
+    s3_client = create_s3_client(service_config, s3_max_concurrency, io_policy)
+
+    # Keep the connections, the models and the caches between the polls of the Google Sheet
+    if daemon:
+        from qc_daemon import QCDaemon
+
+        QCDaemon(
+            sheet,
+            qctool_config,
+            service_config,
+            logger,
+            s3_client,
+            snapshot,
+            io_policy,
+            poll_interval,
+            service_config.daemon_queue_size,
+            service_config.daemon_batch_size,
+            workers,
+            prefetch_samples,
+            s3_max_concurrency,
+            use_artifact_cache,
+            use_result_memo,
+        ).run()
+        return
+
+    # Keep the Google Sheet data and the models in memory between the requests
+    if serve:
+        import asyncio
+        from functools import partial
+
+        from qc_service import QCService
+        from result_memo import ResultMemoStore
+        from values import BUCKET_NAME
+
+        memo_store = None
+        if use_result_memo:
+            memo_store = ResultMemoStore(service_config.result_memo_path, BUCKET_NAME, s3_client)
+        qc_service = QCService(
+            partial(
+                read_sheet_df,
+                sheet,
+                qctool_config.sheet_columns,
+                snapshot,
+                io_policy,
+                use_result_memo,
+            ),
+            qctool_config,
+            service_config,
+            logger,
+            s3_client,
+            memo_store,
+            service_config.http_max_concurrency,
+            service_config.http_sheet_refresh_interval,
+            use_artifact_cache,
+            service_config.http_sheet_min_refresh_interval,
+        )
+        asyncio.run(qc_service.serve(service_config.http_host, port))
+        return
+
+    # Keep only one chunk of the Google Sheet data in memory
+    if chunk_rows is not None:
+        # The stored results are trusted only for the rows as they are in the sheet
+        snapshot.sync(sheet, qctool_config.sheet_columns, load=False, fresh=use_result_memo)
+        run_qc_tool_chunked(
+            snapshot.iter_sample_chunks(chunk_rows),
+            qctool_config,
+            service_config,
+            logger,
+            s3_client,
+            workers,
+            prefetch_samples,
+            s3_max_concurrency,
+            use_artifact_cache,
+            use_result_memo,
+        )
+        return
+
+    df = read_sheet_df(
+        sheet, qctool_config.sheet_columns, snapshot, io_policy, use_result_memo
+    )
+
+    run_qc_tool(
+        df,
+        qctool_config,
+        service_config,
+        logger,
+        s3_client,
+        workers,
+        prefetch_samples,
+        s3_max_concurrency,
+        use_artifact_cache,
+        use_result_memo,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(
+        args.workers,
+        args.prefetch,
+        args.s3_concurrency,
+        not args.no_artifact_cache,
+        not args.no_result_memo,
+        not args.no_sheet_snapshot,
+        args.result_sink,
+        args.daemon,
+        args.poll_interval,
+        args.serve,
+        args.port,
+        args.chunk_rows,
+    )
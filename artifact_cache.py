@@ -0,0 +1,288 @@
+"""
+Module for the persistent local cache of the files downloaded from S3.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+
+from s3_client import S3ArtifactClient, get_object_head
+from stage_metrics import record_cache_lookup
+
+
+class ArtifactCache:
+    """
+    Class for caching the files of the samples downloaded from S3 on the local disk.
+
+    The files are addressed by the bucket, the key, the ETag and the size of
+    the object, so a changed object is downloaded again. The freshness is
+    checked with a HEAD request. The least recently used files are evicted
+    when the cache is larger than max_size bytes. Several processes can share
+    the cache directory: the files are added with atomic renames, and the total
+    size of the files is kept in a file next to them and updated under a file
+    lock, so the files are only scanned on the start and when the cache is full.
+    """
+
+    def __init__(
+        self,
+        dir_path: str,
+        max_size: int,
+        s3_client: S3ArtifactClient,
+    ):
+        """
+        :param dir_path: The path to the directory of the cache.
+        :type dir_path: str
+        :param max_size: The maximal size of the cached files, in bytes.
+        :type max_size: int
+        :param s3_client: The client for downloading the files.
+        :type s3_client: S3ArtifactClient
+        """
+        self.dir_path = dir_path
+        self.max_size = max_size
+        self.s3_client = s3_client
+
+        self._objects_dir_path = os.path.join(dir_path, "objects")
+        self._tmp_dir_path = os.path.join(dir_path, "tmp")
+        self._lock_file_path = os.path.join(dir_path, ".lock")
+        self._size_file_path = os.path.join(dir_path, ".size")
+        os.makedirs(self._objects_dir_path, exist_ok=True)
+        os.makedirs(self._tmp_dir_path, exist_ok=True)
+        # The maximal size may be lower than in the previous runs,
+        # and the files may have been changed while the cache was not used
+        with self._lock():
+            self._evict()
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Lock the cache for the other processes.
+        """
+        with open(self._lock_file_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_entry_path(self, bucket_name: str, object_key: str, head: dict) -> str:
+        """
+        Get the path to the cached file of an object version.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param head: The ETag and the size of the object.
+        :type head: dict
+        :return: The path to the cached file.
+        :rtype: str
+        """
+        address = f"{bucket_name}\0{object_key}\0{head['etag']}\0{head['size']}"
+        digest = hashlib.sha256(address.encode()).hexdigest()
+
+        return os.path.join(self._objects_dir_path, digest[:2], digest)
+
+    def _copy_entry(self, entry_path: str, local_file_path: str) -> bool:
+        """
+        Copy a cached file to the local file and mark it as recently used.
+
+        :param entry_path: The path to the cached file.
+        :type entry_path: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        :return: Whether the cached file exists.
+        :rtype: bool
+        """
+        try:
+            # The modification time is the time of the last use
+            os.utime(entry_path)
+            if os.path.exists(local_file_path):
+                os.remove(local_file_path)
+            try:
+                # The consumers never change the files in place, so a hard link is enough
+                os.link(entry_path, local_file_path)
+            except OSError:
+                shutil.copyfile(entry_path, local_file_path)
+        except FileNotFoundError:
+            # The file was evicted by another process
+            return False
+
+        return True
+
+    def _read_total_size(self) -> int | None:
+        """
+        Read the total size of the cached files; called under the lock.
+
+        :return: The total size of the cached files, in bytes,
+            or None if it is not known.
+        :rtype: int | None
+        """
+        try:
+            with open(self._size_file_path) as size_file:
+                return int(size_file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_total_size(self, total_size: int) -> None:
+        """
+        Write the total size of the cached files; called under the lock.
+
+        :param total_size: The total size of the cached files, in bytes.
+        :type total_size: int
+        """
+        tmp_file_path = f"{self._size_file_path}.tmp"
+        with open(tmp_file_path, "w") as size_file:
+            size_file.write(str(total_size))
+        os.replace(tmp_file_path, self._size_file_path)
+
+    def _evict(self) -> None:
+        """
+        Scan the cached files and remove the least recently used ones until
+        the cache fits in max_size; called under the lock.
+        """
+        entries = []
+        total_size = 0
+        for prefix_dir in os.scandir(self._objects_dir_path):
+            for entry in os.scandir(prefix_dir.path):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+        self._write_total_size(total_size)
+
+    def _add_to_total_size(self, size: int) -> None:
+        """
+        Add the size of a new cached file to the total size,
+        evicting files if the cache no longer fits in max_size.
+
+        :param size: The size of the new cached file, in bytes.
+        :type size: int
+        """
+        with self._lock():
+            total_size = self._read_total_size()
+            # An object added by two processes at once is counted twice,
+            # which only brings the next scan forward
+            if total_size is None or total_size + size > self.max_size:
+                self._evict()
+            else:
+                self._write_total_size(total_size + size)
+
+    def _add_entry(self, bucket_name: str, object_key: str, entry_path: str) -> int:
+        """
+        Download an object to the cache.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param entry_path: The path to the cached file.
+        :type entry_path: str
+        :return: The size of the cached file, in bytes.
+        :rtype: int
+        """
+        # Download the file next to the cache and add it with an atomic rename
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        file_descriptor, tmp_file_path = tempfile.mkstemp(dir=self._tmp_dir_path)
+        os.close(file_descriptor)
+        try:
+            self.s3_client.download(bucket_name, object_key, tmp_file_path)
+            size = os.path.getsize(tmp_file_path)
+            os.replace(tmp_file_path, entry_path)
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
+        return size
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        """
+        Get the ETag and the size of an object from S3.
+        Has the same interface as S3ArtifactClient.head.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The ETag and the size of the object.
+        :rtype: dict
+        """
+        return get_object_head(self.s3_client, bucket_name, object_key)
+
+    def download(
+        self,
+        bucket_name: str,
+        object_key: str,
+        local_file_path: str,
+    ) -> None:
+        """
+        Get a file from the cache, downloading it from S3 if it is not cached
+        or the object has changed. Has the same interface as S3ArtifactClient.download.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        """
+        head = get_object_head(self.s3_client, bucket_name, object_key)
+        entry_path = self._get_entry_path(bucket_name, object_key, head)
+
+        if self._copy_entry(entry_path, local_file_path):
+            record_cache_lookup(True)
+            return
+
+        record_cache_lookup(False)
+        size = self._add_entry(bucket_name, object_key, entry_path)
+        # Copy the file before the eviction, so it is not lost if the cache is too small
+        if not self._copy_entry(entry_path, local_file_path):
+            raise Exception("An error occurred while downloading the file from S3.")
+        self._add_to_total_size(size)
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        """
+        Open a cached file, downloading it from S3 if it is not cached
+        or the object has changed. Has the same interface as S3ArtifactClient.open.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The stream of the file.
+        :rtype: BinaryIO
+        """
+        head = get_object_head(self.s3_client, bucket_name, object_key)
+        entry_path = self._get_entry_path(bucket_name, object_key, head)
+
+        try:
+            # The modification time is the time of the last use
+            os.utime(entry_path)
+            cached_file = open(entry_path, "rb")
+            record_cache_lookup(True)
+            return cached_file
+        except FileNotFoundError:
+            pass
+
+        record_cache_lookup(False)
+        size = self._add_entry(bucket_name, object_key, entry_path)
+        # Open the file before the eviction, so it is readable if the cache is too small
+        try:
+            cached_file = open(entry_path, "rb")
+        except FileNotFoundError as e:
+            raise Exception("An error occurred while downloading the file from S3.") from e
+        self._add_to_total_size(size)
+
+        return cached_file
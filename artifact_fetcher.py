@@ -0,0 +1,283 @@
+"""
+Module for fetching the files of the samples from the S3 bucket in the background.
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable
+
+from artifact_cache import ArtifactCache
+from s3_client import S3ArtifactClient, get_object_head, get_s3_client
+from stage_metrics import IOStats, add_io_stats, collect_io_stats
+from utilities import SCRATCH_DIR_PATH
+
+
+class AsyncArtifactFetcher:
+    """
+    Class for fetching the files of the samples from the S3 bucket.
+
+    The downloads run on an asyncio event loop in a background thread, at most
+    max_concurrency of them at the same time. The files are prefetched ahead
+    of the samples that need them and handed over to the stages by download().
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        max_concurrency: int = 8,
+        s3_client: S3ArtifactClient | ArtifactCache | None = None,
+    ):
+        self.bucket_name = bucket_name
+        self.max_concurrency = max_concurrency
+        # The client or the cache the files are downloaded with
+        self.s3_client = s3_client if s3_client is not None else get_s3_client()
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._dir_path: str | None = None
+        # The downloads by the object key
+        self._futures: dict[str, Future] = {}
+        # The object keys already handed over to the stages
+        self._consumed: set[str] = set()
+        # The functions submitted to run in the background and not finished yet
+        self._tasks: set[Future] = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "AsyncArtifactFetcher":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """
+        Start the event loop for the downloads.
+        """
+        os.makedirs(SCRATCH_DIR_PATH, exist_ok=True)
+        self._dir_path = tempfile.mkdtemp(prefix="prefetch_", dir=SCRATCH_DIR_PATH)
+
+        self._loop = asyncio.new_event_loop()
+        # boto3 is blocking, so the downloads run in the threads of the loop
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_concurrency),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Cancel the pending downloads, stop the event loop and remove the files
+        that were not handed over to the stages.
+        """
+        if self._loop is None:
+            return
+
+        with self._lock:
+            for future in [*self._futures.values(), *self._tasks]:
+                future.cancel()
+            self._futures.clear()
+            self._tasks.clear()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._loop.shutdown_default_executor())
+        self._loop.close()
+        self._loop = None
+
+        shutil.rmtree(self._dir_path, ignore_errors=True)
+
+    def reset(self) -> None:
+        """
+        Cancel the pending downloads and remove the files that were not handed over
+        to the stages, so a long-running service does not keep them between
+        the batches of the samples. The next downloads go to a new directory.
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+            self._consumed.clear()
+
+            # The downloads that are already running finish into the removed directory
+            dir_path = self._dir_path
+            self._dir_path = tempfile.mkdtemp(prefix="prefetch_", dir=SCRATCH_DIR_PATH)
+
+        shutil.rmtree(dir_path, ignore_errors=True)
+
+    def _get_prefetch_file_path(self, object_key: str) -> str:
+        """
+        Get the path to the local file for a prefetched object.
+
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The path to the local file.
+        :rtype: str
+        """
+        file_name = hashlib.sha1(object_key.encode()).hexdigest()
+        return os.path.join(self._dir_path, file_name)
+
+    def _download(self, object_key: str, local_file_path: str) -> IOStats:
+        """
+        Download a file from the S3 bucket and collect the I/O of the download,
+        so it is added to the stage that uses the file.
+
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        :return: The I/O of the download.
+        :rtype: IOStats
+        """
+        with collect_io_stats() as io_stats:
+            self.s3_client.download(self.bucket_name, object_key, local_file_path)
+
+        return io_stats
+
+    async def _fetch(self, object_key: str, local_file_path: str) -> IOStats:
+        """
+        Download a file from the S3 bucket once a download slot is free.
+
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        :return: The I/O of the download.
+        :rtype: IOStats
+        """
+        async with self._semaphore:
+            return await asyncio.to_thread(self._download, object_key, local_file_path)
+
+    def _schedule(self, object_key: str) -> Future:
+        """
+        Schedule the download of an object if it is not scheduled yet.
+        Must be called with the lock held.
+
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The download.
+        :rtype: Future
+        """
+        if object_key not in self._futures:
+            self._futures[object_key] = asyncio.run_coroutine_threadsafe(
+                self._fetch(object_key, self._get_prefetch_file_path(object_key)),
+                self._loop,
+            )
+        return self._futures[object_key]
+
+    def prefetch(self, object_keys: list[str]) -> None:
+        """
+        Start downloading the objects in the background.
+
+        :param object_keys: The keys of the objects.
+        :type object_keys: list[str]
+        """
+        with self._lock:
+            for object_key in object_keys:
+                if object_key not in self._consumed:
+                    self._schedule(object_key)
+
+    def submit(self, function: Callable[..., Any], *args: Any) -> Future:
+        """
+        Run a blocking function in the threads of the downloads, e.g. the requests
+        deciding which files to prefetch, so the caller does not wait for them.
+
+        :param function: The function.
+        :type function: Callable[..., Any]
+        :return: The result of the function.
+        :rtype: Future
+        """
+        future = asyncio.run_coroutine_threadsafe(asyncio.to_thread(function, *args), self._loop)
+        with self._lock:
+            self._tasks.add(future)
+
+        def discard(done_future: Future) -> None:
+            with self._lock:
+                self._tasks.discard(done_future)
+
+        future.add_done_callback(discard)
+
+        return future
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        """
+        Get the ETag and the size of an object from S3.
+        Has the same interface as S3ArtifactClient.head.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The ETag and the size of the object.
+        :rtype: dict
+        """
+        return get_object_head(self.s3_client, bucket_name, object_key)
+
+    def download(
+        self,
+        bucket_name: str,
+        object_key: str,
+        local_file_path: str,
+    ) -> None:
+        """
+        Get a file from the S3 bucket: wait for its prefetched copy or download it now.
+        Has the same interface as S3ArtifactClient.download.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        """
+        if bucket_name != self.bucket_name:
+            self.s3_client.download(bucket_name, object_key, local_file_path)
+            return
+
+        with self._lock:
+            future = self._schedule(object_key)
+            del self._futures[object_key]
+            self._consumed.add(object_key)
+
+        # Raises the error of the download
+        add_io_stats(future.result())
+        os.replace(self._get_prefetch_file_path(object_key), local_file_path)
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        """
+        Open the stream of a file from the S3 bucket: its prefetched copy or
+        the stream from the client if the file is not prefetched.
+        Has the same interface as S3ArtifactClient.open.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The stream of the file.
+        :rtype: BinaryIO
+        """
+        if bucket_name != self.bucket_name:
+            return self.s3_client.open(bucket_name, object_key)
+
+        with self._lock:
+            future = self._futures.pop(object_key, None)
+            self._consumed.add(object_key)
+
+        if future is None:
+            return self.s3_client.open(bucket_name, object_key)
+
+        # Raises the error of the download
+        add_io_stats(future.result())
+        prefetch_file_path = self._get_prefetch_file_path(object_key)
+        prefetched_file = open(prefetch_file_path, "rb")
+        # The opened file is readable after it is removed
+        os.remove(prefetch_file_path)
+
+        return prefetched_file
@@ -0,0 +1,356 @@
+"""
+This module contains the vectorized functions for the qc_tool check stages
+that rely only on the Google Sheet data.
+
+Each function evaluates a check for the whole DataFrame at once and returns
+a list aligned with the rows of the DataFrame. An item of the list is either
+the result of the check, identical to the result of the per-sample function
+from the stages module, or the exception the per-sample function would raise.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def coerce_column_to_float(
+    column: pd.Series,
+) -> tuple[np.ndarray, np.ndarray, dict[int, TypeError]]:
+    """
+    Coerce a column of the DataFrame to floats with the same rules as float().
+
+    :param column: The column of the DataFrame.
+    :type column: pd.Series
+    :return: The float values (NaN where the value is not a number), the mask
+        of the values that are numbers and, by the position, the errors of
+        the values that are neither strings nor numbers, e.g. None; the
+        per-sample functions do not catch them, so they are their results.
+    :rtype: tuple[np.ndarray, np.ndarray, dict[int, TypeError]]
+    """
+    raw_values = column.to_numpy(dtype=object)
+    # The cast turns None into NaN instead of failing as float(None)
+    if not pd.isna(raw_values).any():
+        try:
+            # The cast from the object dtype calls float() for every value
+            values = raw_values.astype(float)
+            return values, np.ones(len(values), dtype=bool), {}
+        except (TypeError, ValueError):
+            pass
+
+    # Some values are not numbers: coerce them one by one
+    values = np.full(len(raw_values), np.nan)
+    valid = np.zeros(len(raw_values), dtype=bool)
+    type_errors = {}
+    for index, value in enumerate(raw_values):
+        try:
+            values[index] = float(value)
+            valid[index] = True
+        except TypeError as e:
+            type_errors[index] = e
+        except ValueError:
+            pass
+
+    return values, valid, type_errors
+
+
+def _merge_type_errors(
+    first_valid: np.ndarray,
+    first_type_errors: dict[int, TypeError],
+    second_type_errors: dict[int, TypeError],
+) -> dict[int, TypeError]:
+    """
+    Merge the errors of two columns coerced one after the other by the per-sample
+    function: the errors of the second column are raised only for the valid
+    values of the first one.
+
+    :param first_valid: The mask of the values of the first column that are numbers.
+    :type first_valid: np.ndarray
+    :param first_type_errors: The errors of the first column by the position.
+    :type first_type_errors: dict[int, TypeError]
+    :param second_type_errors: The errors of the second column by the position.
+    :type second_type_errors: dict[int, TypeError]
+    :return: The errors raised by the per-sample function by the position.
+    :rtype: dict[int, TypeError]
+    """
+    type_errors = dict(first_type_errors)
+    for index, error in second_type_errors.items():
+        if first_valid[index]:
+            type_errors[index] = error
+
+    return type_errors
+
+
+def _get_threshold_results(
+    failed: np.ndarray,
+    valid: np.ndarray,
+    check_stage: dict,
+    error_message: str,
+    type_errors: dict[int, TypeError] | None = None,
+) -> list[dict | Exception]:
+    """
+    Get the results of a threshold check from the mask of the failed samples.
+
+    :param failed: The mask of the samples that failed the check.
+    :type failed: np.ndarray
+    :param valid: The mask of the samples with the numeric values.
+    :type valid: np.ndarray
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :param error_message: The message of the error for the non-numeric values.
+    :type error_message: str
+    :param type_errors: The errors of the values that are neither strings
+        nor numbers by the position, raised instead of the error_message.
+    :type type_errors: dict[int, TypeError] | None
+    :return: The results of the check.
+    :rtype: list[dict | Exception]
+    """
+    type_errors = type_errors or {}
+    results = []
+    for index, (sample_failed, sample_valid) in enumerate(zip(failed.tolist(), valid.tolist())):
+        if not sample_valid:
+            results.append(type_errors.get(index, ValueError(error_message)))
+        elif sample_failed:
+            results.append(
+                {
+                    "uid": check_stage["uid"],
+                    "name": check_stage["name"],
+                    "status": check_stage["failed_status"],
+                    "message": check_stage["failed_message"],
+                }
+            )
+        else:
+            results.append(
+                {
+                    "uid": check_stage["uid"],
+                    "name": check_stage["name"],
+                    "status": check_stage["passed_status"],
+                    "message": check_stage["passed_message"],
+                }
+            )
+
+    return results
+
+
+def average_coverage_v1_v2_ratio_batch_check(
+    df: pd.DataFrame,
+    check_stage: dict,
+) -> list[dict | Exception]:
+    """
+    Check the ratio of the average coverage v1 and v2 for all samples.
+    If the ratio is less than the threshold, the check fails, otherwise it passes.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :return: The results of the check.
+    :rtype: list[dict | Exception]
+    """
+    average_coverage_v1, v1_valid, v1_type_errors = coerce_column_to_float(
+        df["average_coverage_v1"]
+    )
+    average_coverage_v2, v2_valid, v2_type_errors = coerce_column_to_float(
+        df["average_coverage_v2"]
+    )
+    type_errors = _merge_type_errors(v1_valid, v1_type_errors, v2_type_errors)
+
+    # Division by zero is an error for the per-sample check
+    valid = v1_valid & v2_valid & (average_coverage_v2 != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = average_coverage_v1 / average_coverage_v2
+
+    return _get_threshold_results(
+        ratio < check_stage["params"]["threshold"],
+        valid,
+        check_stage,
+        "The average coverage v1 or v2 is not a number.",
+        type_errors,
+    )
+
+
+def total_deduplicated_percentage_batch_check(
+    df: pd.DataFrame,
+    check_stage: dict,
+) -> list[dict | Exception]:
+    """
+    Check the Total Deduplicated Percentage for all samples.
+    If the value is higher than the threshold, the check fails, otherwise it passes.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :return: The results of the check.
+    :rtype: list[dict | Exception]
+    """
+    total_deduplicated_percent, valid, type_errors = coerce_column_to_float(
+        df["Total Deduplicated Percentage"],
+    )
+
+    return _get_threshold_results(
+        total_deduplicated_percent > check_stage["params"]["threshold"],
+        valid,
+        check_stage,
+        "The Total Deduplicated Percentage is not a number.",
+        type_errors,
+    )
+
+
+def off_target_batch_check(
+    df: pd.DataFrame,
+    check_stage: dict,
+) -> list[dict | Exception]:
+    """
+    Check the Off Target for all samples.
+    If the value is higher than the threshold, the check fails, otherwise it passes.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :return: The results of the check.
+    :rtype: list[dict | Exception]
+    """
+    off_target, valid, type_errors = coerce_column_to_float(df["Off-target, %"])
+
+    return _get_threshold_results(
+        off_target > check_stage["params"]["threshold"],
+        valid,
+        check_stage,
+        "The Off Target is not a number.",
+        type_errors,
+    )
+
+
+def number_of_reads_batch_check(
+    df: pd.DataFrame,
+    check_stage: dict,
+) -> list[dict | Exception]:
+    """
+    Check the Number of Reads for all samples.
+    If the value is less than the threshold, the check fails, otherwise it passes.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :return: The results of the check.
+    :rtype: list[dict | Exception]
+    """
+    threshold = check_stage["params"]["threshold"]
+    number_of_reads, valid, type_errors = coerce_column_to_float(df["Number_of_Reads_mln"])
+
+    failed = number_of_reads < threshold
+
+    results = _get_threshold_results(
+        failed,
+        valid,
+        check_stage,
+        "The Number of reads is not a number.",
+        type_errors,
+    )
+
+    # Add the number of the needed reads to the failed checks
+    for index in np.flatnonzero(failed & valid).tolist():
+        result = results[index]
+        sample_number_of_reads = float(number_of_reads[index])
+        # round() is used instead of np.round to keep the per-sample rounding
+        needed_reads = round(threshold - sample_number_of_reads, 1)
+        result["message"] = f"{check_stage['failed_message']}; {needed_reads} mln more reads are needed"
+        result["data"] = {
+            "needed_reads": needed_reads,
+        }
+
+    return results
+
+
+def vaf_lod_batch_estimation(
+    df: pd.DataFrame,
+    estimation_stage: dict,
+    regression_models: dict,
+) -> list[dict | Exception]:
+    """
+    Estimate the VAF and LOD based on the coverage for all tumor samples.
+    The regression function is evaluated for the v1 and v2 coverage of all
+    samples at once, for every regression model.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param estimation_stage: The estimation stage.
+    :type estimation_stage: dict
+    :param regression_models: The regression models.
+    :type regression_models: dict
+    :return: The results of the estimation.
+    :rtype: list[dict | Exception]
+    """
+    sample_ids = df["Sample sheet_Sample_ID"]
+    # The sample ids that are not strings are left to the per-sample function
+    if not all(isinstance(sample_id, str) for sample_id in sample_ids.tolist()):
+        raise TypeError("The sample ids are not strings.")
+    # The tumor/normal value is the second part of the sample id
+    has_tumor_normal = sample_ids.str.contains("-", regex=False).to_numpy(dtype=bool)
+    tumor_normal = sample_ids.str.split("-").str[1].to_numpy(dtype=object)
+
+    average_coverage_v1, v1_valid, v1_type_errors = coerce_column_to_float(
+        df["average_coverage_v1"]
+    )
+    average_coverage_v2, v2_valid, v2_type_errors = coerce_column_to_float(
+        df["average_coverage_v2"]
+    )
+    type_errors = _merge_type_errors(v1_valid, v1_type_errors, v2_type_errors)
+    coverage = np.stack([average_coverage_v1, average_coverage_v2])
+
+    # The division by zero gives inf, as for the per-sample NumPy parameters
+    regression_function = regression_models["function"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vaf = regression_function(coverage, *regression_models["models"]["vaf"])
+        lod = regression_function(coverage, *regression_models["models"]["lod"])
+    negative = ((vaf < 0) | (lod < 0)).any(axis=0)
+
+    # np.round is the rounding of the NumPy scalars of the per-sample function
+    vaf = np.round(vaf, 4)
+    lod = np.round(lod, 2)
+
+    results = []
+    for index, sample_tumor_normal in enumerate(tumor_normal.tolist()):
+        if not has_tumor_normal[index]:
+            results.append(ValueError("The sample id is not in the correct format."))
+        elif sample_tumor_normal == "tumor":
+            if not (v1_valid[index] and v2_valid[index]):
+                results.append(
+                    type_errors.get(
+                        index, ValueError("The average coverage v1 or v2 is not a number.")
+                    )
+                )
+            elif negative[index]:
+                results.append(
+                    ValueError(
+                        "The estimated parameters are negative. The average coverage is too low.",
+                    )
+                )
+            else:
+                results.append(
+                    {
+                        "uid": estimation_stage["uid"],
+                        "name": estimation_stage["name"],
+                        "status": estimation_stage["completed_status"],
+                        "data": {
+                            "vaf_v1": vaf[0, index],
+                            "vaf_v2": vaf[1, index],
+                            "lod_v1": lod[0, index],
+                            "lod_v2": lod[1, index],
+                        },
+                    }
+                )
+        elif sample_tumor_normal == "normal":
+            results.append(
+                {
+                    "uid": estimation_stage["uid"],
+                    "name": estimation_stage["name"],
+                    "status": estimation_stage["skipped_status"],
+                    "message": estimation_stage["skipped_message"],
+                }
+            )
+        else:
+            results.append(ValueError("The tumor/normal value is not tumor or normal."))
+
+    return results
@@ -0,0 +1,109 @@
+"""
+Benchmark of the startup time of the qc_tool modules.
+
+Every module is imported in a fresh interpreter several times and the best
+import time is compared with the budget of the module. The benchmark fails
+(exits with the status 1) if a module is over its budget or imports a
+dependency it should import lazily.
+
+Usage: python benchmarks/import_time.py [--repeat N] [--scale FACTOR]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# The root directory of the repository
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+# The import time budgets in seconds and the dependencies that must not be
+# imported by the module
+IMPORT_BUDGETS = {
+    "app": {
+        "budget": 0.05,
+        "lazy_dependencies": ["pandas", "numpy", "scipy", "boto3", "gspread", "dotenv"],
+    },
+    "qc_pipeline": {
+        "budget": 0.05,
+        "lazy_dependencies": ["pandas", "numpy", "scipy", "boto3", "gspread", "dotenv"],
+    },
+    "complete_stages": {
+        "budget": 1.0,
+        "lazy_dependencies": ["scipy", "boto3", "gspread"],
+    },
+    "service_settings.service_config": {
+        "budget": 1.0,
+        "lazy_dependencies": ["numpy", "pandas", "scipy", "boto3", "gspread"],
+    },
+}
+
+# The code run in the fresh interpreter
+MEASURE_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import {module_name}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure_import(module_name: str) -> dict:
+    """
+    Import a module in a fresh interpreter.
+
+    :param module_name: The name of the module.
+    :type module_name: str
+    :return: The import time in seconds and the names of the imported modules.
+    :rtype: dict
+    """
+    completed = subprocess.run(
+        [sys.executable, "-c", MEASURE_CODE.format(module_name=module_name)],
+        cwd=REPO_PATH,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+def main() -> int:
+    """
+    Run the benchmark.
+
+    :return: The exit status.
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="The number of the imports of a module.")
+    parser.add_argument("--scale", type=float, default=1.0, help="The factor for all budgets, e.g. for slow machines.")
+    args = parser.parse_args()
+
+    failed = False
+    for module_name, budget in IMPORT_BUDGETS.items():
+        measurements = [measure_import(module_name) for _ in range(args.repeat)]
+        best_time = min(measurement["elapsed"] for measurement in measurements)
+        limit = budget["budget"] * args.scale
+
+        imported_modules = set(measurements[0]["modules"])
+        eager_dependencies = [
+            dependency
+            for dependency in budget["lazy_dependencies"]
+            if dependency in imported_modules
+        ]
+
+        status = "ok"
+        if best_time > limit or eager_dependencies:
+            status = "FAILED"
+            failed = True
+
+        print(f"{module_name:<35} {best_time * 1000:8.1f} ms  budget {limit * 1000:8.1f} ms  {status}")
+        if eager_dependencies:
+            print(f"    imports lazy dependencies: {', '.join(eager_dependencies)}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
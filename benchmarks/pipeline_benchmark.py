@@ -0,0 +1,247 @@
+"""
+End-to-end benchmark of the qc_tool on synthetic Google Sheet data.
+
+The files of the samples are served by a local S3 stand-in. Two modes are measured:
+    - stages: complete_qc_stages for every sample, one after another;
+    - run: the full run of app.run_qc_tool, with the batch checks, the prefetching
+      and the saving of the results.
+
+Every (rows, mode) pair runs in a fresh interpreter, so the peak RSS is its own.
+The report has the samples per second, the p50/p99 latency per sample
+(for the run mode, the time between the saved results), the peak RSS
+and the bytes fetched from the stand-in.
+
+Usage: python benchmarks/pipeline_benchmark.py [--rows 1000 10000 100000]
+    [--modes stages run] [--workers N] [--s3-latency SECONDS]
+    [--result-sink json|jsonl|parquet] [--output FILE]
+    [--fault-rate F] [--slow-rate F] [--hang-rate F] [--io-policy]
+
+With the fault options the stand-in fails, delays or hangs some requests;
+with --io-policy the requests go through the I/O policy of the service
+(deadlines, retries, circuit breaker and hedged requests).
+"""
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# The root directory of the repository
+REPO_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_PATH))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+MODES = ["stages", "run"]
+
+
+class ResultTimingHandler(logging.Handler):
+    """
+    Handler for recording the times when the results of the samples are saved.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.times: list[float] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.getMessage() == "The result is saved to a file.":
+            self.times.append(time.perf_counter())
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    """
+    Get a percentile of the values.
+
+    :param values: The values.
+    :type values: list[float]
+    :param percentile: The percentile, from 0 to 100.
+    :type percentile: float
+    :return: The percentile of the values, or 0 if there are none.
+    :rtype: float
+    """
+    import numpy as np
+
+    return float(np.percentile(values, percentile)) if values else 0.0
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """
+    Run one mode of the benchmark on one sheet.
+
+    :param args: The command line arguments.
+    :type args: argparse.Namespace
+    :return: The measurements.
+    :rtype: dict
+    """
+    from synthetic_data import (
+        ByteCountingClient,
+        FaultInjectingS3Client,
+        LocalS3Client,
+        generate_sheet_df,
+    )
+
+    from app import run_qc_tool
+    from complete_stages import complete_qc_stages
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+    from spreadsheet.spreadsheet_client import build_sample_index
+
+    df = generate_sheet_df(args.rows, seed=args.seed)
+    counting_client = ByteCountingClient(
+        FaultInjectingS3Client(
+            LocalS3Client(seed=args.seed, latency=args.s3_latency),
+            error_rate=args.fault_rate,
+            slow_rate=args.slow_rate,
+            hang_rate=args.hang_rate,
+            seed=args.seed,
+        )
+    )
+    s3_client = counting_client
+    if args.io_policy:
+        from io_policy import IOPolicy
+        from s3_client import PolicyS3Client
+
+        s3_client = PolicyS3Client(counting_client, IOPolicy(deadline=args.io_deadline))
+    qctool_config = QCToolConfig()
+    # Load the regression models before the measurement
+    qctool_config.regression_models
+
+    logger = logging.getLogger("qc_tool_benchmark")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    timing_handler = ResultTimingHandler()
+    logger.addHandler(timing_handler)
+
+    latencies = []
+    start_time = time.perf_counter()
+    if args.mode == "stages":
+        sample_index = build_sample_index(df)
+        for sample_id in sample_index:
+            sample_start_time = time.perf_counter()
+            complete_qc_stages(sample_id, df, qctool_config, logger, None, sample_index, s3_client)
+            latencies.append(time.perf_counter() - sample_start_time)
+        samples = len(sample_index)
+    else:
+        with tempfile.TemporaryDirectory(prefix="qc_tool_benchmark_") as dir_path:
+            service_config = ServiceConfig()
+            service_config.result_file_path = dir_path
+            service_config.artifact_cache_path = f"{dir_path}/artifact_cache"
+            service_config.result_memo_path = f"{dir_path}/result_memo"
+            service_config.metrics_file_path = f"{dir_path}/metrics.prom"
+            # The stores kept between the runs are not filled with the synthetic samples
+            service_config.sheet_snapshot_path = f"{dir_path}/sheet_snapshot"
+            service_config.gene_coverage_index_path = f"{dir_path}/gene_coverage.sqlite"
+            service_config.trend_store_path = f"{dir_path}/trends.json"
+            service_config.result_sink = args.result_sink
+            run_qc_tool(
+                df,
+                qctool_config,
+                service_config,
+                logger,
+                s3_client,
+                args.workers,
+                args.prefetch,
+                args.s3_concurrency,
+                use_artifact_cache=False,
+                use_result_memo=False,
+            )
+        times = [start_time] + timing_handler.times
+        latencies = [end - start for start, end in zip(times, times[1:])]
+        samples = len(timing_handler.times)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "rows": args.rows,
+        "mode": args.mode,
+        "samples": samples,
+        "seconds": round(elapsed, 3),
+        "samples_per_second": round(samples / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(get_percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(get_percentile(latencies, 99) * 1000, 2),
+        # The maximal resident set size is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "bytes_fetched": counting_client.bytes_fetched,
+        "requests": counting_client.requests,
+    }
+
+
+def main() -> int:
+    """
+    Run the benchmark.
+
+    :return: The exit status.
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000], help="The numbers of the rows of the sheets.")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES, help="The modes to measure.")
+    parser.add_argument("--workers", type=int, default=1, help="The number of the samples processed at the same time.")
+    parser.add_argument("--prefetch", type=int, default=4, help="The number of the next samples whose files are prefetched.")
+    parser.add_argument("--s3-concurrency", type=int, default=8, help="The number of the files fetched at the same time.")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="The delay of every request to the S3 stand-in, in seconds.")
+    parser.add_argument("--result-sink", choices=["json", "jsonl", "parquet"], default="json", help="The sink of the results in the run mode.")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="The fraction of the requests to the stand-in that fail.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="The fraction of the requests to the stand-in delayed by 1 s.")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="The fraction of the requests to the stand-in that hang for 60 s.")
+    parser.add_argument("--io-policy", action="store_true", help="Send the requests through the I/O policy.")
+    parser.add_argument("--io-deadline", type=float, default=10.0, help="The deadline of a request with the I/O policy, in seconds.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic data.")
+    parser.add_argument("--output", help="The path to the JSON file for the measurements.")
+    # The options of a single measurement in a fresh interpreter
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        args.rows = args.rows[0]
+        print(json.dumps(run_benchmark(args)))
+        return 0
+
+    measurements = []
+    for rows in args.rows:
+        for mode in args.modes:
+            completed = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--mode", mode,
+                    "--rows", str(rows),
+                    "--workers", str(args.workers),
+                    "--prefetch", str(args.prefetch),
+                    "--s3-concurrency", str(args.s3_concurrency),
+                    "--s3-latency", str(args.s3_latency),
+                    "--result-sink", args.result_sink,
+                    "--seed", str(args.seed),
+                    "--fault-rate", str(args.fault_rate),
+                    "--slow-rate", str(args.slow_rate),
+                    "--hang-rate", str(args.hang_rate),
+                    "--io-deadline", str(args.io_deadline),
+                    *(["--io-policy"] if args.io_policy else []),
+                ],
+                cwd=REPO_PATH,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            measurement = json.loads(completed.stdout.splitlines()[-1])
+            measurements.append(measurement)
+            print(
+                f"{measurement['rows']:>7} rows  {measurement['mode']:<6}"
+                f"  {measurement['samples_per_second']:>8.1f} samples/s"
+                f"  p50 {measurement['p50_ms']:>8.2f} ms  p99 {measurement['p99_ms']:>8.2f} ms"
+                f"  peak RSS {measurement['peak_rss_mb']:>7.1f} MB"
+                f"  fetched {measurement['bytes_fetched'] / 1024 / 1024:>9.1f} MB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(measurements, output_file, indent=4)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+"""
+Synthetic Google Sheet data and a local S3 stand-in for the benchmarks.
+
+The sheets have realistic distributions of the coverage, the completeness,
+the duplication and the read counts, some duplicated sample ids and some
+invalid values. The stand-in serves the picard output archives and
+the coverage-stats.genes.txt files of the samples from memory: every file
+is one of a small pool of generated variants, so the sheets of any size
+take little memory.
+"""
+
+import io
+import os
+import random
+import tarfile
+import threading
+import time
+import zlib
+from typing import BinaryIO
+
+import numpy as np
+import pandas as pd
+
+# The columns of the sheet that are not used by the stages
+EXTRA_COLUMNS = ["Patient", "Comment"]
+
+
+def generate_sheet_df(
+    rows: int,
+    seed: int = 0,
+    duplicated_fraction: float = 0.01,
+    invalid_fraction: float = 0.005,
+) -> pd.DataFrame:
+    """
+    Generate the data of a Google Sheet with the values as strings,
+    as they are returned by the Google Sheets API.
+
+    :param rows: The number of the rows.
+    :type rows: int
+    :param seed: The seed of the random generator.
+    :type seed: int
+    :param duplicated_fraction: The fraction of the rows that repeat the sample id of another row.
+    :type duplicated_fraction: float
+    :param invalid_fraction: The fraction of the values that are not numbers.
+    :type invalid_fraction: float
+    :return: The data of the sheet.
+    :rtype: pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+
+    tumor_normal = rng.choice(["tumor", "normal"], size=rows)
+    sample_ids = np.array(
+        [f"S{position}-{tn}-P{position:06d}" for position, tn in enumerate(tumor_normal)],
+        dtype=object,
+    )
+    # Some samples are added to the sheet twice
+    duplicated = rng.random(rows) < duplicated_fraction
+    duplicated[0] = False
+    sample_ids[duplicated] = sample_ids[rng.integers(0, rows, size=duplicated.sum()) // 2]
+    tumor_normal = np.array([sample_id.split("-")[1] for sample_id in sample_ids])
+
+    average_coverage_v1 = rng.lognormal(np.log(1500), 0.4, size=rows)
+    # The priority 1 genes are usually covered about twice as much as the priority 2 genes
+    average_coverage_v2 = average_coverage_v1 / rng.normal(2.0, 0.35, size=rows).clip(0.8)
+
+    columns = {
+        "Sample sheet_Sample_ID": sample_ids,
+        "Run": [f"RUN{position // 96:05d}" for position in range(rows)],
+        "Tumor/Normal": tumor_normal,
+        "average_coverage_v1": np.round(average_coverage_v1, 1),
+        "average_coverage_v2": np.round(average_coverage_v2, 1),
+        "average_coverage_completeness_v1": np.round(100 - rng.gamma(2.0, 8.0, size=rows), 1).clip(0),
+        "average_coverage_completeness_v2": np.round(100 - rng.gamma(2.0, 10.0, size=rows), 1).clip(0),
+        "Total Deduplicated Percentage": np.round(100 - rng.gamma(3.0, 6.0, size=rows), 1).clip(0),
+        "Off-target, %": np.round(rng.lognormal(np.log(15), 0.4, size=rows), 1),
+        "Number_of_Reads_mln": np.round(rng.lognormal(np.log(230), 0.25, size=rows), 1),
+    }
+
+    df = pd.DataFrame({name: np.asarray(values).astype(str) for name, values in columns.items()})
+    for column in df.columns[3:]:
+        invalid = rng.random(rows) < invalid_fraction
+        df.loc[invalid, column] = rng.choice(["", "N/A"], size=invalid.sum())
+    for column in EXTRA_COLUMNS:
+        df[column] = ""
+
+    return df
+
+
+def generate_picard_tarball(rng: np.random.Generator, tumor_normal: str) -> bytes:
+    """
+    Generate a picard output archive with a fragment size histogram
+    that has the mono- and the di-nucleosome peaks.
+
+    :param rng: The random generator.
+    :type rng: np.random.Generator
+    :param tumor_normal: The type of the sample, tumor or normal.
+    :type tumor_normal: str
+    :return: The .tar.gz archive.
+    :rtype: bytes
+    """
+    sizes = np.concatenate(
+        [
+            rng.normal(167, 20, size=900_000),
+            rng.normal(334, 30, size=90_000),
+            rng.uniform(30, 800, size=10_000),
+        ]
+    ).astype(int)
+    sizes, counts = np.unique(sizes[(sizes >= 30) & (sizes <= 800)], return_counts=True)
+    histogram = "".join(
+        f"{position}\t{size}\t{count}\n"
+        for position, (size, count) in enumerate(zip(sizes, counts))
+    )
+
+    members = [
+        (f"cfDNA-{tumor_normal}.alignment_summary_metrics", "CATEGORY\tTOTAL_READS\n" * 2000),
+        (f"cfDNA-{tumor_normal}.insert_size_metrics_2", f"N\tinsert_size\tcount\n{histogram}"),
+    ]
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, text in members:
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    return buffer.getvalue()
+
+
+def generate_coverage_stats(rng: np.random.Generator, genes: int = 600) -> bytes:
+    """
+    Generate a coverage-stats.genes.txt file.
+
+    :param rng: The random generator.
+    :type rng: np.random.Generator
+    :param genes: The number of the genes.
+    :type genes: int
+    :return: The file.
+    :rtype: bytes
+    """
+    mean_coverage = rng.lognormal(np.log(1200), 0.5, size=genes)
+    completeness = (100 - rng.gamma(1.5, 6.0, size=genes)).clip(0)
+    good = completeness > 80
+    lines = ["gene\tmean_coverage\tcompleteness\tgood"]
+    lines.extend(
+        f"GENE{index}\t{mean:.2f}\t{complete:.1f}\t{flag}"
+        for index, (mean, complete, flag) in enumerate(zip(mean_coverage, completeness, good))
+    )
+
+    return ("\n".join(lines) + "\n").encode()
+
+
+class LocalS3Client:
+    """
+    Class for serving the files of the synthetic samples from memory, with the
+    same interface as S3ArtifactClient. A delay can be added to every request
+    to simulate the latency of S3.
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        variants: int = 16,
+        missing_fraction: float = 0.02,
+        latency: float = 0.0,
+    ):
+        """
+        :param seed: The seed of the random generator.
+        :type seed: int
+        :param variants: The number of the different files of every kind.
+        :type variants: int
+        :param missing_fraction: The fraction of the samples without the files.
+        :type missing_fraction: float
+        :param latency: The delay of every request, in seconds.
+        :type latency: float
+        """
+        rng = np.random.default_rng(seed)
+        self.missing_fraction = missing_fraction
+        self.latency = latency
+        self._tarballs = {
+            tumor_normal: [generate_picard_tarball(rng, tumor_normal) for _ in range(variants)]
+            for tumor_normal in ("tumor", "normal")
+        }
+        self._coverage_stats = [generate_coverage_stats(rng) for _ in range(variants)]
+
+    def _get_object(self, object_key: str) -> bytes:
+        """
+        Get the content of an object; the same key always gets the same content.
+
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The content of the object.
+        :rtype: bytes
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        sample_prefix = object_key.split("/output/")[0]
+        if zlib.crc32(sample_prefix.encode()) % 10_000 < self.missing_fraction * 10_000:
+            # Like the 404 of S3: the missing objects are not retried by the I/O policy
+            raise FileNotFoundError("An error occurred while downloading the file from S3.")
+
+        variant = zlib.crc32(object_key.encode())
+        file_name = object_key.rsplit("/", 1)[-1]
+        if file_name.endswith(".picard_output.tar.gz"):
+            tarballs = self._tarballs["tumor" if "-tumor." in file_name else "normal"]
+            return tarballs[variant % len(tarballs)]
+        if file_name.endswith(".coverage-stats.genes.txt"):
+            return self._coverage_stats[variant % len(self._coverage_stats)]
+
+        raise Exception("An error occurred while downloading the file from S3.")
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        content = self._get_object(object_key)
+        return {"etag": f"{zlib.crc32(content):08x}", "size": len(content)}
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        return io.BytesIO(self._get_object(object_key))
+
+    def download(self, bucket_name: str, object_key: str, local_file_path: str) -> None:
+        with open(local_file_path, "wb") as local_file:
+            local_file.write(self._get_object(object_key))
+
+
+class _CountingStream:
+    """
+    Class for counting the bytes read from a stream.
+    """
+
+    def __init__(self, stream: BinaryIO, client: "ByteCountingClient"):
+        self._stream = stream
+        self._client = client
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._client.add_bytes(len(data))
+        return data
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+class ByteCountingClient:
+    """
+    Class for counting the requests and the bytes fetched with an S3 client.
+    """
+
+    def __init__(self, s3_client):
+        """
+        :param s3_client: The client, e.g. S3ArtifactClient or LocalS3Client.
+        """
+        self.s3_client = s3_client
+        self.bytes_fetched = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add_bytes(self, size: int, requests: int = 0) -> None:
+        with self._lock:
+            self.bytes_fetched += size
+            self.requests += requests
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        self.add_bytes(0, requests=1)
+        return self.s3_client.head(bucket_name, object_key)
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        self.add_bytes(0, requests=1)
+        return _CountingStream(self.s3_client.open(bucket_name, object_key), self)
+
+    def download(self, bucket_name: str, object_key: str, local_file_path: str) -> None:
+        self.add_bytes(0, requests=1)
+        self.s3_client.download(bucket_name, object_key, local_file_path)
+        self.add_bytes(os.path.getsize(local_file_path))
+
+
+class _StallingStream:
+    """
+    Class for a stream that stalls once, after a number of bytes were read from it.
+    """
+
+    def __init__(self, stream: BinaryIO, stall_after: int, stall_latency: float):
+        self._stream = stream
+        self._remaining = stall_after
+        self._stall_latency = stall_latency
+
+    def read(self, size: int = -1) -> bytes:
+        if self._remaining <= 0 and self._stall_latency:
+            time.sleep(self._stall_latency)
+            self._stall_latency = 0
+        if 0 < self._remaining and (size < 0 or size > self._remaining):
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+class FaultInjectingS3Client:
+    """
+    Class for injecting the faults of S3 into the requests of another client:
+    the failed requests, the slow requests of the latency tail, the requests
+    that hang for a long time and the opened streams that stall in the middle
+    of the body.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 1.0,
+        hang_rate: float = 0.0,
+        hang_latency: float = 60.0,
+        seed: int = 0,
+        scripted_faults: list[str | None] | None = None,
+        stall_after: int = 0,
+    ):
+        """
+        :param s3_client: The client, e.g. LocalS3Client.
+        :param error_rate: The fraction of the requests that fail with a connection error.
+        :type error_rate: float
+        :param slow_rate: The fraction of the requests delayed by slow_latency.
+        :type slow_rate: float
+        :param slow_latency: The delay of the slow requests, in seconds.
+        :type slow_latency: float
+        :param hang_rate: The fraction of the requests delayed by hang_latency.
+        :type hang_rate: float
+        :param hang_latency: The delay of the hanging requests and the stalled streams,
+            in seconds.
+        :type hang_latency: float
+        :param seed: The seed of the random generator.
+        :type seed: int
+        :param scripted_faults: The faults of the first requests in order: "error",
+            "slow", "hang", "stall" (the opened stream stalls after stall_after bytes)
+            or None; the later requests get their faults at random.
+        :type scripted_faults: list[str | None] | None
+        :param stall_after: The number of the bytes read from a stalling stream before it stalls.
+        :type stall_after: int
+        """
+        self.s3_client = s3_client
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.hang_rate = hang_rate
+        self.hang_latency = hang_latency
+        self.stall_after = stall_after
+        self.faults = 0
+        self._scripted_faults = list(scripted_faults or [])
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw_fault(self) -> str | None:
+        """
+        Get the fault of the next request.
+
+        :return: The fault, or None if the request has none.
+        :rtype: str | None
+        """
+        with self._lock:
+            if self._scripted_faults:
+                fault = self._scripted_faults.pop(0)
+            else:
+                fault = None
+                draw = self._rng.random()
+                for name, rate in (
+                    ("error", self.error_rate),
+                    ("slow", self.slow_rate),
+                    ("hang", self.hang_rate),
+                ):
+                    if draw < rate:
+                        fault = name
+                        break
+                    draw -= rate
+            if fault is not None:
+                self.faults += 1
+
+        return fault
+
+    def _inject_fault(self) -> str | None:
+        """
+        Fail or delay the request.
+
+        :return: The fault of the request, or None if it has none.
+        :rtype: str | None
+        """
+        fault = self._draw_fault()
+        if fault == "error":
+            raise ConnectionError("The connection to the S3 stand-in was reset.")
+        if fault == "slow":
+            time.sleep(self.slow_latency)
+        elif fault == "hang":
+            time.sleep(self.hang_latency)
+
+        return fault
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        self._inject_fault()
+        return self.s3_client.head(bucket_name, object_key)
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        fault = self._inject_fault()
+        stream = self.s3_client.open(bucket_name, object_key)
+        if fault == "stall":
+            return _StallingStream(stream, self.stall_after, self.hang_latency)
+        return stream
+
+    def download(self, bucket_name: str, object_key: str, local_file_path: str) -> None:
+        self._inject_fault()
+        self.s3_client.download(bucket_name, object_key, local_file_path)
@@ -3,20 +3,105 @@ Module for completing the checking stages for a sample.
 """
 
 import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import partial
+from typing import Iterator
 
 import pandas as pd
 
+from artifact_fetcher import AsyncArtifactFetcher
+from gene_coverage_index import GeneCoverageIndex, get_gene_coverage_index
+from result_memo import ResultMemoStore
+from s3_client import S3ArtifactClient, share_object_heads
 from service_settings.service_config import QCToolConfig
 from spreadsheet.spreadsheet_client import get_sample_data
+from stage_metrics import measure_stage
+from utilities import create_buffered_logger
 from values import MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID
 
 
+def get_stage_error_result(stage: dict, error: Exception) -> dict:
+    """
+    Get the result of a stage that raised an error.
+
+    :param stage: The check or estimation stage.
+    :type stage: dict
+    :param error: The error raised by the stage.
+    :type error: Exception
+    :return: The result of the stage.
+    :rtype: dict
+    """
+    return {
+        "uid": stage["uid"],
+        "name": stage["name"],
+        "status": "error",
+        "message": f"Error in stage '{stage['name']}': {error}",
+    }
+
+
+def complete_batch_check_stages(
+    df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+    logger: logging.Logger,
+) -> dict[str, dict[str, dict]]:
+    """
+    Complete the check and estimation stages that rely only on the Google Sheet
+    data for all samples at once.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :return: The results of the stages by the sample id and the stage uid.
+    :rtype: dict[str, dict[str, dict]]
+    """
+    sample_ids = df["Sample sheet_Sample_ID"].tolist()
+    batch_checks = {sample_id: {} for sample_id in sample_ids}
+
+    for stage in qc_tool_config.check_stages + qc_tool_config.estimation_stages:
+        # Get the vectorized stage function
+        batch_stage_function = qc_tool_config.uid_batch_stage_dict.get(stage["uid"])
+        if batch_stage_function is None:
+            continue
+
+        logger.info("Batch stage: %s", stage["name"])
+        # Complete the stage for all samples; it is left to the per-sample function on errors
+        try:
+            if stage["uid"] == MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID:
+                stage_results = batch_stage_function(
+                    df, stage, qc_tool_config.regression_models
+                )
+            else:
+                stage_results = batch_stage_function(df, stage)
+        except Exception as e:
+            logger.error("Error in batch stage: %s", stage["name"])
+            logger.error(e)
+            continue
+
+        for sample_id, stage_result in zip(sample_ids, stage_results):
+            # The per-sample functions use the first row of the sample
+            if stage["uid"] in batch_checks[sample_id]:
+                continue
+            if isinstance(stage_result, Exception):
+                stage_result = get_stage_error_result(stage, stage_result)
+            batch_checks[sample_id][stage["uid"]] = stage_result
+
+    return batch_checks
+
+
 def complete_qc_stages(
     sample_id: str,
     df: pd.DataFrame,
     qc_tool_config: QCToolConfig,
     logger: logging.Logger,
+    batch_checks: dict[str, dict] | None = None,
+    sample_index: dict[str, list[int]] | None = None,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+    record_timings: bool = False,
 ) -> dict:
     """
     Complete the checking and estimation QC stages for a sample.
@@ -29,12 +114,29 @@ def complete_qc_stages(
     :type qc_tool_config: QCToolConfig
     :param logger: The logger.
     :type logger: logging.Logger
+    :param batch_checks: The results of the stages completed for all samples
+        at once by the stage uid; these stages are not run again.
+    :type batch_checks: dict[str, dict] | None
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]] | None
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :param record_timings: Whether the wall and CPU time and the I/O of the stages
+        run for the sample are added to the meta information.
+    :type record_timings: bool
     :return: The result of the check.
     :rtype: dict
     """
     # Get the sample data
     logger.info("Checking sample: %s", sample_id)
-    sample_df = get_sample_data(sample_id, df)
+    sample_df = get_sample_data(sample_id, df, sample_index)
+    # The stages use the first row of the sample
+    if len(sample_df) > 1:
+        logger.warning(
+            "Sample %s has %d rows in the Google Sheet; the first row is used.",
+            sample_id,
+            len(sample_df),
+        )
 
     # Get the check stages
     check_stages = qc_tool_config.check_stages
@@ -43,6 +145,9 @@ def complete_qc_stages(
     # Get the regression models
     regression_models = qc_tool_config.regression_models
 
+    if batch_checks is None:
+        batch_checks = {}
+
     # Create the result dictionary
     result = {}
 
@@ -52,61 +157,501 @@ def complete_qc_stages(
         "config_version": qc_tool_config.config_version,
         "date": datetime.now().strftime("%Y/%m/%d, %H:%M:%S"),
     }
+    if len(sample_df) > 1:
+        result["meta"]["duplicated_rows"] = len(sample_df)
+    # The timings of the stages by the stage name
+    timings = {}
 
     # Add the stages to the result
     result["stages"] = {"checks": [], "estimations": []}
 
     # Complete the check stages
     for check_stage in check_stages:
-        logger.info("Check stage: %s", check_stage["name"])
+        logger.debug(
+            "Check stage: %s",
+            check_stage["name"],
+            extra={"sample_id": sample_id, "stage": check_stage["name"]},
+        )
+        # Take the result of the check completed for all samples at once
+        if check_stage["uid"] in batch_checks:
+            check_result = batch_checks[check_stage["uid"]]
+            if check_result["status"] == "error":
+                logger.error(
+                    "Error in stage: %s: %s",
+                    check_stage["name"],
+                    check_result["message"],
+                    extra={"sample_id": sample_id, "stage": check_stage["name"]},
+                )
+            result["stages"]["checks"].append(check_result)
+            logger.debug(
+                "Check stage result: %s",
+                result["stages"]["checks"][-1],
+                extra={"sample_id": sample_id, "stage": check_stage["name"]},
+            )
+            continue
+
         # Get the check function
         check_function = qc_tool_config.uid_stage_name_dict[check_stage["uid"]]
         # Check the sample
-        try:
-            result["stages"]["checks"].append(check_function(sample_df, check_stage))
-        except Exception as e:
-            logger.error("Error in stage: %s", check_stage["name"])
-            logger.error(e)
-            result["stages"]["checks"].append(
-                {
-                    "uid": check_stage["uid"],
-                    "name": check_stage["name"],
-                    "status": "error",
-                    "message": f"Error in stage '{check_stage['name']}': {e}",
-                }
-            )
+        with measure_stage() as timings[check_stage["name"]]:
+            try:
+                if check_stage["uid"] in qc_tool_config.uid_stage_artifacts_dict:
+                    result["stages"]["checks"].append(
+                        check_function(sample_df, check_stage, artifact_fetcher)
+                    )
+                else:
+                    result["stages"]["checks"].append(
+                        check_function(sample_df, check_stage)
+                    )
+            except Exception as e:
+                logger.error(
+                    "Error in stage: %s: %s",
+                    check_stage["name"],
+                    e,
+                    extra={"sample_id": sample_id, "stage": check_stage["name"]},
+                )
+                result["stages"]["checks"].append(
+                    get_stage_error_result(check_stage, e)
+                )
 
-        logger.info(f"Check stage result: {result['stages']['checks'][-1]}")
+        logger.debug(
+            "Check stage result: %s",
+            result["stages"]["checks"][-1],
+            extra={"sample_id": sample_id, "stage": check_stage["name"]},
+        )
 
     # Complete the estimation stages
     for estimation_stage in estimation_stages:
-        logger.info("Estimation stage: %s", estimation_stage["name"])
+        logger.debug(
+            "Estimation stage: %s",
+            estimation_stage["name"],
+            extra={"sample_id": sample_id, "stage": estimation_stage["name"]},
+        )
+        # Take the result of the estimation completed for all samples at once
+        if estimation_stage["uid"] in batch_checks:
+            estimation_result = batch_checks[estimation_stage["uid"]]
+            if estimation_result["status"] == "error":
+                logger.error(
+                    "Error in stage: %s: %s",
+                    estimation_stage["name"],
+                    estimation_result["message"],
+                    extra={"sample_id": sample_id, "stage": estimation_stage["name"]},
+                )
+            result["stages"]["estimations"].append(estimation_result)
+            logger.debug(
+                "Estimation stage result: %s",
+                result["stages"]["estimations"][-1],
+                extra={"sample_id": sample_id, "stage": estimation_stage["name"]},
+            )
+            continue
+
         # Get the estimation function
         estimation_function = qc_tool_config.uid_stage_name_dict[
             estimation_stage["uid"]
         ]
         # Estimate the value
-        try:
-            if estimation_stage["uid"] == MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID:
-                result["stages"]["estimations"].append(
-                    estimation_function(sample_df, estimation_stage, regression_models)
+        with measure_stage() as timings[estimation_stage["name"]]:
+            try:
+                if estimation_stage["uid"] == MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID:
+                    result["stages"]["estimations"].append(
+                        estimation_function(sample_df, estimation_stage, regression_models)
+                    )
+                elif estimation_stage["uid"] in qc_tool_config.uid_stage_artifacts_dict:
+                    result["stages"]["estimations"].append(
+                        estimation_function(sample_df, estimation_stage, artifact_fetcher)
+                    )
+                else:
+                    result["stages"]["estimations"].append(
+                        estimation_function(sample_df, estimation_stage)
+                    )
+            except Exception as e:
+                logger.error(
+                    "Error in stage: %s: %s",
+                    estimation_stage["name"],
+                    e,
+                    extra={"sample_id": sample_id, "stage": estimation_stage["name"]},
                 )
-            else:
                 result["stages"]["estimations"].append(
-                    estimation_function(sample_df, estimation_stage)
+                    get_stage_error_result(estimation_stage, e)
                 )
-        except Exception as e:
-            logger.error("Error in stage: %s", estimation_stage["name"])
-            logger.error(e)
-            result["stages"]["estimations"].append(
-                {
-                    "uid": estimation_stage["uid"],
-                    "name": estimation_stage["name"],
-                    "status": "error",
-                    "message": f"Error in stage '{estimation_stage['name']}': {e}",
-                }
-            )
 
-        logger.info(f"Estimation stage result: {result['stages']['estimations'][-1]}")
+        logger.debug(
+            "Estimation stage result: %s",
+            result["stages"]["estimations"][-1],
+            extra={"sample_id": sample_id, "stage": estimation_stage["name"]},
+        )
+
+    if record_timings:
+        result["meta"]["timings"] = timings
 
     return result
+
+
+def complete_sample_qc_stages(
+    sample_id: str,
+    df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+    logger: logging.Logger,
+    batch_checks: dict[str, dict[str, dict]] | None = None,
+    sample_index: dict[str, list[int]] | None = None,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+    memo_store: ResultMemoStore | None = None,
+    record_timings: bool = False,
+) -> dict:
+    """
+    Complete the QC stages for a sample. The stored result is returned
+    if the inputs of the sample have not changed, with the memoized flag
+    set in its meta information.
+
+    :param sample_id: The id of the sample.
+    :type sample_id: str
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param batch_checks: The results of the checks completed for all samples
+        at once by the sample id and the stage uid.
+    :type batch_checks: dict[str, dict[str, dict]] | None
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]] | None
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :param memo_store: The store of the results by the hash of the inputs.
+    :type memo_store: ResultMemoStore | None
+    :param record_timings: Whether the timings of the stages are added to the result.
+    :type record_timings: bool
+    :return: The result of the QC stages.
+    :rtype: dict
+    """
+    # The ETags and the sizes requested for the memo key are used by the stages
+    with share_object_heads():
+        memo_key = None
+        if memo_store is not None:
+            memo_key, memo_result = _lookup_sample_result(
+                sample_id, df, qc_tool_config, sample_index, memo_store, consume=True
+            )
+            if memo_result is not None:
+                logger.info("Sample %s has not changed; the stored result is used.", sample_id)
+                # The callers tell the stored results apart by the flag and remove it
+                memo_result["meta"]["memoized"] = True
+                return memo_result
+
+        sample_batch_checks = batch_checks.get(sample_id) if batch_checks else None
+
+        result = complete_qc_stages(
+            sample_id,
+            df,
+            qc_tool_config,
+            logger,
+            sample_batch_checks,
+            sample_index,
+            artifact_fetcher,
+            record_timings,
+        )
+
+        if memo_key is not None:
+            memo_store.put(memo_key, result)
+
+        return result
+
+
+def get_sample_artifacts(
+    sample_df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+) -> list[str]:
+    """
+    Get the keys of the files on the S3 bucket needed by the stages for a sample.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :return: The keys of the files.
+    :rtype: list[str]
+    """
+    object_keys = []
+    for stage in qc_tool_config.check_stages + qc_tool_config.estimation_stages:
+        artifacts_function = qc_tool_config.uid_stage_artifacts_dict.get(stage["uid"])
+        if artifacts_function is None:
+            continue
+        # The errors are reported by the stage itself
+        try:
+            object_keys.extend(artifacts_function(sample_df, stage))
+        except Exception:
+            continue
+
+    return object_keys
+
+
+def _lookup_sample_result(
+    sample_id: str,
+    df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+    sample_index: dict[str, list[int]] | None,
+    memo_store: ResultMemoStore,
+    consume: bool = False,
+) -> tuple[str | None, dict | None]:
+    """
+    Get the hash of the inputs and the stored result of a sample.
+
+    :param sample_id: The id of the sample.
+    :type sample_id: str
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]] | None
+    :param memo_store: The store of the results by the hash of the inputs.
+    :type memo_store: ResultMemoStore
+    :param consume: Whether the lookup is done by the stages, see ResultMemoStore.lookup.
+    :type consume: bool
+    :return: The hash of the inputs and the stored result.
+    :rtype: tuple[str | None, dict | None]
+    """
+    sample_df = get_sample_data(sample_id, df, sample_index)
+
+    return memo_store.lookup(
+        sample_id,
+        sample_df,
+        qc_tool_config.config,
+        get_sample_artifacts(sample_df, qc_tool_config),
+        consume,
+    )
+
+
+def _prefetch_sample_artifacts(
+    sample_id: str,
+    df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+    sample_index: dict[str, list[int]] | None,
+    artifact_fetcher: AsyncArtifactFetcher,
+    memo_store: ResultMemoStore | None = None,
+) -> None:
+    """
+    Start downloading the files on the S3 bucket needed by a sample;
+    the files of a sample with the stored result are not downloaded.
+
+    :param sample_id: The id of the sample.
+    :type sample_id: str
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]] | None
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher
+    :param memo_store: The store of the results by the hash of the inputs.
+    :type memo_store: ResultMemoStore | None
+    """
+    sample_df = get_sample_data(sample_id, df, sample_index)
+    if sample_df.empty:
+        return
+    gene_coverage_index = get_gene_coverage_index()
+    # The ETags and the sizes requested for the memo key are used for the index
+    with share_object_heads():
+        if memo_store is not None:
+            _, memo_result = _lookup_sample_result(
+                sample_id, df, qc_tool_config, sample_index, memo_store
+            )
+            if memo_result is not None:
+                return
+        object_keys = get_sample_artifacts(sample_df, qc_tool_config)
+        # The gene coverage tables of the current files in the index are not read from S3
+        if gene_coverage_index is not None:
+            object_keys = [
+                object_key
+                for object_key in object_keys
+                if not _is_object_indexed(object_key, gene_coverage_index, artifact_fetcher)
+            ]
+    artifact_fetcher.prefetch(object_keys)
+
+
+def _is_object_indexed(
+    object_key: str,
+    gene_coverage_index: GeneCoverageIndex,
+    artifact_fetcher: AsyncArtifactFetcher,
+) -> bool:
+    """
+    Check whether the table of the current version of a file is in the gene
+    coverage index; the ETag of the file is requested only if a table of it is there.
+
+    :param object_key: The key of the file.
+    :type object_key: str
+    :param gene_coverage_index: The gene coverage index.
+    :type gene_coverage_index: GeneCoverageIndex
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher
+    :return: Whether the table is in the index.
+    :rtype: bool
+    """
+    if not gene_coverage_index.has_object_key(object_key):
+        return False
+
+    # The errors of the files are reported by the stages
+    try:
+        head = artifact_fetcher.head(artifact_fetcher.bucket_name, object_key)
+    except Exception:
+        return False
+
+    return gene_coverage_index.has_object(object_key, head)
+
+
+def _complete_sample_qc_stages_buffered(
+    sample_id: str,
+    prefetch_future: Future | None,
+    logger_name: str,
+    **kwargs,
+) -> tuple[dict, list[logging.LogRecord]]:
+    """
+    Complete the QC stages for a sample and keep its log records in memory.
+
+    :param sample_id: The id of the sample.
+    :type sample_id: str
+    :param prefetch_future: The prefetching of the files of the sample, if it is started.
+    :type prefetch_future: Future | None
+    :param logger_name: The name of the logger to create the records for.
+    :type logger_name: str
+    :return: The result of the QC stages and the log records.
+    :rtype: tuple[dict, list[logging.LogRecord]]
+    """
+    # The stages take over the memo lookup of the prefetching;
+    # its errors are reported by the stages
+    if prefetch_future is not None:
+        wait([prefetch_future])
+    sample_logger, buffer_handler = create_buffered_logger(logger_name)
+    result = complete_sample_qc_stages(sample_id, logger=sample_logger, **kwargs)
+
+    return result, buffer_handler.records
+
+
+def complete_qc_stages_for_samples(
+    sample_ids: list[str],
+    df: pd.DataFrame,
+    qc_tool_config: QCToolConfig,
+    logger: logging.Logger,
+    batch_checks: dict[str, dict[str, dict]] | None = None,
+    sample_index: dict[str, list[int]] | None = None,
+    workers: int = 1,
+    artifact_fetcher: AsyncArtifactFetcher | None = None,
+    prefetch_samples: int = 0,
+    memo_store: ResultMemoStore | None = None,
+    record_timings: bool = False,
+) -> Iterator[dict]:
+    """
+    Complete the QC stages for the samples, in a thread pool if there is
+    more than one worker. The results are yielded and the log records are
+    written in the order of the sample ids.
+
+    :param sample_ids: The ids of the samples.
+    :type sample_ids: list[str]
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qc_tool_config: The configuration for the qc_tool.
+    :type qc_tool_config: QCToolConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param batch_checks: The results of the checks completed for all samples
+        at once by the sample id and the stage uid.
+    :type batch_checks: dict[str, dict[str, dict]] | None
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]] | None
+    :param workers: The number of the samples processed at the same time.
+    :type workers: int
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket;
+        the files are downloaded by the stages if it is not provided.
+    :type artifact_fetcher: AsyncArtifactFetcher | None
+    :param prefetch_samples: The number of the next samples whose files
+        are prefetched while the current samples are processed.
+    :type prefetch_samples: int
+    :param memo_store: The store of the results by the hash of the inputs;
+        the stages are run for all samples if it is not provided.
+    :type memo_store: ResultMemoStore | None
+    :param record_timings: Whether the timings of the stages are added to the results.
+    :type record_timings: bool
+    :return: The results of the QC stages.
+    :rtype: Iterator[dict]
+    """
+    # The samples in progress and the next prefetch_samples samples
+    window = max(workers, 1) + prefetch_samples
+    # The position of the first sample whose files are not prefetched yet
+    prefetched_until = 0
+    # The prefetching of the samples not started yet, by the sample id
+    prefetch_futures: dict[str, Future] = {}
+
+    def prefetch(position: int) -> None:
+        nonlocal prefetched_until
+        if artifact_fetcher is None:
+            return
+        # The memo lookups and the index checks run in the threads of the fetcher
+        window_end = min(position + window, len(sample_ids))
+        for sample_id in sample_ids[prefetched_until:window_end]:
+            prefetch_futures[sample_id] = artifact_fetcher.submit(
+                _prefetch_sample_artifacts,
+                sample_id,
+                df,
+                qc_tool_config,
+                sample_index,
+                artifact_fetcher,
+                memo_store,
+            )
+        prefetched_until = max(prefetched_until, window_end)
+
+    if workers <= 1:
+        for position, sample_id in enumerate(sample_ids):
+            prefetch(position)
+            prefetch_future = prefetch_futures.pop(sample_id, None)
+            if prefetch_future is not None:
+                wait([prefetch_future])
+            yield complete_sample_qc_stages(
+                sample_id,
+                df,
+                qc_tool_config,
+                logger,
+                batch_checks,
+                sample_index,
+                artifact_fetcher,
+                memo_store,
+                record_timings,
+            )
+        return
+
+    complete_function = partial(
+        _complete_sample_qc_stages_buffered,
+        logger_name=logger.name,
+        df=df,
+        qc_tool_config=qc_tool_config,
+        batch_checks=batch_checks,
+        sample_index=sample_index,
+        artifact_fetcher=artifact_fetcher,
+        memo_store=memo_store,
+        record_timings=record_timings,
+    )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The samples are submitted as the window moves, so the samples
+        # waiting for a worker hold no more than the prefetched files;
+        # the results are taken in the order of the sample ids
+        futures: deque[Future] = deque()
+        try:
+            for position in range(len(sample_ids) + 1):
+                prefetch(position)
+                for sample_id in sample_ids[position + len(futures) : position + window]:
+                    futures.append(
+                        executor.submit(
+                            complete_function, sample_id, prefetch_futures.pop(sample_id, None)
+                        )
+                    )
+                if not futures:
+                    break
+                result, records = futures.popleft().result()
+                for record in records:
+                    if logger.isEnabledFor(record.levelno):
+                        logger.handle(record)
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
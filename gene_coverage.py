@@ -0,0 +1,119 @@
+"""
+Module for the per-gene coverage tables from the coverage-stats.genes.txt files.
+"""
+
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+import numpy as np
+
+# The values of the good column
+GOOD_FLAGS = ("True", "False")
+
+
+@dataclass
+class GeneCoverageTable:
+    """
+    Class for storing a coverage-stats.genes.txt file column by column:
+    the gene names, the per-gene metrics by the column name and the good flag.
+    """
+
+    genes: np.ndarray
+    good: np.ndarray
+    metrics: dict[str, np.ndarray] = field(default_factory=dict)
+
+    @property
+    def low_coverage_genes(self) -> list[str]:
+        """
+        Get the genes marked as False in the good column.
+
+        :return: The genes with low coverage.
+        :rtype: list[str]
+        """
+        return self.genes[~self.good].tolist()
+
+
+def _get_metric_column(values: list[str]) -> np.ndarray:
+    """
+    Convert the values of a metric to an array: of floats if all values are numbers.
+
+    :param values: The values of the metric.
+    :type values: list[str]
+    :return: The column of the metric.
+    :rtype: np.ndarray
+    """
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        return np.array(values, dtype=object)
+
+
+def read_gene_coverage_table(
+    stream: BinaryIO,
+    chunk_size: int = 64 * 1024,
+) -> GeneCoverageTable:
+    """
+    Read a coverage-stats.genes.txt file from a stream in one pass.
+    The first token of a line is the gene name and the last one is the good flag;
+    the first line is the header if it does not end with a good flag.
+
+    :param stream: The stream of the file, e.g. the body of an S3 object.
+    :type stream: BinaryIO
+    :param chunk_size: The number of the bytes read from the stream at once.
+    :type chunk_size: int
+    :return: The gene coverage table.
+    :rtype: GeneCoverageTable
+    """
+    header = None
+    genes = []
+    flags = []
+    metrics_rows = []
+    is_first_line = True
+    remainder = b""
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if chunk:
+                lines = (remainder + chunk).split(b"\n")
+                # The last line may continue in the next chunk
+                remainder = lines.pop()
+            else:
+                lines = [remainder] if remainder else []
+
+            for line in lines:
+                tokens = line.decode().split()
+                if is_first_line:
+                    is_first_line = False
+                    if tokens and tokens[-1] not in GOOD_FLAGS:
+                        header = tokens
+                        continue
+                genes.append(tokens[0])
+                flags.append(tokens[-1])
+                metrics_rows.append(tokens[1:-1])
+
+            if not chunk:
+                break
+    except Exception as e:
+        raise Exception("An error occurred while reading the file.") from e
+
+    # The names of the metrics are taken from the header if there is one
+    if header is not None:
+        metric_names = header[1:-1]
+    else:
+        metric_names = [
+            f"metric_{index}"
+            for index in range(max((len(row) for row in metrics_rows), default=0))
+        ]
+
+    metrics = {}
+    for index, metric_name in enumerate(metric_names):
+        metrics[metric_name] = _get_metric_column(
+            [row[index] if index < len(row) else "nan" for row in metrics_rows],
+        )
+
+    return GeneCoverageTable(
+        genes=np.array(genes, dtype=str),
+        good=np.array(flags, dtype=str) != "False",
+        metrics=metrics,
+    )
@@ -0,0 +1,434 @@
+"""
+Module for the local index of the per-gene coverage tables of the samples,
+for the queries of the genes that are repeatedly under-covered across
+the samples of a run or a period without downloading the files again.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from gene_coverage import GeneCoverageTable
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coverage_tables (
+    table_id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    panel TEXT NOT NULL,
+    object_key TEXT NOT NULL,
+    etag TEXT,
+    size INTEGER,
+    genes INTEGER NOT NULL,
+    low_coverage_genes INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    UNIQUE (run, sample_id, panel)
+);
+CREATE INDEX IF NOT EXISTS coverage_tables_object_key ON coverage_tables (object_key);
+CREATE INDEX IF NOT EXISTS coverage_tables_indexed_at ON coverage_tables (indexed_at);
+CREATE TABLE IF NOT EXISTS gene_coverage (
+    table_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    gene TEXT NOT NULL,
+    good INTEGER NOT NULL,
+    metrics TEXT NOT NULL,
+    PRIMARY KEY (table_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS gene_coverage_gene ON gene_coverage (gene, good);
+"""
+
+# The index of the process, see get_gene_coverage_index
+_gene_coverage_index: "GeneCoverageIndex | None" = None
+
+
+class GeneCoverageIndex:
+    """
+    Class for storing the per-gene coverage tables in a SQLite database keyed by
+    the run, the sample id and the panel version (v1, v2): the gene names,
+    the good flags and the per-gene metrics of every table. The ETag and the size
+    of the file a table was read from are stored with it, so a table of a changed
+    file is not used and is read again.
+
+    The database is in the WAL mode and every thread has its own connection,
+    so the samples processed at the same time and the other processes
+    of the service (the daemon, the HTTP service) share one index.
+    """
+
+    def __init__(self, file_path: str, index_passed_panels: bool = False):
+        """
+        :param file_path: The path to the SQLite file of the index.
+        :type file_path: str
+        :param index_passed_panels: Whether the tables of the panels that pass
+            the average coverage completeness check are read and indexed too,
+            so the failure frequencies are over all checked samples, not only
+            over the samples with a low coverage completeness.
+        :type index_passed_panels: bool
+        """
+        self.file_path = file_path
+        self.index_passed_panels = index_passed_panels
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+            self._add_head_columns(connection)
+
+    @staticmethod
+    def _add_head_columns(connection: sqlite3.Connection) -> None:
+        """
+        Add the ETag and the size columns to an index created before they were stored;
+        the tables indexed without them do not match any file and are read again.
+
+        :param connection: The connection.
+        :type connection: sqlite3.Connection
+        """
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(coverage_tables)")}
+        for column, column_type in (("etag", "TEXT"), ("size", "INTEGER")):
+            if column in columns:
+                continue
+            try:
+                connection.execute(f"ALTER TABLE coverage_tables ADD COLUMN {column} {column_type}")
+            except sqlite3.OperationalError:
+                # The column is added by another process at the same time
+                pass
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current thread, opening it on the first call.
+
+        :return: The connection.
+        :rtype: sqlite3.Connection
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.file_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+
+        return connection
+
+    def _get_table_id(self, run: str, sample_id: str, panel: str, head: dict) -> int | None:
+        """
+        Get the id of the table of a panel of a sample read from the current file.
+
+        :param run: The name of the run.
+        :type run: str
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param panel: The panel version: v1 or v2.
+        :type panel: str
+        :param head: The ETag and the size of the coverage-stats.genes.txt file.
+        :type head: dict
+        :return: The id of the table, or None if the table is not in the index
+            or was read from another version of the file.
+        :rtype: int | None
+        """
+        row = self._connect().execute(
+            "SELECT table_id FROM coverage_tables "
+            "WHERE run = ? AND sample_id = ? AND panel = ? AND etag = ? AND size = ?",
+            (run, sample_id, panel, head["etag"], head["size"]),
+        ).fetchone()
+
+        return row[0] if row is not None else None
+
+    def has_table(self, run: str, sample_id: str, panel: str, head: dict) -> bool:
+        """
+        Check whether the table of a panel of a sample read from the current file is in the index.
+
+        :param run: The name of the run.
+        :type run: str
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param panel: The panel version: v1 or v2.
+        :type panel: str
+        :param head: The ETag and the size of the coverage-stats.genes.txt file.
+        :type head: dict
+        :return: Whether the table is in the index.
+        :rtype: bool
+        """
+        return self._get_table_id(run, sample_id, panel, head) is not None
+
+    def has_object_key(self, object_key: str) -> bool:
+        """
+        Check whether a table read from any version of a file on the S3 bucket is in the index.
+
+        :param object_key: The key of the coverage-stats.genes.txt file.
+        :type object_key: str
+        :return: Whether a table is in the index.
+        :rtype: bool
+        """
+        row = self._connect().execute(
+            "SELECT 1 FROM coverage_tables WHERE object_key = ?", (object_key,)
+        ).fetchone()
+
+        return row is not None
+
+    def has_object(self, object_key: str, head: dict) -> bool:
+        """
+        Check whether the table read from the current version of a file
+        on the S3 bucket is in the index.
+
+        :param object_key: The key of the coverage-stats.genes.txt file.
+        :type object_key: str
+        :param head: The ETag and the size of the file.
+        :type head: dict
+        :return: Whether the table is in the index.
+        :rtype: bool
+        """
+        row = self._connect().execute(
+            "SELECT 1 FROM coverage_tables WHERE object_key = ? AND etag = ? AND size = ?",
+            (object_key, head["etag"], head["size"]),
+        ).fetchone()
+
+        return row is not None
+
+    def get_low_coverage_genes(
+        self,
+        run: str,
+        sample_id: str,
+        panel: str,
+        head: dict,
+    ) -> list[str] | None:
+        """
+        Get the genes marked as False in the good column of the table of a panel
+        of a sample, in the order of the file.
+
+        :param run: The name of the run.
+        :type run: str
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param panel: The panel version: v1 or v2.
+        :type panel: str
+        :param head: The ETag and the size of the coverage-stats.genes.txt file.
+        :type head: dict
+        :return: The genes with low coverage, or None if the table is not in the index
+            or was read from another version of the file.
+        :rtype: list[str] | None
+        """
+        table_id = self._get_table_id(run, sample_id, panel, head)
+        if table_id is None:
+            return None
+
+        rows = self._connect().execute(
+            "SELECT gene FROM gene_coverage WHERE table_id = ? AND good = 0 ORDER BY position",
+            (table_id,),
+        ).fetchall()
+
+        return [gene for (gene,) in rows]
+
+    def add(
+        self,
+        run: str,
+        sample_id: str,
+        panel: str,
+        object_key: str,
+        head: dict,
+        gene_coverage_table: GeneCoverageTable,
+    ) -> None:
+        """
+        Add the table of a panel of a sample to the index, replacing the stored one.
+
+        :param run: The name of the run.
+        :type run: str
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param panel: The panel version: v1 or v2.
+        :type panel: str
+        :param object_key: The key of the coverage-stats.genes.txt file on the S3 bucket.
+        :type object_key: str
+        :param head: The ETag and the size of the file the table was read from.
+        :type head: dict
+        :param gene_coverage_table: The gene coverage table.
+        :type gene_coverage_table: GeneCoverageTable
+        """
+        metric_names = list(gene_coverage_table.metrics)
+        metric_columns = [
+            column.tolist() for column in gene_coverage_table.metrics.values()
+        ]
+        gene_rows = (
+            (
+                position,
+                gene,
+                int(good),
+                json.dumps(
+                    {name: column[position] for name, column in zip(metric_names, metric_columns)}
+                ),
+            )
+            for position, (gene, good) in enumerate(
+                zip(gene_coverage_table.genes.tolist(), gene_coverage_table.good.tolist())
+            )
+        )
+
+        connection = self._connect()
+        with connection:
+            row = connection.execute(
+                "SELECT table_id FROM coverage_tables "
+                "WHERE run = ? AND sample_id = ? AND panel = ?",
+                (run, sample_id, panel),
+            ).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM gene_coverage WHERE table_id = ?", row)
+                connection.execute("DELETE FROM coverage_tables WHERE table_id = ?", row)
+            table_id = connection.execute(
+                "INSERT INTO coverage_tables "
+                "(run, sample_id, panel, object_key, etag, size, genes, "
+                "low_coverage_genes, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run,
+                    sample_id,
+                    panel,
+                    object_key,
+                    head["etag"],
+                    head["size"],
+                    len(gene_coverage_table.genes),
+                    int(np.count_nonzero(~gene_coverage_table.good)),
+                    time.time(),
+                ),
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO gene_coverage (table_id, position, gene, good, metrics) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((table_id, *gene_row) for gene_row in gene_rows),
+            )
+
+    def get_gene_failure_frequency(
+        self,
+        run: str | None = None,
+        panel: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        min_failed_samples: int = 1,
+    ) -> list[dict]:
+        """
+        Get how often every gene is marked as False across the indexed samples,
+        the most frequently failed genes first.
+
+        :param run: The name of the run; all runs are queried if it is not provided.
+        :type run: str | None
+        :param panel: The panel version: v1 or v2; both panels are queried if it is not provided.
+        :type panel: str | None
+        :param since: The start of the period of the indexing, as a Unix time.
+        :type since: float | None
+        :param until: The end of the period of the indexing, as a Unix time.
+        :type until: float | None
+        :param min_failed_samples: The minimal number of the samples where the gene failed.
+        :type min_failed_samples: int
+        :return: The gene, the panel, the numbers of the samples where the gene
+            is indexed and where it failed and the failure frequency.
+        :rtype: list[dict]
+        """
+        conditions = []
+        parameters = []
+        for condition, value in (
+            ("t.run = ?", run),
+            ("t.panel = ?", panel),
+            ("t.indexed_at >= ?", since),
+            ("t.indexed_at < ?", until),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        rows = self._connect().execute(
+            f"""
+            SELECT g.gene, t.panel, COUNT(DISTINCT t.sample_id) AS samples,
+                COUNT(DISTINCT CASE WHEN g.good = 0 THEN t.sample_id END) AS failed_samples
+            FROM coverage_tables AS t JOIN gene_coverage AS g ON g.table_id = t.table_id
+            {where}
+            GROUP BY g.gene, t.panel
+            HAVING failed_samples >= ?
+            ORDER BY failed_samples * 1.0 / samples DESC, failed_samples DESC, g.gene, t.panel
+            """,
+            (*parameters, min_failed_samples),
+        ).fetchall()
+
+        return [
+            {
+                "gene": gene,
+                "panel": panel,
+                "samples": samples,
+                "failed_samples": failed_samples,
+                "failure_frequency": round(failed_samples / samples, 4),
+            }
+            for gene, panel, samples, failed_samples in rows
+        ]
+
+    def close(self) -> None:
+        """
+        Close the connection of the current thread.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def set_gene_coverage_index(gene_coverage_index: GeneCoverageIndex | None) -> None:
+    """
+    Set the index of the process used by the average coverage completeness check.
+
+    :param gene_coverage_index: The index; the check reads the files from S3
+        without an index if it is None.
+    :type gene_coverage_index: GeneCoverageIndex | None
+    """
+    global _gene_coverage_index
+
+    _gene_coverage_index = gene_coverage_index
+
+
+def get_gene_coverage_index() -> GeneCoverageIndex | None:
+    """
+    Get the index of the process used by the average coverage completeness check.
+
+    :return: The index, or None if it is not set.
+    :rtype: GeneCoverageIndex | None
+    """
+    return _gene_coverage_index
+
+
+def _parse_date(value: str) -> float:
+    """
+    Convert a date in the ISO format, e.g. 2024-05-01, to a Unix time.
+
+    :param value: The date.
+    :type value: str
+    :return: The Unix time.
+    :rtype: float
+    """
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query how often the genes are under-covered across the indexed samples."
+    )
+    parser.add_argument("file_path", help="The path to the SQLite file of the index.")
+    parser.add_argument("--run", default=None, help="The name of the run.")
+    parser.add_argument("--panel", choices=["v1", "v2"], default=None, help="The panel version.")
+    parser.add_argument(
+        "--since", type=_parse_date, default=None, help="The start of the period, e.g. 2024-05-01."
+    )
+    parser.add_argument(
+        "--until", type=_parse_date, default=None, help="The end of the period, e.g. 2024-06-01."
+    )
+    parser.add_argument(
+        "--min-failed-samples",
+        type=int,
+        default=2,
+        help="The minimal number of the samples where the gene failed.",
+    )
+    args = parser.parse_args()
+
+    frequencies = GeneCoverageIndex(args.file_path).get_gene_failure_frequency(
+        args.run, args.panel, args.since, args.until, args.min_failed_samples
+    )
+    print(json.dumps(frequencies, indent=4))
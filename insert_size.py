@@ -0,0 +1,186 @@
+"""
+Module for the insert size histogram from the picard insert size metrics.
+"""
+
+from dataclasses import dataclass
+from typing import BinaryIO
+
+import numpy as np
+
+from utilities import read_insert_size_metrics_lines
+
+
+@dataclass
+class InsertSizeHistogram:
+    """
+    Class for storing the picard insert size metrics as arrays of the insert sizes
+    (sorted ascending) and the counts of the reads with these sizes.
+
+    The cumulative counts are computed once, so every metric is a lookup
+    and any number of metrics is computed without parsing the file again.
+    """
+
+    sizes: np.ndarray
+    counts: np.ndarray
+
+    def __post_init__(self):
+        self.cumulative_counts = np.cumsum(self.counts)
+        self.total_count = int(self.cumulative_counts[-1]) if len(self.counts) else 0
+        if self.total_count <= 0:
+            raise ValueError("The insert size histogram is empty.")
+
+    @classmethod
+    def from_picard_lines(cls, lines: list[str]) -> "InsertSizeHistogram":
+        """
+        Create the histogram from the lines of the insert_size_metrics_2 file:
+        the second column is the insert size and the third one is the count.
+
+        :param lines: The lines of the file without the header.
+        :type lines: list[str]
+        :return: The insert size histogram.
+        :rtype: InsertSizeHistogram
+        """
+        try:
+            rows = np.array(
+                [line.strip().split("\t")[1:3] for line in lines],
+                dtype=np.int64,
+            ).reshape(-1, 2)
+        except Exception as e:
+            raise Exception("An error occurred while reading the file.") from e
+
+        # Keep the last count of a repeated size
+        reversed_sizes = rows[::-1, 0]
+        sizes, positions = np.unique(reversed_sizes, return_index=True)
+        counts = rows[::-1, 1][positions]
+
+        return cls(sizes=sizes, counts=counts)
+
+    def _count_below(self, cutoff: float) -> int:
+        """
+        Get the number of the reads with the insert size less than the cutoff.
+
+        :param cutoff: The insert size cutoff.
+        :type cutoff: float
+        :return: The number of the reads.
+        :rtype: int
+        """
+        position = int(np.searchsorted(self.sizes, cutoff, side="left"))
+        return int(self.cumulative_counts[position - 1]) if position else 0
+
+    def fraction_below(self, cutoff: float) -> float:
+        """
+        Get the fraction of the reads with the insert size less than the cutoff.
+
+        :param cutoff: The insert size cutoff.
+        :type cutoff: float
+        :return: The fraction of the reads.
+        :rtype: float
+        """
+        return self._count_below(cutoff) / self.total_count
+
+    def fraction_between(self, low: float, high: float) -> float:
+        """
+        Get the fraction of the reads with the insert size in [low, high).
+
+        :param low: The lower insert size cutoff.
+        :type low: float
+        :param high: The upper insert size cutoff.
+        :type high: float
+        :return: The fraction of the reads.
+        :rtype: float
+        """
+        return (self._count_below(high) - self._count_below(low)) / self.total_count
+
+    def median(self) -> int:
+        """
+        Get the median insert size of the reads.
+
+        :return: The median insert size.
+        :rtype: int
+        """
+        position = int(np.searchsorted(self.cumulative_counts, self.total_count / 2))
+        return int(self.sizes[position])
+
+    def mode(self) -> int:
+        """
+        Get the most frequent insert size of the reads.
+
+        :return: The most frequent insert size.
+        :rtype: int
+        """
+        return int(self.sizes[np.argmax(self.counts)])
+
+    def _peak(self, window: list[float]) -> int:
+        """
+        Get the height of the peak of the histogram in the [low, high) window.
+
+        :param window: The lower and the upper insert size of the window.
+        :type window: list[float]
+        :return: The maximal count in the window.
+        :rtype: int
+        """
+        start, end = np.searchsorted(self.sizes, window, side="left")
+        return int(self.counts[start:end].max()) if end > start else 0
+
+    def peak_ratio(self, numerator: list[float], denominator: list[float]) -> float:
+        """
+        Get the ratio of the heights of two peaks of the histogram,
+        e.g. of the mono- and the di-nucleosome peaks.
+
+        :param numerator: The [low, high) window of the numerator peak.
+        :type numerator: list[float]
+        :param denominator: The [low, high) window of the denominator peak.
+        :type denominator: list[float]
+        :return: The ratio of the peaks.
+        :rtype: float
+        """
+        denominator_peak = self._peak(denominator)
+        if denominator_peak == 0:
+            raise ValueError("There are no reads in the denominator peak window.")
+
+        return self._peak(numerator) / denominator_peak
+
+    def get_metrics(self, metrics_config: list[dict]) -> dict[str, float]:
+        """
+        Compute the metrics of the histogram from the stage configuration.
+        Every item has the name and the type of the metric: fraction_below (cutoff),
+        fraction_between (low, high), median, mode or peak_ratio (numerator,
+        denominator windows).
+
+        :param metrics_config: The configuration of the metrics.
+        :type metrics_config: list[dict]
+        :return: The values of the metrics by the name.
+        :rtype: dict[str, float]
+        """
+        metrics = {}
+        for metric in metrics_config:
+            if metric["type"] == "fraction_below":
+                value = round(self.fraction_below(metric["cutoff"]), 4)
+            elif metric["type"] == "fraction_between":
+                value = round(self.fraction_between(metric["low"], metric["high"]), 4)
+            elif metric["type"] == "median":
+                value = self.median()
+            elif metric["type"] == "mode":
+                value = self.mode()
+            elif metric["type"] == "peak_ratio":
+                value = round(
+                    self.peak_ratio(metric["numerator"], metric["denominator"]),
+                    4,
+                )
+            else:
+                raise ValueError(f"Unknown insert size metric type: {metric['type']}.")
+            metrics[metric["name"]] = value
+
+        return metrics
+
+
+def read_insert_size_histogram(tar_file: BinaryIO) -> InsertSizeHistogram:
+    """
+    Read the insert size histogram from the stream of a picard output archive.
+
+    :param tar_file: The stream of the .tar.gz archive with the picard output files.
+    :type tar_file: BinaryIO
+    :return: The insert size histogram.
+    :rtype: InsertSizeHistogram
+    """
+    return InsertSizeHistogram.from_picard_lines(read_insert_size_metrics_lines(tar_file))
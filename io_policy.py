@@ -0,0 +1,501 @@
+"""
+Module for the policy of the remote calls shared by the S3 and the Google Sheets
+clients: the deadlines, the retries with an exponential backoff and jitter,
+the circuit breakers per endpoint and the hedged requests.
+"""
+
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+# The HTTP statuses of the errors that are worth retrying
+RETRYABLE_HTTP_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+    Error raised when a call does not complete before its deadline.
+    """
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Error raised when the circuit breaker of an endpoint does not let a call through.
+    """
+
+
+def get_http_status(error: BaseException) -> int | None:
+    """
+    Get the HTTP status of an error of a remote call: of botocore, gspread
+    or their causes.
+
+    :param error: The error.
+    :type error: BaseException
+    :return: The HTTP status, or None if the error has none.
+    :rtype: int | None
+    """
+    while error is not None:
+        response = getattr(error, "response", None)
+        if isinstance(response, dict):
+            status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status is not None:
+                return status
+        elif response is not None and getattr(response, "status_code", None) is not None:
+            return response.status_code
+        error = error.__cause__
+
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Check whether a failed call is worth retrying: the timeouts, the connection
+    errors and the throttling and server errors are, the missing objects and
+    the invalid requests are not.
+
+    :param error: The error of the call.
+    :type error: BaseException
+    :return: Whether the call is retried.
+    :rtype: bool
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = get_http_status(error)
+    if status is not None:
+        return status in RETRYABLE_HTTP_STATUSES
+
+    cause = error
+    while cause is not None:
+        if isinstance(cause, (FileNotFoundError, KeyError, ValueError)):
+            return False
+        cause = cause.__cause__
+
+    return True
+
+
+class CircuitBreaker:
+    """
+    Class for stopping the calls to an endpoint after failure_threshold failures
+    in a row. The calls fail at once for reset_timeout seconds; then a single
+    trial call is let through, and its success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        :param failure_threshold: The number of the failures in a row that open the circuit.
+        :type failure_threshold: int
+        :param reset_timeout: The time after which a trial call is let through, in seconds.
+        :type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Check whether a call is let through.
+
+        :return: Whether the call is let through.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_progress or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self) -> None:
+        """
+        Record a successful call.
+        """
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        """
+        Record a failed call.
+        """
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class LatencyTracker:
+    """
+    Class for keeping the latencies of the last successful calls to an endpoint.
+    """
+
+    def __init__(self, window: int = 1000):
+        """
+        :param window: The number of the last latencies kept.
+        :type window: int
+        """
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        """
+        Add the latency of a call.
+
+        :param latency: The latency, in seconds.
+        :type latency: float
+        """
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float, min_samples: int = 20) -> float | None:
+        """
+        Get a percentile of the latencies.
+
+        :param percentile: The percentile, from 0 to 100.
+        :type percentile: float
+        :param min_samples: The minimal number of the latencies for the percentile.
+        :type min_samples: int
+        :return: The percentile in seconds, or None if there are too few latencies.
+        :rtype: float | None
+        """
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            latencies = sorted(self._latencies)
+
+        # The nearest-rank percentile
+        rank = max(int(len(latencies) * percentile / 100 + 0.5) - 1, 0)
+        return latencies[min(rank, len(latencies) - 1)]
+
+
+class IOPolicy:
+    """
+    Class for making the remote calls with a deadline, bounded retries and a circuit
+    breaker per endpoint. The attempts run in the threads of the policy, so a call
+    that hangs is abandoned at its deadline. A hedged call starts a duplicate
+    attempt if the first one takes longer than the hedge_percentile of the latencies
+    of the endpoint, and the first successful attempt wins.
+
+    At most max_in_flight attempts, the abandoned ones included, run at the same time;
+    a call waits for a free slot until its deadline, and the slow attempts are not hedged
+    when no slot is free.
+    """
+
+    def __init__(
+        self,
+        deadline: float = 120,
+        max_attempts: int = 3,
+        backoff_base: float = 0.2,
+        backoff_max: float = 5,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        hedge_percentile: float | None = 95,
+        hedge_min_samples: int = 20,
+        max_in_flight: int = 64,
+    ):
+        """
+        :param deadline: The time for a call with all its attempts, in seconds.
+        :type deadline: float
+        :param max_attempts: The maximal number of the attempts of a call.
+        :type max_attempts: int
+        :param backoff_base: The maximal delay before the first retry, in seconds;
+            it doubles for every next retry.
+        :type backoff_base: float
+        :param backoff_max: The upper bound of the maximal delay, in seconds.
+        :type backoff_max: float
+        :param failure_threshold: The number of the failures in a row that open
+            the circuit of an endpoint.
+        :type failure_threshold: int
+        :param reset_timeout: The time after which a trial call is let through
+            an open circuit, in seconds.
+        :type reset_timeout: float
+        :param hedge_percentile: The percentile of the latencies after which
+            a hedged call starts a duplicate attempt; the calls are not hedged if it is None.
+        :type hedge_percentile: float | None
+        :param hedge_min_samples: The minimal number of the latencies of an endpoint
+            for its calls to be hedged.
+        :type hedge_min_samples: int
+        :param max_in_flight: The maximal number of the attempts in progress,
+            the abandoned ones included; it is the number of the threads for the attempts.
+        :type max_in_flight: int
+        """
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        # The number of the duplicate attempts started by the hedged calls
+        self.hedges = 0
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._latencies: dict[str, LatencyTracker] = {}
+        self._lock = threading.Lock()
+        # The slots of the attempts in progress; a slot is released when its attempt
+        # completes, not when it is abandoned
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="io_policy"
+        )
+
+    def get_breaker(self, endpoint: str) -> CircuitBreaker:
+        """
+        Get the circuit breaker of an endpoint.
+
+        :param endpoint: The name of the endpoint.
+        :type endpoint: str
+        :return: The circuit breaker.
+        :rtype: CircuitBreaker
+        """
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout
+                )
+                self._latencies[endpoint] = LatencyTracker()
+            return self._breakers[endpoint]
+
+    def _submit(
+        self,
+        endpoint: str,
+        function: Callable[[], Any],
+        record_latency: bool = True,
+    ) -> Future:
+        """
+        Start an attempt in a thread of the policy; the attempt sees the context
+        variables of the caller, e.g. the I/O of the stage being measured.
+        The slot of the attempt must be acquired by the caller.
+
+        :param endpoint: The name of the endpoint.
+        :type endpoint: str
+        :param function: The function of the attempt.
+        :type function: Callable[[], Any]
+        :param record_latency: Whether the latency of the attempt is added to the
+            latencies of the endpoint that the hedging relies on.
+        :type record_latency: bool
+        :return: The attempt.
+        :rtype: Future
+        """
+        context = contextvars.copy_context()
+        start_time = time.monotonic()
+
+        def run() -> Any:
+            try:
+                result = context.run(function)
+            finally:
+                self._slots.release()
+            if record_latency:
+                self._latencies[endpoint].add(time.monotonic() - start_time)
+            return result
+
+        try:
+            return self._executor.submit(run)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _attempt(
+        self,
+        endpoint: str,
+        function: Callable[[], Any],
+        timeout: float,
+        hedge: bool,
+        discard: Callable[[Any], None] | None,
+    ) -> Any:
+        """
+        Make an attempt of a call, hedged if needed; the slot of the first attempt
+        must be acquired by the caller.
+
+        :param endpoint: The name of the endpoint.
+        :type endpoint: str
+        :param function: The function of the call.
+        :type function: Callable[[], Any]
+        :param timeout: The time left before the deadline, in seconds.
+        :type timeout: float
+        :param hedge: Whether a duplicate attempt is started for a slow attempt.
+        :type hedge: bool
+        :param discard: The function that releases the result of an attempt that lost.
+        :type discard: Callable[[Any], None] | None
+        :return: The result of the call.
+        :rtype: Any
+        """
+        end_time = time.monotonic() + timeout
+        futures = [self._submit(endpoint, function)]
+
+        hedge_delay = None
+        if hedge and self.hedge_percentile is not None:
+            hedge_delay = self._latencies[endpoint].percentile(
+                self.hedge_percentile, self.hedge_min_samples
+            )
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(futures, timeout=hedge_delay)
+            # The duplicate attempt is not started if all slots are taken
+            if not done and self._slots.acquire(blocking=False):
+                futures.append(self._submit(endpoint, function))
+                with self._lock:
+                    self.hedges += 1
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(
+                pending, timeout=max(end_time - time.monotonic(), 0), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    winner = future
+                    break
+                error = future.exception()
+            else:
+                continue
+            # The results of the other attempts are released when they complete
+            if discard is not None:
+                for future in futures:
+                    if future is not winner:
+                        future.add_done_callback(
+                            lambda lost: discard(lost.result()) if lost.exception() is None else None
+                        )
+            return winner.result()
+
+        if error is not None and not pending:
+            raise error
+        # The attempts that hang are abandoned; their results are released when they complete
+        if discard is not None:
+            for future in pending:
+                future.add_done_callback(
+                    lambda lost: discard(lost.result()) if lost.exception() is None else None
+                )
+        raise DeadlineExceededError(f"The call to {endpoint} did not complete in time.")
+
+    def call(
+        self,
+        endpoint: str,
+        function: Callable[[], Any],
+        hedge: bool = False,
+        discard: Callable[[Any], None] | None = None,
+        deadline: float | None = None,
+    ) -> Any:
+        """
+        Make a remote call with the policy.
+
+        :param endpoint: The name of the endpoint, e.g. the S3 bucket or the Google Sheets API;
+            the endpoint has its own circuit breaker and latencies.
+        :type endpoint: str
+        :param function: The function of the call, without arguments.
+        :type function: Callable[[], Any]
+        :param hedge: Whether a duplicate attempt is started for a slow attempt;
+            only for the idempotent calls.
+        :type hedge: bool
+        :param discard: The function that releases the result of an attempt that lost,
+            e.g. closes a stream or removes a file.
+        :type discard: Callable[[Any], None] | None
+        :param deadline: The time for the call with all its attempts, in seconds;
+            the deadline of the policy is used if it is not provided.
+        :type deadline: float | None
+        :return: The result of the call.
+        :rtype: Any
+        """
+        breaker = self.get_breaker(endpoint)
+        end_time = time.monotonic() + (deadline if deadline is not None else self.deadline)
+
+        for attempt in range(self.max_attempts):
+            # The endpoint is not at fault, so the circuit is not affected
+            if not self._slots.acquire(timeout=max(end_time - time.monotonic(), 0)):
+                raise DeadlineExceededError(
+                    f"No attempt slot became free in time for the call to {endpoint}."
+                )
+            if not breaker.allow():
+                self._slots.release()
+                raise CircuitOpenError(f"The circuit of {endpoint} is open.")
+
+            try:
+                result = self._attempt(
+                    endpoint, function, end_time - time.monotonic(), hedge, discard
+                )
+            except Exception as error:
+                if not is_retryable(error):
+                    # The endpoint has answered, so the circuit is not affected
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                # Full jitter: a random delay up to the exponential bound
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+                if attempt + 1 >= self.max_attempts or time.monotonic() + delay >= end_time:
+                    raise
+                time.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+
+    def call_once(
+        self,
+        endpoint: str,
+        function: Callable[[], Any],
+        deadline: float,
+        discard: Callable[[Any], None] | None = None,
+    ) -> Any:
+        """
+        Make a single attempt of a call that cannot be repeated, e.g. a read from
+        the stream of a response, with a deadline. The attempt is not retried or
+        hedged and its latency is not added to the latencies of the endpoint;
+        its failures count for the circuit breaker of the endpoint.
+
+        :param endpoint: The name of the endpoint.
+        :type endpoint: str
+        :param function: The function of the call, without arguments.
+        :type function: Callable[[], Any]
+        :param deadline: The time for the call, in seconds.
+        :type deadline: float
+        :param discard: The function that releases the result of the attempt
+            if it completes after the deadline.
+        :type discard: Callable[[Any], None] | None
+        :return: The result of the call.
+        :rtype: Any
+        """
+        breaker = self.get_breaker(endpoint)
+        end_time = time.monotonic() + deadline
+
+        if not self._slots.acquire(timeout=deadline):
+            raise DeadlineExceededError(
+                f"No attempt slot became free in time for the call to {endpoint}."
+            )
+        future = self._submit(endpoint, function, record_latency=False)
+
+        done, _ = wait([future], timeout=max(end_time - time.monotonic(), 0))
+        if not done:
+            breaker.record_failure()
+            # The attempt that hangs is abandoned; its result is released when it completes
+            if discard is not None:
+                future.add_done_callback(
+                    lambda lost: discard(lost.result()) if lost.exception() is None else None
+                )
+            raise DeadlineExceededError(f"The call to {endpoint} did not complete in time.")
+
+        error = future.exception()
+        if error is not None:
+            if is_retryable(error):
+                breaker.record_failure()
+            raise error
+
+        return future.result()
+
+    def close(self) -> None:
+        """
+        Stop the threads of the policy; the attempts in progress are not waited for.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
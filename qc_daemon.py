@@ -0,0 +1,333 @@
+"""
+Module for running the qc_tool as a long-running service that watches
+the Google Sheet and completes the QC stages of the newly added samples.
+"""
+
+import logging
+import queue
+import signal
+import threading
+from typing import TYPE_CHECKING
+
+from qc_pipeline import (
+    create_artifact_source,
+    create_trend_store,
+    index_sheet_df,
+    process_samples,
+    read_sheet_df,
+    save_run_summary,
+)
+
+if TYPE_CHECKING:
+    import gspread
+    import pandas as pd
+
+    from artifact_fetcher import AsyncArtifactFetcher
+    from io_policy import IOPolicy
+    from result_memo import ResultMemoStore
+    from result_sink import ResultSink
+    from s3_client import S3ArtifactClient
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+    from spreadsheet.sheet_snapshot import SheetSnapshot
+    from stage_metrics import RunMetrics
+
+
+class QCDaemon:
+    """
+    Class for watching the Google Sheet and completing the QC stages of the samples
+    as soon as they are added.
+
+    The Google Sheet is polled every poll_interval seconds; the ids of the samples
+    that have not been processed yet are put into a bounded queue, and a worker
+    thread takes them from the queue in batches. The samples that do not fit into
+    the queue are picked up by the next polls. The Google Sheet connection,
+    the S3 client, the fitted regression models, the artifact cache, the fetcher
+    and the result sink are created once and kept between the polls.
+
+    The first poll puts all samples of the Google Sheet into the queue,
+    the samples whose inputs have not changed get their stored results.
+    """
+
+    def __init__(
+        self,
+        sheet: "gspread.worksheet.Worksheet",
+        qctool_config: "QCToolConfig",
+        service_config: "ServiceConfig",
+        logger: logging.Logger,
+        s3_client: "S3ArtifactClient",
+        snapshot: "SheetSnapshot | None" = None,
+        io_policy: "IOPolicy | None" = None,
+        poll_interval: float = 30,
+        queue_size: int = 1000,
+        batch_size: int = 16,
+        workers: int = 1,
+        prefetch_samples: int = 0,
+        s3_max_concurrency: int = 8,
+        use_artifact_cache: bool = True,
+        use_result_memo: bool = True,
+    ):
+        """
+        :param sheet: The Google Sheet.
+        :type sheet: gspread.worksheet.Worksheet
+        :param qctool_config: The configuration for the qc_tool.
+        :type qctool_config: QCToolConfig
+        :param service_config: The configuration of the service.
+        :type service_config: ServiceConfig
+        :param logger: The logger.
+        :type logger: logging.Logger
+        :param s3_client: The client for the files on the S3 bucket.
+        :type s3_client: S3ArtifactClient
+        :param snapshot: The local snapshot of the Google Sheet;
+            the whole sheet is read on every poll if it is not provided.
+        :type snapshot: SheetSnapshot | None
+        :param io_policy: The I/O policy of the requests to the Google Sheets API.
+        :type io_policy: IOPolicy | None
+        :param poll_interval: The time between the polls of the Google Sheet, in seconds.
+        :type poll_interval: float
+        :param queue_size: The maximal number of the samples waiting to be processed.
+        :type queue_size: int
+        :param batch_size: The maximal number of the samples processed by the worker at once.
+        :type batch_size: int
+        :param workers: The number of the samples processed at the same time.
+        :type workers: int
+        :param prefetch_samples: The number of the next samples whose files are prefetched.
+        :type prefetch_samples: int
+        :param s3_max_concurrency: The number of the files downloaded from S3 at the same time.
+        :type s3_max_concurrency: int
+        :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+        :type use_artifact_cache: bool
+        :param use_result_memo: Whether the stored results are used for the samples
+            whose inputs have not changed.
+        :type use_result_memo: bool
+        """
+        self.sheet = sheet
+        self.qctool_config = qctool_config
+        self.service_config = service_config
+        self.logger = logger
+        self.s3_client = s3_client
+        self.snapshot = snapshot
+        self.io_policy = io_policy
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch_samples = prefetch_samples
+        self.s3_max_concurrency = s3_max_concurrency
+        self.use_artifact_cache = use_artifact_cache
+        self.use_result_memo = use_result_memo
+
+        # The ids of the samples waiting to be processed
+        self._queue: queue.Queue[str] = queue.Queue(maxsize=queue_size)
+        # The ids of the samples put into the queue, processed or being processed
+        self._seen_sample_ids: set[str] = set()
+        # The last data from the Google Sheet, its index and the results of the batch stages
+        self._sheet_state: tuple["pd.DataFrame", dict, dict] | None = None
+        self._sheet_state_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # The outcomes of the stages of the processed samples for the summary of the runs
+        self._stage_outcomes: dict[str, dict] | None = (
+            {} if service_config.run_summary else None
+        )
+        # The baselines of the metrics, updated with the processed samples
+        self._trend_store = create_trend_store(service_config)
+
+    def stop(self, *_) -> None:
+        """
+        Stop the daemon: the batch being processed is completed,
+        the samples left in the queue are picked up by the next start.
+        Can be used as a signal handler.
+        """
+        self._stop_event.set()
+
+    def poll(self) -> int:
+        """
+        Read the Google Sheet and put the samples that have not been seen yet into the queue.
+
+        :return: The number of the samples put into the queue.
+        :rtype: int
+        """
+        # The stored results are trusted only for the rows as they are in the sheet;
+        # after the first poll only the appended rows are new, and they are always read
+        df = read_sheet_df(
+            self.sheet,
+            self.qctool_config.sheet_columns,
+            self.snapshot,
+            self.io_policy,
+            self.use_result_memo and not self._seen_sample_ids,
+        )
+        sample_index, batch_checks = index_sheet_df(df, self.qctool_config, self.logger)
+        with self._sheet_state_lock:
+            self._sheet_state = (df, sample_index, batch_checks)
+
+        queued = 0
+        for sample_id in sample_index:
+            if sample_id in self._seen_sample_ids:
+                continue
+            try:
+                self._queue.put_nowait(sample_id)
+            except queue.Full:
+                self.logger.warning(
+                    "The queue of the samples is full; the rest of the new samples "
+                    "are left for the next polls."
+                )
+                break
+            self._seen_sample_ids.add(sample_id)
+            queued += 1
+
+        return queued
+
+    def _take_batch(self) -> list[str]:
+        """
+        Wait for the samples in the queue and take up to batch_size of them.
+
+        :return: The ids of the samples, empty if the daemon is stopped.
+        :rtype: list[str]
+        """
+        sample_ids = []
+        while not sample_ids and not self._stop_event.is_set():
+            try:
+                sample_ids.append(self._queue.get(timeout=1))
+            except queue.Empty:
+                continue
+        while len(sample_ids) < self.batch_size:
+            try:
+                sample_ids.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return sample_ids
+
+    def _work(
+        self,
+        artifact_fetcher: "AsyncArtifactFetcher",
+        result_sink: "ResultSink",
+        run_metrics: "RunMetrics",
+        memo_store: "ResultMemoStore | None",
+    ) -> None:
+        """
+        Complete the QC stages of the samples from the queue until the daemon is stopped.
+
+        :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+        :type artifact_fetcher: AsyncArtifactFetcher
+        :param result_sink: The sink of the results.
+        :type result_sink: ResultSink
+        :param run_metrics: The metrics of the daemon.
+        :type run_metrics: RunMetrics
+        :param memo_store: The store of the results by the hash of the inputs.
+        :type memo_store: ResultMemoStore | None
+        """
+        from run_summary import get_sheet_metrics
+
+        while not self._stop_event.is_set():
+            sample_ids = self._take_batch()
+            if not sample_ids or self._stop_event.is_set():
+                break
+
+            with self._sheet_state_lock:
+                df, sample_index, batch_checks = self._sheet_state
+            # The samples removed from the Google Sheet after they were queued are skipped
+            sample_ids = [sample_id for sample_id in sample_ids if sample_id in sample_index]
+
+            try:
+                process_samples(
+                    sample_ids,
+                    df,
+                    sample_index,
+                    batch_checks,
+                    self.qctool_config,
+                    self.service_config,
+                    self.logger,
+                    artifact_fetcher,
+                    result_sink,
+                    run_metrics,
+                    memo_store,
+                    self.workers,
+                    self.prefetch_samples,
+                    self._stage_outcomes,
+                    self._trend_store,
+                )
+                # The results of the buffered sinks are visible after each batch
+                result_sink.flush()
+            except Exception:
+                self.logger.exception("Failed to process the samples: %s.", ", ".join(sample_ids))
+                # The samples are tried again by the next polls
+                self._seen_sample_ids.difference_update(sample_ids)
+
+            # The prefetched files and the memo keys of the batch are not needed anymore
+            artifact_fetcher.reset()
+            if memo_store is not None:
+                for sample_id in sample_ids:
+                    memo_store.forget(sample_id)
+
+            if self._stage_outcomes is not None:
+                try:
+                    save_run_summary(
+                        get_sheet_metrics(df), self._stage_outcomes, self.service_config, self.logger
+                    )
+                except Exception:
+                    self.logger.exception("Failed to save the summary of the runs.")
+
+            if self._trend_store is not None:
+                try:
+                    self._trend_store.save()
+                except Exception:
+                    self.logger.exception("Failed to save the baselines of the metrics.")
+
+            if self.service_config.metrics_file_path is not None:
+                run_metrics.save(self.service_config.metrics_file_path)
+
+    def run(self) -> None:
+        """
+        Run the daemon until it is stopped by SIGINT, SIGTERM or stop().
+        """
+        from artifact_fetcher import AsyncArtifactFetcher
+        from result_memo import ResultMemoStore
+        from result_sink import create_result_sink
+        from stage_metrics import RunMetrics
+        from values import BUCKET_NAME
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        # Load the fitted regression models before the first sample
+        self.qctool_config.regression_models
+
+        run_metrics = RunMetrics()
+        artifact_source = create_artifact_source(
+            self.service_config, self.s3_client, self.use_artifact_cache
+        )
+        memo_store = None
+        if self.use_result_memo:
+            memo_store = ResultMemoStore(
+                self.service_config.result_memo_path, BUCKET_NAME, self.s3_client
+            )
+
+        with AsyncArtifactFetcher(
+            BUCKET_NAME, self.s3_max_concurrency, artifact_source
+        ) as artifact_fetcher, create_result_sink(
+            self.service_config.result_sink, self.service_config.result_file_path
+        ) as result_sink:
+            worker = threading.Thread(
+                target=self._work,
+                args=(artifact_fetcher, result_sink, run_metrics, memo_store),
+                name="qc_daemon_worker",
+            )
+            worker.start()
+            self.logger.info("The daemon is started.")
+
+            try:
+                while not self._stop_event.is_set():
+                    try:
+                        queued = self.poll()
+                        if queued:
+                            self.logger.info("%d new samples are queued.", queued)
+                    except Exception:
+                        self.logger.exception("Failed to poll the Google Sheet.")
+                    self._stop_event.wait(self.poll_interval)
+            finally:
+                self._stop_event.set()
+                worker.join()
+
+        if self.service_config.metrics_file_path is not None:
+            run_metrics.save(self.service_config.metrics_file_path)
+        self.logger.info("The daemon is stopped.")
@@ -0,0 +1,393 @@
+"""
+Module for the steps of the qc_tool shared by the batch run (app), the daemon
+(qc_daemon) and the HTTP service (qc_service): reading and indexing the Google
+Sheet, creating the clients and the stores and processing the samples.
+
+Importing the module has no side effects and the heavy dependencies are
+imported by the functions that use them.
+"""
+
+import logging
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import gspread
+    import pandas as pd
+
+    from artifact_cache import ArtifactCache
+    from artifact_fetcher import AsyncArtifactFetcher
+    from io_policy import IOPolicy
+    from result_memo import ResultMemoStore
+    from result_sink import ResultSink
+    from s3_client import PolicyS3Client, S3ArtifactClient
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+    from spreadsheet.sheet_snapshot import SheetSnapshot
+    from stage_metrics import RunMetrics
+    from trend_store import TrendStore
+
+# Constants
+# The title of the Google Sheet
+SHEET_TITLE = "cfDNA_samples"
+
+
+def connect_to_sheet(
+    logger: logging.Logger,
+    io_policy: "IOPolicy | None" = None,
+) -> "gspread.worksheet.Worksheet":
+    """
+    Connect to the Google Sheet with the credentials from the .env file.
+
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param io_policy: The I/O policy of the requests to the Google Sheets API.
+    :type io_policy: IOPolicy | None
+    :return: The Google Sheet.
+    :rtype: gspread.worksheet.Worksheet
+    """
+    from dotenv import dotenv_values
+
+    from spreadsheet.spreadsheet_client import connect_to_google_sheet
+
+    # Load the environment variables
+    config = dotenv_values(".env")
+
+    # Get the credentials for the Google Sheet API
+    spreadsheet_credentials = config["GDRIVE_API_CREDENTIALS"]
+
+    # Connect to the Google Sheet
+    sheet = connect_to_google_sheet(spreadsheet_credentials, SHEET_TITLE, io_policy)
+    logger.info("Connected to the Google Sheet.")
+
+    return sheet
+
+
+def read_sheet_df(
+    sheet: "gspread.worksheet.Worksheet",
+    columns: list[str] | None = None,
+    snapshot: "SheetSnapshot | None" = None,
+    io_policy: "IOPolicy | None" = None,
+    fresh: bool = False,
+) -> "pd.DataFrame":
+    """
+    Get the data of the Google Sheet as a pandas DataFrame.
+
+    :param sheet: The Google Sheet.
+    :type sheet: gspread.worksheet.Worksheet
+    :param columns: The columns needed by the stages; only they are kept in the snapshot.
+    :type columns: list[str] | None
+    :param snapshot: The local snapshot of the Google Sheet;
+        the whole sheet is read if it is not provided.
+    :type snapshot: SheetSnapshot | None
+    :param io_policy: The I/O policy of the requests to the Google Sheets API.
+    :type io_policy: IOPolicy | None
+    :param fresh: Whether all rows of the snapshot have to be as in the sheet,
+        e.g. when the stored results of the samples are used.
+    :type fresh: bool
+    :return: The data from the Google Sheet.
+    :rtype: pd.DataFrame
+    """
+    from spreadsheet.spreadsheet_client import get_sheet_data, sheet_data_to_df
+
+    # Read only the changed rows of the needed columns
+    if snapshot is not None and columns is not None:
+        return snapshot.sync(sheet, columns, fresh=fresh)
+
+    # Get the data from the Google Sheet
+    data = get_sheet_data(sheet, io_policy)
+
+    # Convert the data to a pandas DataFrame
+    return sheet_data_to_df(data)
+
+
+def create_io_policy(service_config: "ServiceConfig") -> "IOPolicy":
+    """
+    Create the I/O policy of the S3 and the Google Sheets requests.
+
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :return: The I/O policy.
+    :rtype: IOPolicy
+    """
+    from io_policy import IOPolicy
+
+    return IOPolicy(
+        deadline=service_config.io_deadline,
+        max_attempts=service_config.io_max_attempts,
+        backoff_base=service_config.io_backoff_base,
+        backoff_max=service_config.io_backoff_max,
+        failure_threshold=service_config.io_circuit_failure_threshold,
+        reset_timeout=service_config.io_circuit_reset_timeout,
+        hedge_percentile=service_config.io_hedge_percentile,
+    )
+
+
+def create_s3_client(
+    service_config: "ServiceConfig",
+    s3_max_concurrency: int,
+    io_policy: "IOPolicy | None" = None,
+) -> "S3ArtifactClient | PolicyS3Client":
+    """
+    Create the S3 client shared by the samples; the pool fits all parallel transfers.
+
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param s3_max_concurrency: The number of the files downloaded from S3 at the same time.
+    :type s3_max_concurrency: int
+    :param io_policy: The I/O policy of the requests; the requests are retried
+        by botocore if it is not provided.
+    :type io_policy: IOPolicy | None
+    :return: The client for the files on the S3 bucket.
+    :rtype: S3ArtifactClient | PolicyS3Client
+    """
+    from s3_client import PolicyS3Client, S3ArtifactClient
+
+    s3_client = S3ArtifactClient(
+        endpoint_url=service_config.s3_endpoint_url,
+        max_pool_connections=max(
+            service_config.s3_max_pool_connections,
+            s3_max_concurrency * service_config.s3_transfer_max_concurrency,
+        ),
+        connect_timeout=service_config.s3_connect_timeout,
+        read_timeout=service_config.s3_read_timeout,
+        multipart_threshold=service_config.s3_multipart_threshold,
+        transfer_max_concurrency=service_config.s3_transfer_max_concurrency,
+        # The requests are retried by the policy, not by botocore
+        max_attempts=1 if io_policy is not None else 3,
+    )
+    if io_policy is None:
+        return s3_client
+
+    return PolicyS3Client(s3_client, io_policy, service_config.s3_read_timeout)
+
+
+def index_sheet_df(
+    df: "pd.DataFrame",
+    qctool_config: "QCToolConfig",
+    logger: logging.Logger,
+) -> tuple[dict[str, list[int]], dict[str, dict[str, dict]]]:
+    """
+    Index the rows of the samples and complete the stages that rely only on
+    the Google Sheet data for all samples at once.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param qctool_config: The configuration for the qc_tool.
+    :type qctool_config: QCToolConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :return: The positions of the rows by the sample id and the results
+        of the batch stages by the sample id and the stage uid.
+    :rtype: tuple[dict[str, list[int]], dict[str, dict[str, dict]]]
+    """
+    from complete_stages import complete_batch_check_stages
+    from spreadsheet.spreadsheet_client import (
+        build_sample_index,
+        get_duplicated_sample_ids,
+    )
+
+    # Index the rows of the samples once per run
+    sample_index = build_sample_index(df)
+    duplicated_sample_ids = get_duplicated_sample_ids(sample_index)
+    if duplicated_sample_ids:
+        logger.warning(
+            "Duplicated sample ids in the Google Sheet: %s",
+            ", ".join(duplicated_sample_ids),
+        )
+
+    # Complete the checks that rely only on the Google Sheet data for all samples at once
+    batch_checks = complete_batch_check_stages(df, qctool_config, logger)
+    logger.info("The batch checking stages are completed.")
+
+    return sample_index, batch_checks
+
+
+def create_artifact_source(
+    service_config: "ServiceConfig",
+    s3_client: "S3ArtifactClient",
+    use_artifact_cache: bool = True,
+) -> "S3ArtifactClient | ArtifactCache":
+    """
+    Create the source of the files on the S3 bucket: the local cache
+    of the files or the client itself.
+
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param s3_client: The client for the files on the S3 bucket.
+    :type s3_client: S3ArtifactClient
+    :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+    :type use_artifact_cache: bool
+    :return: The source of the files.
+    :rtype: S3ArtifactClient | ArtifactCache
+    """
+    from artifact_cache import ArtifactCache
+
+    # Keep the files from S3 in the local cache between the runs
+    if use_artifact_cache and service_config.artifact_cache_max_size > 0:
+        return ArtifactCache(
+            service_config.artifact_cache_path,
+            service_config.artifact_cache_max_size,
+            s3_client,
+        )
+
+    return s3_client
+
+
+def save_run_summary(
+    sheet_metrics: "pd.DataFrame",
+    stage_outcomes: dict[str, dict],
+    service_config: "ServiceConfig",
+    logger: logging.Logger,
+) -> None:
+    """
+    Compute the summary of the runs and save it to the results directory.
+
+    :param sheet_metrics: The run and the metrics of the samples from the Google Sheet,
+        from run_summary.get_sheet_metrics.
+    :type sheet_metrics: pd.DataFrame
+    :param stage_outcomes: The outcomes of the stages by the sample id.
+    :type stage_outcomes: dict[str, dict]
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    """
+    import run_summary
+
+    summary = run_summary.compute_run_summary(
+        sheet_metrics, stage_outcomes, service_config.run_summary_outlier_threshold
+    )
+    file_path = os.path.join(service_config.result_file_path, run_summary.RUN_SUMMARY_FILE_NAME)
+    run_summary.save_run_summary(summary, file_path)
+    logger.info(
+        "The summary of %d runs is saved to %s; %d outlier metrics are flagged.",
+        len(summary),
+        file_path,
+        sum(len(run["outliers"]) for run in summary.values()),
+    )
+
+
+def create_trend_store(service_config: "ServiceConfig") -> "TrendStore | None":
+    """
+    Create the store of the baselines of the metrics kept between the runs.
+
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :return: The store, or None if the trends are not followed.
+    :rtype: TrendStore | None
+    """
+    from trend_store import TrendStore
+
+    if service_config.trend_store_path is None:
+        return None
+
+    return TrendStore(
+        service_config.trend_store_path,
+        service_config.trend_control_limit_sigma,
+        service_config.trend_ewma_lambda,
+        service_config.trend_min_baseline_samples,
+        service_config.trend_tracked_runs,
+    )
+
+
+def process_samples(
+    sample_ids: list[str],
+    df: "pd.DataFrame",
+    sample_index: dict[str, list[int]],
+    batch_checks: dict[str, dict[str, dict]],
+    qctool_config: "QCToolConfig",
+    service_config: "ServiceConfig",
+    logger: logging.Logger,
+    artifact_fetcher: "AsyncArtifactFetcher",
+    result_sink: "ResultSink",
+    run_metrics: "RunMetrics",
+    memo_store: "ResultMemoStore | None" = None,
+    workers: int = 1,
+    prefetch_samples: int = 0,
+    stage_outcomes: dict[str, dict] | None = None,
+    trend_store: "TrendStore | None" = None,
+) -> None:
+    """
+    Complete the QC stages for the samples and write the results to the sink.
+
+    :param sample_ids: The ids of the samples.
+    :type sample_ids: list[str]
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :param sample_index: The positions of the rows of the DataFrame by the sample id.
+    :type sample_index: dict[str, list[int]]
+    :param batch_checks: The results of the batch stages by the sample id and the stage uid.
+    :type batch_checks: dict[str, dict[str, dict]]
+    :param qctool_config: The configuration for the qc_tool.
+    :type qctool_config: QCToolConfig
+    :param service_config: The configuration of the service.
+    :type service_config: ServiceConfig
+    :param logger: The logger.
+    :type logger: logging.Logger
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher
+    :param result_sink: The sink of the results.
+    :type result_sink: ResultSink
+    :param run_metrics: The metrics of the run.
+    :type run_metrics: RunMetrics
+    :param memo_store: The store of the results by the hash of the inputs.
+    :type memo_store: ResultMemoStore | None
+    :param workers: The number of the samples processed at the same time.
+    :type workers: int
+    :param prefetch_samples: The number of the next samples whose files are prefetched.
+    :type prefetch_samples: int
+    :param stage_outcomes: The outcomes of the stages for the summary of the runs
+        by the sample id, filled for the samples; not collected if it is not provided.
+    :type stage_outcomes: dict[str, dict] | None
+    :param trend_store: The baselines of the metrics; the results get the drift flags
+        against them and the new samples are added to them.
+    :type trend_store: TrendStore | None
+    """
+    from complete_stages import complete_qc_stages_for_samples
+    from run_summary import get_sheet_metrics, get_stage_outcomes
+    from trend_store import TREND_METRICS
+
+    sheet_metrics = None
+    if trend_store is not None:
+        # The metrics of the first rows of the samples, as the stages read them
+        sheet_metrics = get_sheet_metrics(
+            df.iloc[[sample_index[sample_id][0] for sample_id in sample_ids]]
+        ).to_dict(orient="index")
+
+    for result in complete_qc_stages_for_samples(
+        sample_ids,
+        df,
+        qctool_config,
+        logger,
+        batch_checks,
+        sample_index,
+        workers,
+        artifact_fetcher,
+        prefetch_samples,
+        memo_store,
+        service_config.record_stage_timings,
+    ):
+        logger.info("The checking and estimation stages are completed.")
+        # The stored result is written as it was stored
+        is_memoized = result["meta"].pop("memoized", False)
+        run_metrics.add_result(result, is_memoized)
+        if stage_outcomes is not None:
+            stage_outcomes[result["meta"]["sample_id"]] = get_stage_outcomes(
+                result, qctool_config.check_stages
+            )
+        if sheet_metrics is not None:
+            metrics = sheet_metrics[result["meta"]["sample_id"]]
+            result["drift"] = trend_store.observe(
+                result["meta"]["sample_id"],
+                metrics["run"],
+                {metric: metrics[metric] for metric in TREND_METRICS},
+                is_memoized,
+            )
+
+        # The result of an unchanged sample is not written again
+        if is_memoized and result_sink.has_result(result["meta"]["sample_id"]):
+            continue
+
+        # Save the result of the qc_tool
+        result_sink.write(result)
+        logger.info("The result is saved to a file.")
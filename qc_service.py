@@ -0,0 +1,367 @@
+"""
+Module for the local HTTP service that completes the QC stages for a single sample
+on demand:
+
+    POST /samples/{sample_id}/qc - complete the QC stages for the current inputs;
+    GET /samples/{sample_id}/qc - get the last result, completing the stages if there is none.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import signal
+import time
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import unquote, urlsplit
+
+from qc_pipeline import create_artifact_source, index_sheet_df
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from result_memo import ResultMemoStore
+    from s3_client import S3ArtifactClient
+    from service_settings.service_config import QCToolConfig, ServiceConfig
+
+# The path of the QC result of a sample
+SAMPLE_QC_PATH_PATTERN = re.compile(r"^/samples/(?P<sample_id>[^/]+)/qc$")
+# The reason phrases of the response statuses
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+# The maximal size of the request line and the headers, in bytes
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class SampleNotFoundError(KeyError):
+    """
+    Error raised when a sample is not found in the Google Sheet.
+    """
+
+
+class QCService:
+    """
+    Class for completing the QC stages for single samples on demand.
+
+    The Google Sheet data, its index, the results of the batch stages, the S3 client
+    and the fitted regression models are kept in memory; the Google Sheet is read
+    again when its data is older than sheet_refresh_interval seconds, or older than
+    sheet_min_refresh_interval seconds for a request for an unknown sample.
+    The concurrent requests for the same sample share one computation, at most
+    max_concurrency samples are processed at the same time, and the stored result
+    is returned if the inputs of the sample have not changed.
+    """
+
+    def __init__(
+        self,
+        read_sheet: Callable[[], "pd.DataFrame"],
+        qctool_config: "QCToolConfig",
+        service_config: "ServiceConfig",
+        logger: logging.Logger,
+        s3_client: "S3ArtifactClient",
+        memo_store: "ResultMemoStore | None" = None,
+        max_concurrency: int = 4,
+        sheet_refresh_interval: float = 10,
+        use_artifact_cache: bool = True,
+        sheet_min_refresh_interval: float = 2,
+    ):
+        """
+        :param read_sheet: The function that gets the data from the Google Sheet.
+        :type read_sheet: Callable[[], pd.DataFrame]
+        :param qctool_config: The configuration for the qc_tool.
+        :type qctool_config: QCToolConfig
+        :param service_config: The configuration of the service.
+        :type service_config: ServiceConfig
+        :param logger: The logger.
+        :type logger: logging.Logger
+        :param s3_client: The client for the files on the S3 bucket.
+        :type s3_client: S3ArtifactClient
+        :param memo_store: The store of the results by the hash of the inputs;
+            the stages are run on every request if it is not provided.
+        :type memo_store: ResultMemoStore | None
+        :param max_concurrency: The number of the samples processed at the same time.
+        :type max_concurrency: int
+        :param sheet_refresh_interval: The time after which the Google Sheet is read again,
+            in seconds.
+        :type sheet_refresh_interval: float
+        :param use_artifact_cache: Whether the files from S3 are kept in the local cache.
+        :type use_artifact_cache: bool
+        :param sheet_min_refresh_interval: The minimal time between the reads of the Google
+            Sheet forced by the requests for the samples that are not in the data, in seconds.
+        :type sheet_min_refresh_interval: float
+        """
+        self.read_sheet = read_sheet
+        self.qctool_config = qctool_config
+        self.service_config = service_config
+        self.logger = logger
+        self.memo_store = memo_store
+        self.max_concurrency = max_concurrency
+        self.sheet_refresh_interval = sheet_refresh_interval
+        self.sheet_min_refresh_interval = sheet_min_refresh_interval
+        self.artifact_source = create_artifact_source(
+            service_config, s3_client, use_artifact_cache
+        )
+
+        # The data from the Google Sheet, its index, the results of the batch stages
+        # and the time it was read
+        self._sheet_state: tuple["pd.DataFrame", dict, dict] | None = None
+        self._sheet_read_at = 0.0
+        # The last results by the sample id
+        self._results: dict[str, dict] = {}
+        # The computations in progress by the sample id
+        self._in_flight: dict[str, asyncio.Task] = {}
+        # Created on the event loop of the service
+        self._sheet_lock: asyncio.Lock | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._stop_event: asyncio.Event | None = None
+
+    def _start(self) -> None:
+        """
+        Create the synchronization primitives on the running event loop
+        and load the fitted regression models.
+        """
+        if self._semaphore is None:
+            self._sheet_lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._stop_event = asyncio.Event()
+        self.qctool_config.regression_models
+
+    def stop(self) -> None:
+        """
+        Stop serving the HTTP requests; must be called on the event loop of the service.
+        """
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def _read_sheet_state(self) -> tuple["pd.DataFrame", dict, dict]:
+        """
+        Read the Google Sheet, index it and complete the batch stages.
+
+        :return: The data from the Google Sheet, its index and the results of the batch stages.
+        :rtype: tuple[pd.DataFrame, dict, dict]
+        """
+        df = self.read_sheet()
+        sample_index, batch_checks = index_sheet_df(df, self.qctool_config, self.logger)
+
+        return df, sample_index, batch_checks
+
+    async def get_sheet_state(self, force: bool = False) -> tuple["pd.DataFrame", dict, dict]:
+        """
+        Get the data from the Google Sheet, reading it again if it is outdated.
+
+        :param force: Whether the Google Sheet is read again if the data is older than
+            sheet_min_refresh_interval, so the requests for the unknown samples
+            do not read the whole sheet every time.
+        :type force: bool
+        :return: The data from the Google Sheet, its index and the results of the batch stages.
+        :rtype: tuple[pd.DataFrame, dict, dict]
+        """
+        self._start()
+        async with self._sheet_lock:
+            age = time.monotonic() - self._sheet_read_at
+            is_outdated = age >= (
+                self.sheet_min_refresh_interval if force else self.sheet_refresh_interval
+            )
+            if self._sheet_state is None or is_outdated:
+                self._sheet_state = await asyncio.to_thread(self._read_sheet_state)
+                self._sheet_read_at = time.monotonic()
+
+            return self._sheet_state
+
+    def _complete_sample(
+        self,
+        sample_id: str,
+        sheet_state: tuple["pd.DataFrame", dict, dict],
+    ) -> dict:
+        """
+        Complete the QC stages for a sample; runs in a thread of the event loop.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param sheet_state: The data from the Google Sheet, its index
+            and the results of the batch stages.
+        :type sheet_state: tuple[pd.DataFrame, dict, dict]
+        :return: The result of the QC stages.
+        :rtype: dict
+        """
+        from complete_stages import complete_sample_qc_stages
+
+        df, sample_index, batch_checks = sheet_state
+        if self.memo_store is not None:
+            # The inputs may have changed since the previous request
+            self.memo_store.forget(sample_id)
+
+        result = complete_sample_qc_stages(
+            sample_id,
+            df,
+            self.qctool_config,
+            self.logger,
+            batch_checks,
+            sample_index,
+            self.artifact_source,
+            self.memo_store,
+            self.service_config.record_stage_timings,
+        )
+        # The stored result is returned as it was stored
+        result["meta"].pop("memoized", None)
+
+        return result
+
+    async def _compute(self, sample_id: str) -> dict:
+        """
+        Complete the QC stages for a sample with the current inputs.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :return: The result of the QC stages.
+        :rtype: dict
+        """
+        sheet_state = await self.get_sheet_state()
+        # The sample may have been added after the last read
+        if sample_id not in sheet_state[1]:
+            sheet_state = await self.get_sheet_state(force=True)
+        if sample_id not in sheet_state[1]:
+            raise SampleNotFoundError(sample_id)
+
+        async with self._semaphore:
+            result = await asyncio.to_thread(self._complete_sample, sample_id, sheet_state)
+        self._results[sample_id] = result
+
+        return result
+
+    async def complete(self, sample_id: str) -> dict:
+        """
+        Complete the QC stages for a sample; the concurrent calls for the same
+        sample share one computation.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :return: The result of the QC stages.
+        :rtype: dict
+        """
+        self._start()
+        task = self._in_flight.get(sample_id)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(sample_id))
+            self._in_flight[sample_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(sample_id, None))
+
+        # A cancelled request does not cancel the computation shared with the others
+        return await asyncio.shield(task)
+
+    async def get(self, sample_id: str) -> dict:
+        """
+        Get the last result of a sample, completing the QC stages if there is none.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :return: The result of the QC stages.
+        :rtype: dict
+        """
+        if sample_id in self._results:
+            return self._results[sample_id]
+
+        return await self.complete(sample_id)
+
+    async def handle_request(self, method: str, path: str) -> tuple[int, dict]:
+        """
+        Handle an HTTP request.
+
+        :param method: The method of the request.
+        :type method: str
+        :param path: The path of the request.
+        :type path: str
+        :return: The status and the body of the response.
+        :rtype: tuple[int, dict]
+        """
+        match = SAMPLE_QC_PATH_PATTERN.match(urlsplit(path).path)
+        if match is None:
+            return 404, {"error": f"Unknown path: {path}."}
+        if method not in ("GET", "POST"):
+            return 405, {"error": f"Method {method} is not allowed."}
+
+        sample_id = unquote(match["sample_id"])
+        try:
+            if method == "POST":
+                return 200, await self.complete(sample_id)
+            return 200, await self.get(sample_id)
+        except SampleNotFoundError:
+            return 404, {"error": f"Sample {sample_id} is not found in the Google Sheet."}
+        except Exception as error:
+            self.logger.exception("Failed to complete the QC stages for sample %s.", sample_id)
+            return 500, {"error": str(error)}
+
+    async def _handle_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        """
+        Read an HTTP request from a connection and write the response;
+        the connection is closed after the response.
+
+        :param reader: The reader of the connection.
+        :type reader: asyncio.StreamReader
+        :param writer: The writer of the connection.
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            try:
+                header = await reader.readuntil(b"\r\n\r\n")
+                if len(header) > MAX_HEADER_SIZE:
+                    raise ValueError("The headers are too large.")
+                method, path, _ = header.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                status, body = 400, {"error": "Malformed request."}
+            else:
+                status, body = await self.handle_request(method, path)
+
+            payload = json.dumps(body, default=str).encode()
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode()
+                + payload
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        Serve the HTTP requests until SIGINT or SIGTERM is received or stop() is called.
+
+        :param host: The host to listen on.
+        :type host: str
+        :param port: The port to listen on.
+        :type port: int
+        """
+        self._start()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # The signals can be handled only in the main thread on Unix
+                pass
+
+        # Read the Google Sheet before the first request
+        await self.get_sheet_state()
+
+        server = await asyncio.start_server(
+            self._handle_connection, host, port, limit=MAX_HEADER_SIZE
+        )
+        self.logger.info("The QC service is listening on %s:%d.", host, port)
+        async with server:
+            await self._stop_event.wait()
+        self.logger.info("The QC service is stopped.")
@@ -0,0 +1,212 @@
+"""
+Module for the memoized results of the samples whose inputs have not changed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import pandas as pd
+
+from s3_client import S3ArtifactClient, get_object_head, share_object_heads
+
+# The version of the memo keys; it has to be increased when the code of
+# the stages changes the results for the same inputs
+MEMO_VERSION = "1"
+
+
+class ResultMemoStore:
+    """
+    Class for storing the results of the QC stages by the hash of their inputs:
+    the rows of the sample in the Google Sheet, the version and the stages of
+    the configuration and the ETags of the files on the S3 bucket used by
+    the stages. A sample whose inputs have not changed since the previous run
+    gets the stored result (with the date of that run) without running the stages.
+
+    The results with errors are not stored, so the failed stages are run again.
+    """
+
+    def __init__(
+        self,
+        dir_path: str,
+        bucket_name: str,
+        s3_client: S3ArtifactClient,
+    ):
+        """
+        :param dir_path: The path to the directory of the memo store.
+        :type dir_path: str
+        :param bucket_name: The name of the bucket with the files of the samples.
+        :type bucket_name: str
+        :param s3_client: The client for getting the ETags of the files.
+        :type s3_client: S3ArtifactClient
+        """
+        self.dir_path = dir_path
+        self.bucket_name = bucket_name
+        self.s3_client = s3_client
+
+        # The numbers of the lookups of the stages with and without a stored result
+        self.hits = 0
+        self.misses = 0
+        # The hashes of the inputs and the ETags and the sizes of the files of
+        # the samples looked up by the prefetching and not yet by the stages,
+        # by the sample id
+        self._lookups: dict[str, tuple[str | None, dict[tuple[str, str], dict]]] = {}
+        self._lookups_lock = threading.Lock()
+
+        os.makedirs(dir_path, exist_ok=True)
+
+    def get_key(
+        self,
+        sample_df: pd.DataFrame,
+        config: dict,
+        object_keys: list[str],
+    ) -> str:
+        """
+        Get the hash of the inputs of the QC stages for a sample.
+
+        :param sample_df: The data for the sample.
+        :type sample_df: pd.DataFrame
+        :param config: The configuration of the qc_tool with the version and the stages.
+        :type config: dict
+        :param object_keys: The keys of the files on the S3 bucket used by the stages.
+        :type object_keys: list[str]
+        :return: The hash of the inputs.
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        digest.update(MEMO_VERSION.encode())
+        digest.update(json.dumps(config, sort_keys=True).encode())
+        digest.update(
+            json.dumps(sample_df.to_dict(orient="records"), sort_keys=True, default=str).encode()
+        )
+        for object_key in sorted(set(object_keys)):
+            head = get_object_head(self.s3_client, self.bucket_name, object_key)
+            digest.update(f"\0{object_key}\0{head['etag']}\0{head['size']}".encode())
+
+        return digest.hexdigest()
+
+    def _get_entry_path(self, key: str) -> str:
+        """
+        Get the path to the stored result.
+
+        :param key: The hash of the inputs.
+        :type key: str
+        :return: The path to the stored result.
+        :rtype: str
+        """
+        return os.path.join(self.dir_path, key[:2], f"{key}.json")
+
+    def _read_entry(self, key: str) -> dict | None:
+        """
+        Read the stored result.
+
+        :param key: The hash of the inputs.
+        :type key: str
+        :return: The stored result, or None if there is none.
+        :rtype: dict | None
+        """
+        try:
+            with open(self._get_entry_path(key), "r") as entry_file:
+                return json.load(entry_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def lookup(
+        self,
+        sample_id: str,
+        sample_df: pd.DataFrame,
+        config: dict,
+        object_keys: list[str],
+        consume: bool = False,
+    ) -> tuple[str | None, dict | None]:
+        """
+        Get the hash of the inputs and the stored result of a sample. The hash is
+        computed once per sample, so the prefetching of the files and the stages
+        share it; only the hash and the ETags and the sizes of the files are kept
+        in memory and the stored result is read from the memo store on every lookup.
+        Inside share_object_heads, the ETags and the sizes are shared with the caller.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param sample_df: The data for the sample.
+        :type sample_df: pd.DataFrame
+        :param config: The configuration of the qc_tool with the version and the stages.
+        :type config: dict
+        :param object_keys: The keys of the files on the S3 bucket used by the stages.
+        :type object_keys: list[str]
+        :param consume: Whether the lookup is done by the stages: the hit or the miss
+            is counted and the hash is dropped, as it is not needed anymore.
+        :type consume: bool
+        :return: The hash of the inputs (None if the files are not available)
+            and the stored result (None if there is none).
+        :rtype: tuple[str | None, dict | None]
+        """
+        with self._lookups_lock:
+            lookup = self._lookups.pop(sample_id, None) if consume else self._lookups.get(sample_id)
+
+        # The ETags and the sizes requested for the hash are shared with the stages
+        with share_object_heads(lookup[1] if lookup is not None else None) as object_heads:
+            if lookup is not None:
+                key = lookup[0]
+            else:
+                # The errors of the files are reported by the stages
+                try:
+                    key = self.get_key(sample_df, config, object_keys)
+                except Exception:
+                    key = None
+            sample_object_heads = {
+                (self.bucket_name, object_key): object_heads[(self.bucket_name, object_key)]
+                for object_key in object_keys
+                if (self.bucket_name, object_key) in object_heads
+            }
+        result = self._read_entry(key) if key is not None else None
+
+        with self._lookups_lock:
+            if consume:
+                if result is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            else:
+                self._lookups.setdefault(sample_id, (key, sample_object_heads))
+
+        return key, result
+
+    def forget(self, sample_id: str) -> None:
+        """
+        Drop the lookup of a sample, so the hash of its inputs is computed again
+        by the next lookup; used by the long-running services.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        """
+        with self._lookups_lock:
+            self._lookups.pop(sample_id, None)
+
+    def put(self, key: str, result: dict) -> None:
+        """
+        Store the result if none of its stages has an error.
+
+        :param key: The hash of the inputs.
+        :type key: str
+        :param result: The result of the QC stages.
+        :type result: dict
+        """
+        stage_results = result["stages"]["checks"] + result["stages"]["estimations"]
+        if any(stage_result["status"] == "error" for stage_result in stage_results):
+            return
+
+        # The timings describe the run that completed the stages, not the inputs
+        result = {**result, "meta": {**result["meta"]}}
+        result["meta"].pop("timings", None)
+
+        # Write the result with an atomic rename, so the parallel runs
+        # never read a partially written file
+        entry_path = self._get_entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        file_descriptor, tmp_file_path = tempfile.mkstemp(dir=os.path.dirname(entry_path))
+        with os.fdopen(file_descriptor, "w") as entry_file:
+            json.dump(result, entry_file)
+        os.replace(tmp_file_path, entry_path)
@@ -0,0 +1,297 @@
+"""
+Module for the sinks the results of the qc_tool are written to.
+"""
+
+import json
+import os
+import tempfile
+
+from utilities import save_qc_tool_result_locally
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The kinds of the sinks
+RESULT_SINK_KINDS = ("json", "jsonl", "parquet")
+
+
+def dumps_result(result: dict) -> bytes:
+    """
+    Encode a result as compact JSON, with orjson if it is installed.
+
+    :param result: The result of the qc_tool.
+    :type result: dict
+    :return: The encoded result.
+    :rtype: bytes
+    """
+    if orjson is not None:
+        # The values computed with NumPy are NumPy scalars
+        return orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY, default=float)
+
+    return json.dumps(result, separators=(",", ":")).encode()
+
+
+class ResultSink:
+    """
+    Base class for the sinks of the results. A sink is used as a context manager:
+    the buffered results are written when it is closed.
+    """
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def has_result(self, sample_id: str) -> bool:
+        """
+        Check whether the sink already has a result of a sample from a previous run,
+        so the result that has not changed is not written again.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :return: Whether the sink has the result.
+        :rtype: bool
+        """
+        return False
+
+    def write(self, result: dict) -> None:
+        """
+        Write the result of a sample.
+
+        :param result: The result of the qc_tool.
+        :type result: dict
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """
+        Write the buffered results, keeping the sink open.
+        """
+
+    def close(self) -> None:
+        """
+        Write the buffered results.
+        """
+
+
+class JsonFileResultSink(ResultSink):
+    """
+    Class for writing every result to its own <sample_id>_qc_tool_result.json file.
+    """
+
+    def __init__(self, dir_path: str):
+        """
+        :param dir_path: The path to the directory of the result files.
+        :type dir_path: str
+        """
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+
+    def _get_file_name(self, sample_id: str) -> str:
+        return f"{sample_id}_qc_tool_result.json"
+
+    def has_result(self, sample_id: str) -> bool:
+        return os.path.exists(os.path.join(self.dir_path, self._get_file_name(sample_id)))
+
+    def write(self, result: dict) -> None:
+        save_qc_tool_result_locally(
+            result,
+            self.dir_path,
+            self._get_file_name(result["meta"]["sample_id"]),
+        )
+
+
+class JsonlResultSink(ResultSink):
+    """
+    Class for appending the results to a JSON Lines file, one result per line.
+
+    The results are buffered and appended in batches, every batch with one write.
+    A crash while a batch is written can leave an incomplete last line,
+    which the readers have to skip; the complete lines are never changed.
+    """
+
+    def __init__(self, file_path: str, buffer_size: int = 1000):
+        """
+        :param file_path: The path to the JSON Lines file.
+        :type file_path: str
+        :param buffer_size: The number of the results appended at once.
+        :type buffer_size: int
+        """
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self._buffer: list[bytes] = []
+        self._sample_ids = self._read_sample_ids()
+
+    def _read_sample_ids(self) -> set[str]:
+        """
+        Read the ids of the samples whose results are already in the file.
+
+        :return: The ids of the samples.
+        :rtype: set[str]
+        """
+        sample_ids = set()
+        if not os.path.exists(self.file_path):
+            return sample_ids
+
+        with open(self.file_path, "rb") as results_file:
+            for line in results_file:
+                try:
+                    sample_ids.add(json.loads(line)["meta"]["sample_id"])
+                except (ValueError, KeyError, TypeError):
+                    # The incomplete line of an interrupted write
+                    continue
+
+        return sample_ids
+
+    def has_result(self, sample_id: str) -> bool:
+        return sample_id in self._sample_ids
+
+    def write(self, result: dict) -> None:
+        self._buffer.append(dumps_result(result) + b"\n")
+        self._sample_ids.add(result["meta"]["sample_id"])
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Append the buffered results to the file.
+        """
+        if not self._buffer:
+            return
+
+        os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+        with open(self.file_path, "ab") as results_file:
+            results_file.write(b"".join(self._buffer))
+        self._buffer.clear()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def flatten_result(result: dict) -> dict:
+    """
+    Flatten a result to a row: the meta information, the drift flags and the status,
+    the message and the data (as JSON) of every stage in the "<stage name>.<field>" columns.
+
+    :param result: The result of the qc_tool.
+    :type result: dict
+    :return: The values of the columns.
+    :rtype: dict
+    """
+    meta = result["meta"]
+    row = {
+        "sample_id": meta["sample_id"],
+        "config_version": meta["config_version"],
+        "date": meta["date"],
+        "duplicated_rows": meta.get("duplicated_rows", 1),
+        "timings": dumps_result(meta["timings"]).decode() if "timings" in meta else None,
+        "drift": result["drift"]["drift"] if "drift" in result else None,
+        "drift.metrics": (
+            dumps_result(result["drift"]["metrics"]).decode() if "drift" in result else None
+        ),
+    }
+    for stage_result in result["stages"]["checks"] + result["stages"]["estimations"]:
+        row[f"{stage_result['name']}.status"] = stage_result["status"]
+        row[f"{stage_result['name']}.message"] = stage_result.get("message")
+        row[f"{stage_result['name']}.data"] = (
+            dumps_result(stage_result["data"]).decode() if "data" in stage_result else None
+        )
+
+    return row
+
+
+class ParquetResultSink(ResultSink):
+    """
+    Class for writing the results of a run to a Parquet file, one row per sample
+    (see flatten_result). The file is written next to its path and renamed when
+    the sink is closed, so the readers never see a partially written file.
+    """
+
+    def __init__(self, file_path: str, row_group_size: int = 10000):
+        """
+        :param file_path: The path to the Parquet file.
+        :type file_path: str
+        :param row_group_size: The number of the results written at once.
+        :type row_group_size: int
+        """
+        self.file_path = file_path
+        self.row_group_size = row_group_size
+        self._rows: list[dict] = []
+        self._schema = None
+        self._writer = None
+        self._tmp_file_path = None
+
+    def write(self, result: dict) -> None:
+        self._rows.append(flatten_result(result))
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered results as a row group.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._rows:
+            return
+
+        if self._writer is None:
+            # The columns are the stages of the configuration; all values but
+            # the number of the rows are strings
+            columns = list(dict.fromkeys(column for row in self._rows for column in row))
+            self._schema = pa.schema(
+                [
+                    (column, pa.int64() if column == "duplicated_rows" else pa.string())
+                    for column in columns
+                ]
+            )
+            dir_path = os.path.dirname(self.file_path) or "."
+            os.makedirs(dir_path, exist_ok=True)
+            file_descriptor, self._tmp_file_path = tempfile.mkstemp(dir=dir_path)
+            os.close(file_descriptor)
+            self._writer = pq.ParquetWriter(self._tmp_file_path, self._schema)
+
+        table = pa.Table.from_pydict(
+            {
+                field.name: [row.get(field.name) for row in self._rows]
+                for field in self._schema
+            },
+            schema=self._schema,
+        )
+        self._writer.write_table(table)
+        self._rows.clear()
+
+    def close(self) -> None:
+        self.flush()
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        self._writer = None
+        os.chmod(self._tmp_file_path, 0o644)
+        os.replace(self._tmp_file_path, self.file_path)
+
+
+def create_result_sink(kind: str, dir_path: str) -> ResultSink:
+    """
+    Create a sink for the results.
+
+    :param kind: The kind of the sink: json (a file per sample), jsonl or parquet.
+    :type kind: str
+    :param dir_path: The path to the directory of the results.
+    :type dir_path: str
+    :return: The sink.
+    :rtype: ResultSink
+    """
+    if kind == "json":
+        return JsonFileResultSink(dir_path)
+    if kind == "jsonl":
+        return JsonlResultSink(os.path.join(dir_path, "qc_tool_results.jsonl"))
+    if kind == "parquet":
+        return ParquetResultSink(os.path.join(dir_path, "qc_tool_results.parquet"))
+
+    raise ValueError(f"Unknown result sink: {kind}.")
@@ -0,0 +1,194 @@
+"""
+Module for the summary of the QC results per sequencing run: the pass rates
+of the checks, the distributions of the metrics and the samples that are
+outliers within their run.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from batch_stages import coerce_column_to_float
+from values import INSERT_SIZE_FRACTION_ESTIMATION_STAGE_UID
+
+# The name of the file of the summary in the results directory
+RUN_SUMMARY_FILE_NAME = "qc_tool_run_summary.json"
+# The quantiles of the metrics reported per run
+SUMMARY_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# The scale of the median absolute deviation to the standard deviation of a normal distribution
+MAD_SCALE = 0.6745
+# The minimal number of the samples of a run with a metric for the outliers to be flagged
+MIN_OUTLIER_SAMPLES = 5
+
+
+def get_sheet_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the QC metrics of the samples from the Google Sheet data:
+    the first row of every sample, as the stages use it.
+
+    :param df: The data from the Google Sheet.
+    :type df: pd.DataFrame
+    :return: The run and the metrics indexed by the sample id.
+    :rtype: pd.DataFrame
+    """
+    df = df.drop_duplicates("Sample sheet_Sample_ID", keep="first")
+
+    def get_column(column_name: str) -> np.ndarray:
+        # The columns of the stages that are not configured are not in the snapshot
+        if column_name not in df.columns:
+            return np.full(len(df), np.nan)
+        return coerce_column_to_float(df[column_name])[0]
+
+    average_coverage_v2 = get_column("average_coverage_v2")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coverage_ratio = get_column("average_coverage_v1") / average_coverage_v2
+    coverage_ratio[average_coverage_v2 == 0] = np.nan
+
+    return pd.DataFrame(
+        {
+            "run": df["Run"].to_numpy() if "Run" in df.columns else "",
+            "coverage_ratio": coverage_ratio,
+            "deduplicated_percentage": get_column("Total Deduplicated Percentage"),
+            "off_target": get_column("Off-target, %"),
+            "number_of_reads_mln": get_column("Number_of_Reads_mln"),
+        },
+        index=pd.Index(df["Sample sheet_Sample_ID"].to_numpy(), name="sample_id"),
+    )
+
+
+def get_stage_outcomes(result: dict, check_stages: list[dict]) -> dict:
+    """
+    Get the outcomes of the stages of a sample kept for the summary: whether
+    each check passed, whether each stage has an error and the insert size fraction.
+
+    :param result: The result of the QC stages.
+    :type result: dict
+    :param check_stages: The check stages of the configuration.
+    :type check_stages: list[dict]
+    :return: The outcomes by the column name.
+    :rtype: dict
+    """
+    passed_statuses = {stage["uid"]: stage["passed_status"] for stage in check_stages}
+    outcomes = {}
+    for stage_result in result["stages"]["checks"] + result["stages"]["estimations"]:
+        uid = stage_result.get("uid")
+        outcomes[f"error:{stage_result['name']}"] = stage_result["status"] == "error"
+        if uid in passed_statuses:
+            outcomes[f"passed:{stage_result['name']}"] = (
+                stage_result["status"] == passed_statuses[uid]
+            )
+        if uid == INSERT_SIZE_FRACTION_ESTIMATION_STAGE_UID and "data" in stage_result:
+            outcomes["insert_size_fraction"] = stage_result["data"]["fraction"]
+
+    return outcomes
+
+
+def compute_run_summary(
+    metrics: pd.DataFrame,
+    stage_outcomes: dict[str, dict],
+    outlier_threshold: float = 3.5,
+) -> dict:
+    """
+    Compute the summary of every run with one groupby over the metrics of the samples
+    and the outcomes of their stages. A sample is an outlier within its run if
+    the robust z-score (based on the median and the median absolute deviation
+    of the run) of one of its metrics exceeds the threshold in absolute value.
+
+    :param metrics: The run and the metrics of the samples, from get_sheet_metrics.
+    :type metrics: pd.DataFrame
+    :param stage_outcomes: The outcomes of the stages by the sample id, from get_stage_outcomes.
+    :type stage_outcomes: dict[str, dict]
+    :param outlier_threshold: The threshold of the absolute robust z-score of the outliers.
+    :type outlier_threshold: float
+    :return: The summary by the run name.
+    :rtype: dict
+    """
+    if not stage_outcomes:
+        return {}
+
+    outcomes = pd.DataFrame.from_dict(stage_outcomes, orient="index")
+    frame = metrics.join(outcomes, how="inner")
+    frame["run"] = frame["run"].fillna("")
+
+    metric_columns = [
+        column
+        for column in (*metrics.columns.drop("run"), "insert_size_fraction")
+        if column in frame.columns
+    ]
+    flag_columns = [column for column in frame.columns if column.startswith(("passed:", "error:"))]
+    frame[metric_columns] = frame[metric_columns].astype(float)
+    frame[flag_columns] = frame[flag_columns].astype(float)
+
+    grouped = frame.groupby("run", sort=True)
+    samples = grouped.size()
+    flag_means = grouped[flag_columns].mean()
+    quantiles = grouped[metric_columns].quantile(list(SUMMARY_QUANTILES))
+    counts = grouped[metric_columns].count()
+
+    # The robust z-scores against the median and the median absolute deviation of the run;
+    # the group codes of the rows take the aggregates of their run
+    group_codes = grouped.ngroup().to_numpy()
+    values = frame[metric_columns].to_numpy()
+    run_medians = quantiles.xs(0.5, level=1).to_numpy()[group_codes]
+    deviations = pd.DataFrame(np.abs(values - run_medians), columns=metric_columns)
+    mads = deviations.groupby(group_codes).median().to_numpy()[group_codes]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_scores = MAD_SCALE * (values - run_medians) / mads
+    is_outlier = (
+        (np.abs(z_scores) > outlier_threshold)
+        & (mads > 0)
+        & (counts.to_numpy()[group_codes] >= MIN_OUTLIER_SAMPLES)
+    )
+
+    summary = {}
+    for run_name in samples.index:
+        summary[str(run_name)] = {
+            "samples": int(samples[run_name]),
+            "pass_rates": {},
+            "error_rates": {},
+            "metrics": {},
+            "outliers": [],
+        }
+    for column in flag_columns:
+        kind, stage_name = column.split(":", 1)
+        rate_key = "pass_rates" if kind == "passed" else "error_rates"
+        for run_name, rate in flag_means[column].items():
+            if not np.isnan(rate):
+                summary[str(run_name)][rate_key][stage_name] = round(float(rate), 4)
+    for (run_name, quantile), row in quantiles.iterrows():
+        for column in metric_columns:
+            if not np.isnan(row[column]):
+                summary[str(run_name)]["metrics"].setdefault(column, {})[
+                    f"p{round(quantile * 100)}"
+                ] = round(float(row[column]), 4)
+    for position, metric_position in zip(*np.nonzero(is_outlier)):
+        summary[str(frame["run"].iat[position])]["outliers"].append(
+            {
+                "sample_id": frame.index[position],
+                "metric": metric_columns[metric_position],
+                "value": round(float(values[position, metric_position]), 4),
+                "robust_z_score": round(float(z_scores[position, metric_position]), 2),
+            }
+        )
+
+    return summary
+
+
+def save_run_summary(summary: dict, file_path: str) -> None:
+    """
+    Save the summary of the runs with an atomic rename.
+
+    :param summary: The summary by the run name.
+    :type summary: dict
+    :param file_path: The path to the file.
+    :type file_path: str
+    """
+    dir_path = os.path.dirname(file_path) or "."
+    os.makedirs(dir_path, exist_ok=True)
+    file_descriptor, tmp_file_path = tempfile.mkstemp(dir=dir_path)
+    with os.fdopen(file_descriptor, "w") as summary_file:
+        json.dump(summary, summary_file, indent=4)
+    os.replace(tmp_file_path, file_path)
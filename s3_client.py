@@ -0,0 +1,441 @@
+"""
+Module for the S3 client shared by the stages.
+"""
+
+import io
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import BinaryIO, Iterator
+
+from io_policy import IOPolicy
+from stage_metrics import record_download
+
+# The number of the bytes of the body of an object read within the request
+# opening it through the I/O policy, so the deadline and the hedging cover
+# the time to the first byte
+FIRST_READ_SIZE = 64 * 1024
+# The number of the bytes read from the body of an object opened through
+# the I/O policy at once
+READ_CHUNK_SIZE = 1024 * 1024
+
+# The client created by get_s3_client()
+_s3_client = None
+_s3_client_lock = threading.Lock()
+# The ETags and the sizes of the objects by the bucket and the key,
+# shared by the requests of the sample being processed in the current thread
+_object_heads: ContextVar[dict[tuple[str, str], dict] | None] = ContextVar(
+    "object_heads", default=None
+)
+
+
+class S3ArtifactError(Exception):
+    """
+    Error raised when an object cannot be read from S3; the error of botocore is its cause.
+    """
+
+
+class S3ArtifactClient:
+    """
+    Class for downloading the files of the samples from S3.
+
+    The client is thread-safe and keeps a pool of HTTP connections,
+    so a single client is meant to be created per process and shared.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str | None = None,
+        max_pool_connections: int = 16,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        max_attempts: int = 3,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunksize: int = 8 * 1024 * 1024,
+        transfer_max_concurrency: int = 4,
+    ):
+        """
+        :param endpoint_url: The URL of the S3 endpoint, e.g. of a MinIO server;
+            the AWS endpoint is used if it is not provided.
+        :type endpoint_url: str | None
+        :param max_pool_connections: The size of the HTTP connection pool.
+        :type max_pool_connections: int
+        :param connect_timeout: The timeout for opening a connection, in seconds.
+        :type connect_timeout: float
+        :param read_timeout: The timeout for reading from a connection, in seconds.
+        :type read_timeout: float
+        :param max_attempts: The number of attempts of a request.
+        :type max_attempts: int
+        :param multipart_threshold: The size of an object from which it is
+            downloaded in parts, in bytes.
+        :type multipart_threshold: int
+        :param multipart_chunksize: The size of a part, in bytes.
+        :type multipart_chunksize: int
+        :param transfer_max_concurrency: The number of the parts of an object
+            downloaded at the same time.
+        :type transfer_max_concurrency: int
+        """
+        # boto3 is imported when the first client is created, not on the import of the module
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        # The default session is not thread-safe, so the client has its own session
+        session = boto3.session.Session()
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(
+                max_pool_connections=max_pool_connections,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries={"max_attempts": max_attempts, "mode": "standard"},
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=transfer_max_concurrency,
+        )
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        """
+        Get the ETag and the size of an object without downloading it.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The ETag and the size of the object.
+        :rtype: dict
+        """
+        try:
+            response = self.client.head_object(Bucket=bucket_name, Key=object_key)
+        except Exception as e:
+            raise S3ArtifactError("An error occurred while downloading the file from S3.") from e
+
+        return {
+            "etag": response["ETag"].strip('"'),
+            "size": response["ContentLength"],
+        }
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        """
+        Open the stream of an object in an S3 bucket; nothing is written to the disk.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The stream of the object.
+        :rtype: BinaryIO
+        """
+        try:
+            response = self.client.get_object(Bucket=bucket_name, Key=object_key)
+        except Exception as e:
+            raise S3ArtifactError("An error occurred while downloading the file from S3.") from e
+
+        record_download(response["ContentLength"])
+
+        return response["Body"]
+
+    def download(
+        self,
+        bucket_name: str,
+        object_key: str,
+        local_file_path: str,
+    ) -> None:
+        """
+        Download a file from an S3 bucket.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        """
+        try:
+            self.client.download_file(
+                bucket_name,
+                object_key,
+                local_file_path,
+                Config=self.transfer_config,
+            )
+        except Exception as e:
+            raise S3ArtifactError("An error occurred while downloading the file from S3.") from e
+
+        record_download(os.path.getsize(local_file_path))
+
+
+class _DeadlineStream(io.RawIOBase):
+    """
+    Class for reading the body of an object opened through the I/O policy:
+    every read of the underlying stream has its own deadline, so a stalled
+    transfer fails instead of hanging, and nothing is kept beyond the chunk
+    being read.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        first_chunk: bytes,
+        io_policy: IOPolicy,
+        endpoint: str,
+        read_deadline: float,
+    ):
+        """
+        :param stream: The stream of the body.
+        :type stream: BinaryIO
+        :param first_chunk: The bytes already read from the stream.
+        :type first_chunk: bytes
+        :param io_policy: The I/O policy.
+        :type io_policy: IOPolicy
+        :param endpoint: The name of the endpoint of the I/O policy.
+        :type endpoint: str
+        :param read_deadline: The time for a read of the stream, in seconds.
+        :type read_deadline: float
+        """
+        super().__init__()
+        self.stream = stream
+        self.io_policy = io_policy
+        self.endpoint = endpoint
+        self.read_deadline = read_deadline
+
+        self._first_chunk = memoryview(first_chunk)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._first_chunk:
+            size = min(len(buffer), len(self._first_chunk))
+            buffer[:size] = self._first_chunk[:size]
+            self._first_chunk = self._first_chunk[size:]
+            return size
+
+        # The stream is closed when a read abandoned at its deadline completes
+        chunk = self.io_policy.call_once(
+            self.endpoint,
+            lambda: self.stream.read(len(buffer)),
+            self.read_deadline,
+            discard=lambda _: self.stream.close(),
+        )
+        buffer[: len(chunk)] = chunk
+
+        return len(chunk)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stream.close()
+        super().close()
+
+
+class PolicyS3Client:
+    """
+    Class for reading the files from S3 through another client with the I/O policy:
+    every request has a deadline, the failed requests are retried with a backoff,
+    the bucket has a circuit breaker, and the slow requests are hedged.
+    The bodies of the opened objects are streamed: the policy covers the requests
+    up to the first bytes of the bodies, and every later read has read_deadline.
+    Has the same interface as S3ArtifactClient, so it wraps S3ArtifactClient
+    or its stand-ins.
+    """
+
+    def __init__(
+        self,
+        s3_client: S3ArtifactClient,
+        io_policy: IOPolicy,
+        read_deadline: float = 60,
+    ):
+        """
+        :param s3_client: The client the files are read with.
+        :type s3_client: S3ArtifactClient
+        :param io_policy: The I/O policy.
+        :type io_policy: IOPolicy
+        :param read_deadline: The time for a read of the body of an opened object, in seconds.
+        :type read_deadline: float
+        """
+        self.s3_client = s3_client
+        self.io_policy = io_policy
+        self.read_deadline = read_deadline
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        """
+        Get the ETag and the size of an object without downloading it.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The ETag and the size of the object.
+        :rtype: dict
+        """
+        return self.io_policy.call(
+            f"s3:{bucket_name}",
+            lambda: self.s3_client.head(bucket_name, object_key),
+            hedge=True,
+        )
+
+    def open(self, bucket_name: str, object_key: str) -> BinaryIO:
+        """
+        Open the stream of an object in an S3 bucket; nothing is written to the disk.
+        The request and the first read of the body are retried and hedged,
+        so a slow first byte starts a duplicate request; the rest of the body is
+        read from the stream of the winning request.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :return: The stream of the object.
+        :rtype: BinaryIO
+        """
+        endpoint = f"s3:{bucket_name}"
+
+        def open_attempt() -> tuple[BinaryIO, bytes]:
+            stream = self.s3_client.open(bucket_name, object_key)
+            try:
+                return stream, stream.read(FIRST_READ_SIZE)
+            except BaseException:
+                stream.close()
+                raise
+
+        stream, first_chunk = self.io_policy.call(
+            endpoint,
+            open_attempt,
+            hedge=True,
+            discard=lambda opened: opened[0].close(),
+        )
+
+        return io.BufferedReader(
+            _DeadlineStream(stream, first_chunk, self.io_policy, endpoint, self.read_deadline),
+            READ_CHUNK_SIZE,
+        )
+
+    def download(
+        self,
+        bucket_name: str,
+        object_key: str,
+        local_file_path: str,
+    ) -> None:
+        """
+        Download a file from an S3 bucket.
+
+        :param bucket_name: The name of the bucket.
+        :type bucket_name: str
+        :param object_key: The key of the object.
+        :type object_key: str
+        :param local_file_path: The path to the local file.
+        :type local_file_path: str
+        """
+        dir_path = os.path.dirname(local_file_path) or "."
+
+        # Every attempt downloads to its own file, so the hedged attempts do not collide
+        def download_attempt() -> str:
+            file_descriptor, tmp_file_path = tempfile.mkstemp(dir=dir_path, prefix=".download_")
+            os.close(file_descriptor)
+            try:
+                self.s3_client.download(bucket_name, object_key, tmp_file_path)
+            except BaseException:
+                os.remove(tmp_file_path)
+                raise
+            return tmp_file_path
+
+        tmp_file_path = self.io_policy.call(
+            f"s3:{bucket_name}",
+            download_attempt,
+            hedge=True,
+            discard=_remove_file,
+        )
+        os.replace(tmp_file_path, local_file_path)
+
+
+def _remove_file(file_path: str) -> None:
+    """
+    Remove a file if it exists.
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    """
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def share_object_heads(
+    object_heads: dict[tuple[str, str], dict] | None = None,
+) -> Iterator[dict[tuple[str, str], dict]]:
+    """
+    Share the ETags and the sizes of the objects got by get_object_head
+    in the current thread inside the block, so an object is requested once,
+    e.g. by the memo store and then by the stages of a sample. The nested
+    blocks share the heads of the outer block.
+
+    :param object_heads: The heads got earlier, e.g. in another thread, to share.
+    :type object_heads: dict[tuple[str, str], dict] | None
+    :return: The heads by the bucket and the key, filled in inside the block.
+    :rtype: Iterator[dict[tuple[str, str], dict]]
+    """
+    shared_object_heads = _object_heads.get()
+    if shared_object_heads is not None:
+        shared_object_heads.update(object_heads or {})
+        yield shared_object_heads
+        return
+
+    token = _object_heads.set(dict(object_heads or {}))
+    try:
+        yield _object_heads.get()
+    finally:
+        _object_heads.reset(token)
+
+
+def get_object_head(
+    s3_client: "S3ArtifactClient | PolicyS3Client",
+    bucket_name: str,
+    object_key: str,
+) -> dict:
+    """
+    Get the ETag and the size of an object: the shared ones inside
+    share_object_heads, otherwise with a HEAD request.
+
+    :param s3_client: The client for the HEAD request.
+    :type s3_client: S3ArtifactClient | PolicyS3Client
+    :param bucket_name: The name of the bucket.
+    :type bucket_name: str
+    :param object_key: The key of the object.
+    :type object_key: str
+    :return: The ETag and the size of the object.
+    :rtype: dict
+    """
+    object_heads = _object_heads.get()
+    if object_heads is not None and (bucket_name, object_key) in object_heads:
+        return object_heads[(bucket_name, object_key)]
+
+    head = s3_client.head(bucket_name, object_key)
+    if object_heads is not None:
+        object_heads[(bucket_name, object_key)] = head
+
+    return head
+
+
+def get_s3_client() -> PolicyS3Client:
+    """
+    Get the S3 client of the process; it is created with the default settings
+    and the default I/O policy on the first call.
+
+    :return: The S3 client.
+    :rtype: PolicyS3Client
+    """
+    global _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            # The requests are retried by the policy, not by botocore
+            _s3_client = PolicyS3Client(S3ArtifactClient(max_attempts=1), IOPolicy())
+
+    return _s3_client
@@ -2,28 +2,27 @@
 Module for storing classes used for service configufractionn.
 """
 
+import hashlib
+import inspect
 import json
+import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, ClassVar
-
-import numpy as np
-import pandas as pd
-from scipy.optimize import curve_fit
-
-from stages import (
-    average_coverage_completeness_v1_v2_check,
-    average_coverage_v1_v2_ratio_check,
-    insert_size_fraction_estimation,
-    number_of_reads_check,
-    off_target_check,
-    total_deduplicated_percentage_check,
-    vaf_lod_estimation,
-)
+from typing import TYPE_CHECKING, Callable, ClassVar
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
 
 with (Path(__file__).resolve().parent / "qc_tool_config.json").open("r") as conf_obj:
     config = json.load(conf_obj)
 
+# The directory with the data for the regression models
+REGRESSION_MODELS_DATA_PATH = Path(__file__).resolve().parent / "regression_models_data"
+# The directory with the fitted parameters of the regression models
+FITTED_REGRESSION_MODELS_PATH = REGRESSION_MODELS_DATA_PATH / "fitted"
+
 
 @dataclass
 class ServiceConfig:
@@ -38,6 +37,93 @@ class ServiceConfig:
     logger_file_name: str = None
     logger_file_path: str = None
     result_file_path: str = None
+    # Whether the log records are written as JSON lines and the fraction of
+    # the samples whose per-stage debug records are written
+    logger_json_format: bool = True
+    logger_stage_debug_sample_rate: float = 1.0
+
+    # The number of the files downloaded from S3 at the same time
+    s3_max_concurrency: int = 8
+    # The settings of the S3 client: the endpoint (e.g. of a MinIO server),
+    # the HTTP connection pool, the timeouts in seconds (the read timeout is also
+    # the deadline of a read of a body streamed with the I/O policy) and the transfers
+    s3_endpoint_url: str = None
+    s3_max_pool_connections: int = 16
+    s3_connect_timeout: float = 5
+    s3_read_timeout: float = 60
+    s3_multipart_threshold: int = 8 * 1024 * 1024
+    s3_transfer_max_concurrency: int = 4
+    # The I/O policy of the S3 and the Google Sheets requests: the deadline of
+    # a request with its retries in seconds, the number of the attempts, the bounds
+    # of the backoff delays in seconds, the number of the failures in a row that
+    # open the circuit of an endpoint and the time it stays open in seconds, and
+    # the latency percentile after which a duplicate S3 request is started
+    # (the requests are not hedged if it is None)
+    io_deadline: float = 120
+    io_max_attempts: int = 3
+    io_backoff_base: float = 0.2
+    io_backoff_max: float = 5
+    io_circuit_failure_threshold: int = 5
+    io_circuit_reset_timeout: float = 30
+    io_hedge_percentile: float = 95
+
+    # The directory and the maximal size in bytes of the local cache of
+    # the files downloaded from S3; the cache is disabled if the size is 0
+    artifact_cache_path: str = "artifact_cache"
+    artifact_cache_max_size: int = 10 * 1024 * 1024 * 1024
+    # The number of the next samples whose files are prefetched
+    prefetch_samples: int = 4
+    # The directory of the results stored by the hash of the inputs of the samples
+    result_memo_path: str = "result_memo"
+    # The directory of the local snapshot of the Google Sheet, the number of
+    # the last rows read again on a sync and the time between the syncs of
+    # all rows in seconds
+    sheet_snapshot_path: str = "sheet_snapshot"
+    sheet_snapshot_recheck_rows: int = 500
+    sheet_snapshot_full_sync_interval: float = 24 * 60 * 60
+    # The number of the rows read from the Google Sheet at once on a full sync
+    sheet_snapshot_chunk_rows: int = 50_000
+    # The SQLite file of the index of the per-gene coverage tables, the index
+    # is not used if it is None, and whether the tables of the panels that pass
+    # the average coverage completeness check are read from S3 and indexed too
+    gene_coverage_index_path: str | None = "gene_coverage_index/gene_coverage.sqlite"
+    gene_coverage_index_passed_panels: bool = False
+    # The JSON file of the baselines of the metrics kept between the runs, the trends
+    # are not followed if it is None, the width of the control limits in standard
+    # deviations, the weight of a new value in the moving average, the minimal
+    # number of the samples of a baseline for the results to be flagged and
+    # the number of the last runs whose sample ids are kept to add every sample once
+    trend_store_path: str | None = "trends/qc_tool_trends.json"
+    trend_control_limit_sigma: float = 3.0
+    trend_ewma_lambda: float = 0.2
+    trend_min_baseline_samples: int = 20
+    trend_tracked_runs: int = 20
+    # Whether the timings of the stages are added to the results and the file
+    # for the metrics of the run: in the Prometheus text format if it has
+    # the .prom extension, as JSON otherwise; the metrics are not saved if it is None
+    record_stage_timings: bool = True
+    metrics_file_path: str = "metrics/qc_tool.prom"
+    # The sink of the results: json (a file per sample), jsonl or parquet
+    result_sink: str = "json"
+    # Whether the summary of the runs is saved to the results directory and
+    # the absolute robust z-score from which a sample is an outlier within its run
+    run_summary: bool = True
+    run_summary_outlier_threshold: float = 3.5
+    # The settings of the daemon mode: the time between the polls of the Google
+    # Sheet in seconds, the maximal number of the samples waiting to be processed
+    # and the maximal number of the samples processed by the worker at once
+    daemon_poll_interval: float = 30
+    daemon_queue_size: int = 1000
+    daemon_batch_size: int = 16
+    # The settings of the HTTP service: the address, the number of the samples
+    # processed at the same time, the time after which the Google Sheet
+    # is read again in seconds and the minimal time between the reads
+    # for the requests for the samples that are not in the data
+    http_host: str = "127.0.0.1"
+    http_port: int = 8080
+    http_max_concurrency: int = 4
+    http_sheet_refresh_interval: float = 10
+    http_sheet_min_refresh_interval: float = 2
 
     def __post_init__(self):
         self.logger_name = self.service_name
@@ -70,7 +156,7 @@ class RegressionModelsConfig:
         """
         return a / (x + b) + c
 
-    def _get_regression_model(self, data: pd.DataFrame, lod_or_vaf: str) -> np.ndarray:
+    def _get_regression_model(self, data: "pd.DataFrame", lod_or_vaf: str) -> "np.ndarray":
         """
         Get the regression model for the estimation of the lod or vaf based on the coverage.
         The hyperbola function is used for the regression model.
@@ -82,6 +168,9 @@ class RegressionModelsConfig:
         :return: The regression model for the estimation of the lod or vaf.
         :rtype: np.ndarray
         """
+        # SciPy is imported only when a model has to be fitted
+        from scipy.optimize import curve_fit
+
         x = data["coverage"]
         y = data[lod_or_vaf]
 
@@ -90,7 +179,74 @@ class RegressionModelsConfig:
 
         return popt
 
-    def vaf_regression_model(self) -> np.ndarray:
+    def _get_model_hash(self, data_file_name: str, lod_or_vaf: str) -> str:
+        """
+        Get the hash of the data and the definition of a regression model.
+
+        :param data_file_name: The name of the file with the data for the regression model.
+        :type data_file_name: str
+        :param lod_or_vaf: The y-column name for the regression model.
+        :type lod_or_vaf: str
+        :return: The hash of the regression model.
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        digest.update((REGRESSION_MODELS_DATA_PATH / data_file_name).read_bytes())
+        digest.update(lod_or_vaf.encode())
+        digest.update(inspect.getsource(RegressionModelsConfig.hyperbola).encode())
+
+        return digest.hexdigest()
+
+    def _get_fitted_regression_model(
+        self,
+        data_file_name: str,
+        lod_or_vaf: str,
+    ) -> "np.ndarray":
+        """
+        Get the parameters of a regression model fitted earlier for the same data
+        and model definition; the model is fitted and saved if there are none.
+
+        :param data_file_name: The name of the file with the data for the regression model.
+        :type data_file_name: str
+        :param lod_or_vaf: The y-column name for the regression model.
+        :type lod_or_vaf: str
+        :return: The regression model for the estimation of the lod or vaf.
+        :rtype: np.ndarray
+        """
+        import numpy as np
+        import pandas as pd
+
+        model_hash = self._get_model_hash(data_file_name, lod_or_vaf)
+        fitted_model_path = FITTED_REGRESSION_MODELS_PATH / f"{model_hash}.json"
+
+        if fitted_model_path.exists():
+            with fitted_model_path.open("r") as fitted_model_file:
+                return np.array(json.load(fitted_model_file)["params"])
+
+        df = pd.read_csv(REGRESSION_MODELS_DATA_PATH / data_file_name)
+        popt = self._get_regression_model(df, lod_or_vaf)
+
+        # Save the parameters with an atomic rename, so the parallel processes
+        # never read a partially written file
+        FITTED_REGRESSION_MODELS_PATH.mkdir(parents=True, exist_ok=True)
+        file_descriptor, tmp_file_path = tempfile.mkstemp(
+            dir=FITTED_REGRESSION_MODELS_PATH,
+        )
+        with os.fdopen(file_descriptor, "w") as fitted_model_file:
+            json.dump(
+                {
+                    "data_file_name": data_file_name,
+                    "lod_or_vaf": lod_or_vaf,
+                    "params": popt.tolist(),
+                },
+                fitted_model_file,
+                indent=4,
+            )
+        os.replace(tmp_file_path, fitted_model_path)
+
+        return popt
+
+    def vaf_regression_model(self) -> "np.ndarray":
         """
         Get the regression model for the estimation of the vaf based on the coverage.
         The hyperbola function is used for the regression model.
@@ -98,12 +254,9 @@ class RegressionModelsConfig:
         :return: The regression model for the estimation of the vaf.
         :rtype: np.ndarray
         """
-        df = pd.read_csv(
-            f"{Path(__file__).parent.resolve()}/regression_models_data/vaf_data_for_regression.csv",
-        )
-        return self._get_regression_model(df, "vaf")
+        return self._get_fitted_regression_model("vaf_data_for_regression.csv", "vaf")
 
-    def lod_tumor_regression_model(self) -> np.ndarray:
+    def lod_tumor_regression_model(self) -> "np.ndarray":
         """
         Get the regression model for the estimation of the lod based on the coverage.
         The hyperbola function is used for the regression model.
@@ -111,10 +264,7 @@ class RegressionModelsConfig:
         :return: The regression model for the estimation of the lod.
         :rtype: np.ndarray
         """
-        df = pd.read_csv(
-            f"{Path(__file__).parent.resolve()}/regression_models_data/lod_data_for_regression.csv",
-        )
-        return self._get_regression_model(df, "lod")
+        return self._get_fitted_regression_model("lod_data_for_regression.csv", "lod")
 
 
 class QCToolConfig:
@@ -122,33 +272,144 @@ class QCToolConfig:
     Class for storing the configufractionn for the qc_tool.
     """
 
-    # Dictionary for storing the stages functions
-
-    uid_stage_name_dict: ClassVar[dict[str, Callable]] = {
-        "f104e31c-b3f5-4a4c-8f3f-4cb164f8e2ea": average_coverage_v1_v2_ratio_check,
-        "36ebebff-9f66-4278-8acd-1021081b0e73": average_coverage_completeness_v1_v2_check,
-        "03d48698-caf1-4f03-9960-8bc643edfdc6": total_deduplicated_percentage_check,
-        "cf5a1b22-1cc7-458d-b8df-0820be40fb96": off_target_check,
-        "fdc7f9b6-9c4a-4301-a5fb-c0196e5ef969": number_of_reads_check,
-        "e9a5fe97-d7b9-4bb9-917d-1d5b6396236c": vaf_lod_estimation,
-        "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500": insert_size_fraction_estimation,
+    # Dictionaries for storing the functions of the stages by the stage uid,
+    # created on the first use, as the stages import NumPy and pandas
+    _stage_functions: ClassVar[dict[str, dict[str, Callable]] | None] = None
+
+    # Dictionary for storing the columns of the Google Sheet used by the stages
+
+    uid_stage_columns_dict: ClassVar[dict[str, list[str]]] = {
+        "f104e31c-b3f5-4a4c-8f3f-4cb164f8e2ea": ["average_coverage_v1", "average_coverage_v2"],
+        "36ebebff-9f66-4278-8acd-1021081b0e73": [
+            "average_coverage_completeness_v1",
+            "average_coverage_completeness_v2",
+            "Run",
+            "Tumor/Normal",
+        ],
+        "03d48698-caf1-4f03-9960-8bc643edfdc6": ["Total Deduplicated Percentage"],
+        "cf5a1b22-1cc7-458d-b8df-0820be40fb96": ["Off-target, %"],
+        "fdc7f9b6-9c4a-4301-a5fb-c0196e5ef969": ["Number_of_Reads_mln"],
+        "e9a5fe97-d7b9-4bb9-917d-1d5b6396236c": ["average_coverage_v1", "average_coverage_v2"],
+        "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500": ["Run", "Tumor/Normal"],
     }
 
     # Regression models configufractionn
     regression_models_config = RegressionModelsConfig()
 
-    # Dictionary for storing the regression function and models
-    regression_models: ClassVar[dict] = {
-        "function": regression_models_config.hyperbola,
-        "models": {
-            "vaf": regression_models_config.vaf_regression_model(),
-            "lod": regression_models_config.lod_tumor_regression_model(),
-        },
-    }
+    # Dictionary for storing the regression function and models,
+    # loaded on the first use
+    _regression_models: ClassVar[dict | None] = None
 
     def __init__(self):
         self.config = config
 
+    @classmethod
+    def _get_stage_functions(cls) -> dict[str, dict[str, Callable]]:
+        """
+        Get the dictionaries of the functions of the stages, importing the stages on the first call.
+
+        :return: The dictionaries by their name.
+        :rtype: dict[str, dict[str, Callable]]
+        """
+        if cls._stage_functions is None:
+            from batch_stages import (
+                average_coverage_v1_v2_ratio_batch_check,
+                number_of_reads_batch_check,
+                off_target_batch_check,
+                total_deduplicated_percentage_batch_check,
+                vaf_lod_batch_estimation,
+            )
+            from stages import (
+                average_coverage_completeness_v1_v2_check,
+                average_coverage_v1_v2_ratio_check,
+                get_coverage_stats_object_keys,
+                get_picard_output_object_keys,
+                insert_size_fraction_estimation,
+                number_of_reads_check,
+                off_target_check,
+                total_deduplicated_percentage_check,
+                vaf_lod_estimation,
+            )
+
+            cls._stage_functions = {
+                # The functions of the stages
+                "stages": {
+                    "f104e31c-b3f5-4a4c-8f3f-4cb164f8e2ea": average_coverage_v1_v2_ratio_check,
+                    "36ebebff-9f66-4278-8acd-1021081b0e73": average_coverage_completeness_v1_v2_check,
+                    "03d48698-caf1-4f03-9960-8bc643edfdc6": total_deduplicated_percentage_check,
+                    "cf5a1b22-1cc7-458d-b8df-0820be40fb96": off_target_check,
+                    "fdc7f9b6-9c4a-4301-a5fb-c0196e5ef969": number_of_reads_check,
+                    "e9a5fe97-d7b9-4bb9-917d-1d5b6396236c": vaf_lod_estimation,
+                    "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500": insert_size_fraction_estimation,
+                },
+                # The vectorized functions of the check and estimation stages
+                # that rely only on the Google Sheet data
+                "batch_stages": {
+                    "f104e31c-b3f5-4a4c-8f3f-4cb164f8e2ea": average_coverage_v1_v2_ratio_batch_check,
+                    "03d48698-caf1-4f03-9960-8bc643edfdc6": total_deduplicated_percentage_batch_check,
+                    "cf5a1b22-1cc7-458d-b8df-0820be40fb96": off_target_batch_check,
+                    "fdc7f9b6-9c4a-4301-a5fb-c0196e5ef969": number_of_reads_batch_check,
+                    "e9a5fe97-d7b9-4bb9-917d-1d5b6396236c": vaf_lod_batch_estimation,
+                },
+                # The functions that get the keys of the files on the S3 bucket needed by the stages
+                "artifacts": {
+                    "36ebebff-9f66-4278-8acd-1021081b0e73": get_coverage_stats_object_keys,
+                    "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500": get_picard_output_object_keys,
+                },
+            }
+
+        return cls._stage_functions
+
+    @property
+    def uid_stage_name_dict(self) -> dict[str, Callable]:
+        """
+        Get the functions of the stages by the stage uid.
+
+        :return: The functions of the stages.
+        :rtype: dict[str, Callable]
+        """
+        return self._get_stage_functions()["stages"]
+
+    @property
+    def uid_batch_stage_dict(self) -> dict[str, Callable]:
+        """
+        Get the vectorized functions of the stages that rely only on the Google Sheet data
+        by the stage uid.
+
+        :return: The vectorized functions of the stages.
+        :rtype: dict[str, Callable]
+        """
+        return self._get_stage_functions()["batch_stages"]
+
+    @property
+    def uid_stage_artifacts_dict(self) -> dict[str, Callable]:
+        """
+        Get the functions that get the keys of the files on the S3 bucket needed
+        by the stages by the stage uid.
+
+        :return: The functions of the files of the stages.
+        :rtype: dict[str, Callable]
+        """
+        return self._get_stage_functions()["artifacts"]
+
+    @property
+    def regression_models(self) -> dict:
+        """
+        Get the regression function and the fitted regression models.
+
+        :return: The regression function and models.
+        :rtype: dict
+        """
+        if QCToolConfig._regression_models is None:
+            QCToolConfig._regression_models = {
+                "function": self.regression_models_config.hyperbola,
+                "models": {
+                    "vaf": self.regression_models_config.vaf_regression_model(),
+                    "lod": self.regression_models_config.lod_tumor_regression_model(),
+                },
+            }
+        return QCToolConfig._regression_models
+
     @property
     def config_version(self) -> str:
         """
@@ -159,6 +420,23 @@ class QCToolConfig:
         """
         return self.config["meta"]["config_version"]
 
+    @property
+    def sheet_columns(self) -> list[str]:
+        """
+        Get the columns of the Google Sheet used by the configured stages,
+        the sample id column first.
+
+        :return: The names of the columns.
+        :rtype: list[str]
+        """
+        columns = ["Sample sheet_Sample_ID"]
+        for stage in self.check_stages + self.estimation_stages:
+            for column in self.uid_stage_columns_dict.get(stage["uid"], []):
+                if column not in columns:
+                    columns.append(column)
+
+        return columns
+
     @property
     def check_stages(self) -> list:
         """
@@ -0,0 +1,370 @@
+"""
+Module for the local columnar snapshot of the Google Sheet data.
+"""
+
+import json
+import os
+import tempfile
+import time
+from typing import TYPE_CHECKING, Callable, Iterator
+
+import pandas as pd
+
+from spreadsheet.spreadsheet_client import call_sheets_api, get_sheet_columns_data
+
+if TYPE_CHECKING:
+    import gspread
+    import pyarrow as pa
+
+    from io_policy import IOPolicy
+
+# The key of the snapshot information in the metadata of the Feather file
+SNAPSHOT_METADATA_KEY = b"sheet_snapshot"
+
+
+class SheetSnapshot:
+    """
+    Class for keeping the columns of the Google Sheet needed by the stages
+    in a local Feather file, so a run reads only what has changed.
+
+    The sheet is not read at all if it has not been modified since the last sync.
+    Otherwise the last recheck_rows rows of the snapshot and the appended rows
+    are read again: the new rows are usually edited for some time after they
+    are added. All rows are read again if the columns are changed, the sheet
+    gets shorter or the last full sync is older than full_sync_interval seconds,
+    so the edits of the older rows are picked up by the next full sync.
+    The number of the rows not read again since the sheet was modified is kept
+    in the snapshot, and a sync for fresh data reads all rows if there are any,
+    e.g. for the stored results that are trusted only for the current rows.
+    A full sync reads the sheet in blocks of chunk_rows rows and writes them
+    to the file one by one, so the whole sheet is never held in memory.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        recheck_rows: int = 500,
+        full_sync_interval: float = 24 * 60 * 60,
+        io_policy: "IOPolicy | None" = None,
+        chunk_rows: int = 50_000,
+    ):
+        """
+        :param file_path: The path to the Feather file of the snapshot.
+        :type file_path: str
+        :param recheck_rows: The number of the last rows of the snapshot read again on a sync.
+        :type recheck_rows: int
+        :param full_sync_interval: The time between the syncs of all rows, in seconds.
+        :type full_sync_interval: float
+        :param io_policy: The I/O policy of the requests to the Google Sheets API.
+        :type io_policy: IOPolicy | None
+        :param chunk_rows: The number of the rows read from the sheet at once on a full sync.
+        :type chunk_rows: int
+        """
+        self.file_path = file_path
+        self.recheck_rows = recheck_rows
+        self.full_sync_interval = full_sync_interval
+        self.io_policy = io_policy
+        self.chunk_rows = chunk_rows
+
+    def load_table(self) -> "tuple[pa.Table, dict] | None":
+        """
+        Load the snapshot as an Arrow table; the file is memory-mapped, not read into a buffer.
+
+        :return: The table and the information of the snapshot, or None if there is none.
+        :rtype: tuple[pa.Table, dict] | None
+        """
+        from pyarrow import feather
+
+        try:
+            table = feather.read_table(self.file_path, memory_map=True)
+            info = json.loads(table.schema.metadata[SNAPSHOT_METADATA_KEY])
+        except (FileNotFoundError, KeyError, TypeError, ValueError):
+            return None
+
+        return table, info
+
+    def load(self) -> tuple[pd.DataFrame, dict] | None:
+        """
+        Load the snapshot as a pandas DataFrame.
+
+        :return: The data and the information of the snapshot, or None if there is none.
+        :rtype: tuple[pd.DataFrame, dict] | None
+        """
+        snapshot = self.load_table()
+        if snapshot is None:
+            return None
+
+        table, info = snapshot
+        return table.to_pandas(), info
+
+    def _write(self, write: Callable[[str], None]) -> None:
+        """
+        Write the snapshot to a temporary file and replace the file with an atomic rename.
+
+        :param write: The function writing the snapshot to the path of the temporary file.
+        :type write: Callable[[str], None]
+        """
+        dir_path = os.path.dirname(self.file_path) or "."
+        os.makedirs(dir_path, exist_ok=True)
+        file_descriptor, tmp_file_path = tempfile.mkstemp(dir=dir_path)
+        os.close(file_descriptor)
+        try:
+            write(tmp_file_path)
+            # The memory-mapped old file stays readable until it is unmapped
+            os.replace(tmp_file_path, self.file_path)
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
+    def save_table(self, table: "pa.Table", info: dict) -> None:
+        """
+        Save the snapshot from an Arrow table with an atomic rename.
+
+        :param table: The data of the snapshot.
+        :type table: pa.Table
+        :param info: The information of the snapshot.
+        :type info: dict
+        """
+        from pyarrow import feather
+
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), SNAPSHOT_METADATA_KEY: json.dumps(info)}
+        )
+        # The uncompressed file can be memory-mapped
+        self._write(
+            lambda tmp_file_path: feather.write_feather(
+                table, tmp_file_path, compression="uncompressed"
+            )
+        )
+
+    def save(self, df: pd.DataFrame, info: dict) -> None:
+        """
+        Save the snapshot with an atomic rename.
+
+        :param df: The data of the snapshot.
+        :type df: pd.DataFrame
+        :param info: The information of the snapshot.
+        :type info: dict
+        """
+        import pyarrow as pa
+
+        self.save_table(pa.Table.from_pandas(df, preserve_index=False), info)
+
+    def _full_sync(
+        self,
+        sheet: "gspread.worksheet.Worksheet",
+        columns: list[str],
+        info: dict,
+    ) -> None:
+        """
+        Read all rows of the columns in blocks of chunk_rows rows and write
+        every block to the snapshot as it is read.
+
+        :param sheet: The Google Sheet.
+        :type sheet: gspread.worksheet.Worksheet
+        :param columns: The names of the columns needed by the stages.
+        :type columns: list[str]
+        :param info: The information of the snapshot.
+        :type info: dict
+        """
+        import pyarrow as pa
+
+        schema = get_snapshot_schema(columns).with_metadata(
+            {SNAPSHOT_METADATA_KEY: json.dumps(info)}
+        )
+
+        def write(tmp_file_path: str) -> None:
+            # The empty rows are kept back until a non-empty row follows them,
+            # as the empty rows at the end of the sheet are not returned by a whole read
+            empty_rows = 0
+            start_position = 0
+            with pa.OSFile(tmp_file_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+                while True:
+                    end_position = start_position + self.chunk_rows
+                    rows = get_sheet_columns_data(
+                        sheet, columns, start_position, self.io_policy, end_position
+                    )[1:]
+                    # A block of empty rows may be followed by more values, so the blocks
+                    # are read to the end of the grid; the rows appended after the size
+                    # of the grid was fetched are read while the blocks are not empty
+                    if not rows and start_position >= sheet.row_count:
+                        break
+                    rows.extend([[""] * len(columns)] * (self.chunk_rows - len(rows)))
+                    last_position = max(
+                        (position for position, row in enumerate(rows) if any(row)),
+                        default=None,
+                    )
+                    start_position = end_position
+                    if last_position is None:
+                        empty_rows += len(rows)
+                        continue
+                    rows = [[""] * len(columns)] * empty_rows + rows[: last_position + 1]
+                    writer.write_table(rows_to_table(rows, schema))
+                    empty_rows = self.chunk_rows - last_position - 1
+
+        self._write(write)
+
+    def sync(
+        self,
+        sheet: "gspread.worksheet.Worksheet",
+        columns: list[str],
+        load: bool = True,
+        fresh: bool = False,
+    ) -> pd.DataFrame | None:
+        """
+        Update the snapshot from the Google Sheet and get its data.
+
+        :param sheet: The Google Sheet.
+        :type sheet: gspread.worksheet.Worksheet
+        :param columns: The names of the columns needed by the stages.
+        :type columns: list[str]
+        :param load: Whether the data are loaded into a DataFrame; the snapshot
+            is only updated otherwise, e.g. to be read in chunks with iter_sample_chunks.
+        :type load: bool
+        :param fresh: Whether all rows have to be as in the sheet; the rows that
+            have not been read again since the sheet was modified are read then.
+        :type fresh: bool
+        :return: The data from the Google Sheet, or None if they are not loaded.
+        :rtype: pd.DataFrame | None
+        """
+        import pyarrow as pa
+
+        last_update_time = call_sheets_api(
+            sheet.spreadsheet.get_lastUpdateTime, self.io_policy
+        )
+        snapshot = self.load_table()
+
+        is_full_sync = True
+        start_position = 0
+        if snapshot is not None:
+            table, info = snapshot
+            # The snapshots without the number are treated as not read again at all
+            stale_rows = info.get("stale_rows", table.num_rows)
+            if info["columns"] == columns and not (fresh and stale_rows):
+                if info["last_update_time"] == last_update_time:
+                    return table.to_pandas() if load else None
+                recheck_position = max(table.num_rows - self.recheck_rows, 0)
+                # The rows before the rechecked ones are not read, so they can be stale
+                if time.time() - info["full_synced_at"] < self.full_sync_interval and not (
+                    fresh and recheck_position
+                ):
+                    is_full_sync = False
+                    start_position = recheck_position
+
+        if not is_full_sync:
+            schema = get_snapshot_schema(columns)
+            rows = get_sheet_columns_data(sheet, columns, start_position, self.io_policy)[1:]
+            # Some rows were removed, so the positions of the stored rows are not valid
+            if start_position + len(rows) < table.num_rows:
+                is_full_sync = True
+            else:
+                table = pa.concat_tables(
+                    [
+                        table.slice(0, start_position).cast(schema),
+                        rows_to_table(rows, schema),
+                    ]
+                )
+                self.save_table(
+                    table,
+                    {
+                        "columns": columns,
+                        "last_update_time": last_update_time,
+                        "full_synced_at": info["full_synced_at"],
+                        "stale_rows": max(info.get("stale_rows", 0), start_position),
+                    },
+                )
+
+        if is_full_sync:
+            self._full_sync(
+                sheet,
+                columns,
+                {
+                    "columns": columns,
+                    "last_update_time": last_update_time,
+                    "full_synced_at": time.time(),
+                    "stale_rows": 0,
+                },
+            )
+
+        if not load:
+            return None
+
+        return self.load_table()[0].to_pandas()
+
+    def iter_sample_chunks(self, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        """
+        Read the snapshot in chunks of about chunk_rows rows. The rows of a sample
+        are in the chunk of its first row, in the order of the sheet, so every chunk
+        can be processed as a whole sheet of its samples and the samples come
+        in the order of their first appearance, as in the whole sheet.
+        Only the sample ids are read for all rows; the other columns are read
+        from the memory-mapped file chunk by chunk.
+
+        :param chunk_rows: The number of the rows of the sheet per chunk.
+        :type chunk_rows: int
+        :return: The chunks of the data from the Google Sheet.
+        :rtype: Iterator[pd.DataFrame]
+        """
+        import pyarrow as pa
+
+        snapshot = self.load_table()
+        if snapshot is None:
+            return
+        table, _ = snapshot
+
+        # The positions of the later rows of the duplicated samples
+        sample_ids = table.column("Sample sheet_Sample_ID").to_pylist()
+        first_positions: dict[str, int] = {}
+        later_positions: dict[str, list[int]] = {}
+        for position, sample_id in enumerate(sample_ids):
+            if sample_id in first_positions:
+                later_positions.setdefault(sample_id, []).append(position)
+            else:
+                first_positions[sample_id] = position
+
+        for start_position in range(0, len(sample_ids), chunk_rows):
+            positions = []
+            for position in range(start_position, min(start_position + chunk_rows, len(sample_ids))):
+                sample_id = sample_ids[position]
+                if first_positions[sample_id] == position:
+                    positions.append(position)
+                    positions.extend(later_positions.get(sample_id, []))
+            positions.sort()
+            yield table.take(pa.array(positions, type=pa.int64())).to_pandas()
+
+
+def get_snapshot_schema(columns: list[str]) -> "pa.Schema":
+    """
+    Get the schema of the snapshot: all values of the sheet are strings.
+
+    :param columns: The names of the columns.
+    :type columns: list[str]
+    :return: The schema.
+    :rtype: pa.Schema
+    """
+    import pyarrow as pa
+
+    return pa.schema([(column, pa.string()) for column in columns])
+
+
+def rows_to_table(rows: list[list[str]], schema: "pa.Schema") -> "pa.Table":
+    """
+    Convert the rows of the sheet to an Arrow table column by column,
+    without a DataFrame of string objects in between.
+
+    :param rows: The rows of the values.
+    :type rows: list[list[str]]
+    :param schema: The schema of the snapshot.
+    :type schema: pa.Schema
+    :return: The table.
+    :rtype: pa.Table
+    """
+    import pyarrow as pa
+
+    return pa.Table.from_arrays(
+        [
+            pa.array([row[position] for row in rows], type=field.type)
+            for position, field in enumerate(schema)
+        ],
+        schema=schema,
+    )
@@ -2,15 +2,44 @@
 Module for connecting to a Google Sheet and getting the data from it.
 """
 
-import gspread
+from typing import TYPE_CHECKING, Any, Callable
+
 import pandas as pd
 
 from spreadsheet.spreadsheet_utilities import get_google_sheet_service_account_dict
 
+if TYPE_CHECKING:
+    import gspread
+
+    from io_policy import IOPolicy
+
+# The name of the Google Sheets API endpoint for the I/O policy
+SHEETS_ENDPOINT = "sheets"
+
+
+def call_sheets_api(function: Callable[[], Any], io_policy: "IOPolicy | None" = None) -> Any:
+    """
+    Call the Google Sheets API with the I/O policy: with a deadline, the retries
+    of the throttled and failed requests and the circuit breaker.
+
+    :param function: The function of the call, without arguments.
+    :type function: Callable[[], Any]
+    :param io_policy: The I/O policy; the function is called directly if it is not provided.
+    :type io_policy: IOPolicy | None
+    :return: The result of the call.
+    :rtype: Any
+    """
+    if io_policy is None:
+        return function()
+
+    return io_policy.call(SHEETS_ENDPOINT, function)
+
 
 def connect_to_google_sheet(
-    credentials: str | None, sheet_title: str
-) -> gspread.spreadsheet.Spreadsheet:
+    credentials: str | None,
+    sheet_title: str,
+    io_policy: "IOPolicy | None" = None,
+) -> "gspread.spreadsheet.Spreadsheet":
     """
     Connect to a Google Sheet using the gspread library.
 
@@ -18,33 +47,100 @@ def connect_to_google_sheet(
     :type credentials: str
     :param sheet_title: The title of the Google Sheet.
     :type sheet_title: str
+    :param io_policy: The I/O policy of the requests.
+    :type io_policy: IOPolicy | None
     :return: The Google Sheet.
     :rtype: gspread.spreadsheet.Spreadsheet
     """
+    # gspread is imported on the connection, not on the import of the module
+    import gspread
+
     config = get_google_sheet_service_account_dict(credentials)
     # Authorize the client
     client = gspread.service_account_from_dict(config)
     # Open the Google Sheet by its title or URL
-    sheet = client.open(sheet_title).sheet1
+    sheet = call_sheets_api(lambda: client.open(sheet_title).sheet1, io_policy)
 
     return sheet
 
 
-def get_sheet_data(sheet: gspread.spreadsheet.Spreadsheet) -> list:
+def get_sheet_data(
+    sheet: "gspread.spreadsheet.Spreadsheet",
+    io_policy: "IOPolicy | None" = None,
+) -> list:
     """
     Get the data from a Google Sheet.
 
     :param sheet: The Google Sheet.
     :type sheet: gspread.models.Spreadsheet
+    :param io_policy: The I/O policy of the requests.
+    :type io_policy: IOPolicy | None
     :return: The data from the Google Sheet.
     :rtype: list
     """
     # Get all values from the sheet
-    data = sheet.get_all_values()
+    data = call_sheets_api(sheet.get_all_values, io_policy)
 
     return data
 
 
+def get_sheet_columns_data(
+    sheet: "gspread.worksheet.Worksheet",
+    columns: list[str],
+    start_position: int = 0,
+    io_policy: "IOPolicy | None" = None,
+    end_position: int | None = None,
+) -> list:
+    """
+    Get the values of some columns of a Google Sheet with one batched range read.
+
+    :param sheet: The Google Sheet.
+    :type sheet: gspread.worksheet.Worksheet
+    :param columns: The names of the columns.
+    :type columns: list[str]
+    :param start_position: The position of the first data row to read,
+        not counting the header row.
+    :type start_position: int
+    :param io_policy: The I/O policy of the requests.
+    :type io_policy: IOPolicy | None
+    :param end_position: The position after the last data row to read;
+        the rows are read to the end of the sheet if it is not provided.
+    :type end_position: int | None
+    :return: The names of the columns and the rows of their values,
+        in the format of get_sheet_data.
+    :rtype: list
+    """
+    from gspread.utils import rowcol_to_a1
+
+    header = call_sheets_api(lambda: sheet.row_values(1), io_policy)
+    missing_columns = [column for column in columns if column not in header]
+    if missing_columns:
+        raise ValueError(
+            f"The columns are not found in the Google Sheet: {', '.join(missing_columns)}."
+        )
+
+    # The data rows start from the second row of the sheet
+    start_row = start_position + 2
+    end_row = str(end_position + 1) if end_position is not None else ""
+    ranges = []
+    for column in columns:
+        # The letter of the column, e.g. "C" from "C1"
+        column_letter = rowcol_to_a1(1, header.index(column) + 1)[:-1]
+        ranges.append(f"{column_letter}{start_row}:{column_letter}{end_row}")
+    value_ranges = call_sheets_api(lambda: sheet.batch_get(ranges), io_policy)
+
+    # The empty cells are returned as empty rows and the empty cells
+    # at the end of a column are not returned at all
+    column_values = [
+        [row[0] if row else "" for row in value_range] for value_range in value_ranges
+    ]
+    row_count = max((len(values) for values in column_values), default=0)
+    for values in column_values:
+        values.extend([""] * (row_count - len(values)))
+
+    return [list(columns)] + [list(row) for row in zip(*column_values)]
+
+
 def sheet_data_to_df(data: list) -> pd.DataFrame:
     """
     Convert the data from a Google Sheet to a pandas DataFrame.
@@ -60,7 +156,42 @@ def sheet_data_to_df(data: list) -> pd.DataFrame:
     return df
 
 
-def get_sample_data(sample_id: str, df: pd.DataFrame) -> pd.DataFrame:
+def build_sample_index(df: pd.DataFrame) -> dict[str, list[int]]:
+    """
+    Build the index of the samples in the DataFrame: the positions of the rows
+    of every sample id in the order of their first appearance.
+
+    :param df: The DataFrame.
+    :type df: pd.DataFrame
+    :return: The positions of the rows by the sample id.
+    :rtype: dict[str, list[int]]
+    """
+    sample_index = {}
+    for position, sample_id in enumerate(df["Sample sheet_Sample_ID"].tolist()):
+        sample_index.setdefault(sample_id, []).append(position)
+
+    return sample_index
+
+
+def get_duplicated_sample_ids(sample_index: dict[str, list[int]]) -> list[str]:
+    """
+    Get the ids of the samples that have more than one row in the DataFrame.
+
+    :param sample_index: The positions of the rows by the sample id.
+    :type sample_index: dict[str, list[int]]
+    :return: The duplicated sample ids.
+    :rtype: list[str]
+    """
+    return [
+        sample_id for sample_id, positions in sample_index.items() if len(positions) > 1
+    ]
+
+
+def get_sample_data(
+    sample_id: str,
+    df: pd.DataFrame,
+    sample_index: dict[str, list[int]] | None = None,
+) -> pd.DataFrame:
     """
     Get the data for a specific sample from the DataFrame.
 
@@ -68,9 +199,16 @@ def get_sample_data(sample_id: str, df: pd.DataFrame) -> pd.DataFrame:
     :type sample_id: str
     :param df: The DataFrame.
     :type df: pd.DataFrame
+    :param sample_index: The positions of the rows by the sample id;
+        the DataFrame is filtered for the sample if it is not provided.
+    :type sample_index: dict[str, list[int]] | None
     :return: The data for the sample.
     :rtype: pd.DataFrame
     """
+    if sample_index is not None:
+        # Take the rows of the sample by their positions
+        return df.iloc[sample_index.get(sample_id, [])]
+
     # Filter the DataFrame for the sample
     sample_data = df[df["Sample sheet_Sample_ID"] == sample_id]
 
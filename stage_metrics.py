@@ -0,0 +1,265 @@
+"""
+Module for measuring the stages: the wall and CPU time, the bytes downloaded
+from S3 and the outcomes of the artifact cache lookups.
+"""
+
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Iterator
+
+# The upper bounds of the buckets of the stage wall time histograms, in seconds
+WALL_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+@dataclass
+class IOStats:
+    """
+    Class for storing the I/O of a stage: the bytes downloaded from S3
+    and the numbers of the artifact cache hits and misses.
+    """
+
+    bytes_downloaded: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+    def add(self, other: "IOStats") -> None:
+        """
+        Add the I/O of another stage or download.
+
+        :param other: The I/O to add.
+        :type other: IOStats
+        """
+        self.bytes_downloaded += other.bytes_downloaded
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+
+
+# The I/O of the stage that is being measured in the current thread
+_io_stats: ContextVar[IOStats | None] = ContextVar("io_stats", default=None)
+
+
+def record_download(size: int) -> None:
+    """
+    Add the bytes downloaded from S3 to the I/O of the current stage.
+
+    :param size: The number of the bytes.
+    :type size: int
+    """
+    io_stats = _io_stats.get()
+    if io_stats is not None:
+        io_stats.bytes_downloaded += size
+
+
+def record_cache_lookup(hit: bool) -> None:
+    """
+    Add the outcome of an artifact cache lookup to the I/O of the current stage.
+
+    :param hit: Whether the file was taken from the cache.
+    :type hit: bool
+    """
+    io_stats = _io_stats.get()
+    if io_stats is None:
+        return
+    if hit:
+        io_stats.cache_hits += 1
+    else:
+        io_stats.cache_misses += 1
+
+
+def add_io_stats(other: IOStats) -> None:
+    """
+    Add the I/O done in another thread, e.g. by a prefetched download,
+    to the I/O of the current stage.
+
+    :param other: The I/O to add.
+    :type other: IOStats
+    """
+    io_stats = _io_stats.get()
+    if io_stats is not None:
+        io_stats.add(other)
+
+
+@contextmanager
+def collect_io_stats() -> Iterator[IOStats]:
+    """
+    Collect the I/O done in the current thread inside the block.
+
+    :return: The I/O of the block, filled in when the block exits.
+    :rtype: Iterator[IOStats]
+    """
+    io_stats = IOStats()
+    token = _io_stats.set(io_stats)
+    try:
+        yield io_stats
+    finally:
+        _io_stats.reset(token)
+
+
+@contextmanager
+def measure_stage() -> Iterator[dict]:
+    """
+    Measure a stage run in the block: the wall time, the CPU time of
+    the thread and the I/O.
+
+    :return: The measurements, filled in when the block exits.
+    :rtype: Iterator[dict]
+    """
+    timing = {}
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    with collect_io_stats() as io_stats:
+        try:
+            yield timing
+        finally:
+            timing["wall_time"] = round(time.perf_counter() - start_wall_time, 6)
+            timing["cpu_time"] = round(time.thread_time() - start_cpu_time, 6)
+            timing.update(asdict(io_stats))
+
+
+def _get_stage_label(stage_name: str) -> str:
+    """
+    Get the quoted and escaped value of the stage label of a Prometheus metric.
+
+    :param stage_name: The name of the stage.
+    :type stage_name: str
+    :return: The value of the label.
+    :rtype: str
+    """
+    return json.dumps(stage_name, ensure_ascii=False)
+
+
+class RunMetrics:
+    """
+    Class for aggregating the timings of the stages of all samples of a run:
+    a histogram of the wall time and the totals of the CPU time and the I/O per stage.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.memoized_samples = 0
+        self.start_time = time.time()
+        # The aggregates by the stage name
+        self.stages: dict[str, dict] = {}
+
+    def add_result(self, result: dict, memoized: bool = False) -> None:
+        """
+        Add the timings of the stages of a sample.
+
+        :param result: The result of the QC stages with the timings in the meta block.
+        :type result: dict
+        :param memoized: Whether the result was stored by a previous run.
+        :type memoized: bool
+        """
+        self.samples += 1
+        if memoized:
+            self.memoized_samples += 1
+            return
+
+        for stage_name, timing in result["meta"].get("timings", {}).items():
+            stage = self.stages.setdefault(
+                stage_name,
+                {
+                    "count": 0,
+                    "wall_time_sum": 0.0,
+                    "wall_time_buckets": [0] * len(WALL_TIME_BUCKETS),
+                    "cpu_time_sum": 0.0,
+                    "bytes_downloaded": 0,
+                    "cache_hits": 0,
+                    "cache_misses": 0,
+                },
+            )
+            stage["count"] += 1
+            stage["wall_time_sum"] += timing["wall_time"]
+            for index, bucket in enumerate(WALL_TIME_BUCKETS):
+                if timing["wall_time"] <= bucket:
+                    stage["wall_time_buckets"][index] += 1
+            stage["cpu_time_sum"] += timing["cpu_time"]
+            stage["bytes_downloaded"] += timing["bytes_downloaded"]
+            stage["cache_hits"] += timing["cache_hits"]
+            stage["cache_misses"] += timing["cache_misses"]
+
+    def to_dict(self) -> dict:
+        """
+        Get the summary of the run.
+
+        :return: The summary.
+        :rtype: dict
+        """
+        return {
+            "samples": self.samples,
+            "memoized_samples": self.memoized_samples,
+            "duration": round(time.time() - self.start_time, 3),
+            "wall_time_buckets": list(WALL_TIME_BUCKETS),
+            "stages": self.stages,
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Get the summary of the run in the Prometheus text format.
+
+        :return: The metrics.
+        :rtype: str
+        """
+        summary = self.to_dict()
+        lines = [
+            "# HELP qc_tool_run_samples_total The number of the samples of the run.",
+            "# TYPE qc_tool_run_samples_total counter",
+            f"qc_tool_run_samples_total {summary['samples']}",
+            "# HELP qc_tool_run_memoized_samples_total The number of the samples with the stored results.",
+            "# TYPE qc_tool_run_memoized_samples_total counter",
+            f"qc_tool_run_memoized_samples_total {summary['memoized_samples']}",
+            "# HELP qc_tool_run_duration_seconds The duration of the run.",
+            "# TYPE qc_tool_run_duration_seconds gauge",
+            f"qc_tool_run_duration_seconds {summary['duration']}",
+            "# HELP qc_tool_stage_wall_seconds The wall time of the stages.",
+            "# TYPE qc_tool_stage_wall_seconds histogram",
+        ]
+        for stage_name, stage in self.stages.items():
+            label = _get_stage_label(stage_name)
+            for bucket, count in zip(WALL_TIME_BUCKETS, stage["wall_time_buckets"]):
+                lines.append(f'qc_tool_stage_wall_seconds_bucket{{stage={label},le="{bucket}"}} {count}')
+            lines.append(f'qc_tool_stage_wall_seconds_bucket{{stage={label},le="+Inf"}} {stage["count"]}')
+            lines.append(f"qc_tool_stage_wall_seconds_sum{{stage={label}}} {stage['wall_time_sum']}")
+            lines.append(f"qc_tool_stage_wall_seconds_count{{stage={label}}} {stage['count']}")
+
+        counters = [
+            ("qc_tool_stage_cpu_seconds_total", "The CPU time of the stages.", "cpu_time_sum", ""),
+            ("qc_tool_stage_downloaded_bytes_total", "The bytes downloaded from S3 by the stages.", "bytes_downloaded", ""),
+            ("qc_tool_stage_artifact_cache_total", "The artifact cache lookups of the stages.", "cache_hits", ',outcome="hit"'),
+            ("qc_tool_stage_artifact_cache_total", None, "cache_misses", ',outcome="miss"'),
+        ]
+        for metric_name, help_text, key, extra_labels in counters:
+            if help_text is not None:
+                lines.append(f"# HELP {metric_name} {help_text}")
+                lines.append(f"# TYPE {metric_name} counter")
+            for stage_name, stage in self.stages.items():
+                lines.append(f"{metric_name}{{stage={_get_stage_label(stage_name)}{extra_labels}}} {stage[key]}")
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, file_path: str) -> None:
+        """
+        Save the summary of the run with an atomic rename: in the Prometheus text
+        format if the file has the .prom extension, as JSON otherwise.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        """
+        if file_path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=4)
+
+        dir_path = os.path.dirname(file_path) or "."
+        os.makedirs(dir_path, exist_ok=True)
+        file_descriptor, tmp_file_path = tempfile.mkstemp(dir=dir_path)
+        with os.fdopen(file_descriptor, "w") as metrics_file:
+            metrics_file.write(content)
+        # The file is read by the other users, e.g. by the node exporter
+        os.chmod(tmp_file_path, 0o644)
+        os.replace(tmp_file_path, file_path)
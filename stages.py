@@ -2,19 +2,16 @@
 This module contains the functions for the qc_tool check stages.
 """
 
-from pathlib import Path
+from contextlib import closing
+from typing import BinaryIO
 
 import pandas as pd
 
-from utilities import (
-    download_file_from_s3,
-    get_genes_list_with_low_coverage,
-    get_inset_size_fraction_below_150,
-    get_size_count_dict,
-    normalize_size_count_dict,
-    remove_files_in_dir,
-    unarchive_tar_gz_file,
-)
+from artifact_fetcher import AsyncArtifactFetcher
+from gene_coverage import GeneCoverageTable, read_gene_coverage_table
+from gene_coverage_index import get_gene_coverage_index
+from insert_size import read_insert_size_histogram
+from s3_client import S3ArtifactClient, get_object_head, get_s3_client
 from values import BUCKET_NAME
 
 
@@ -54,25 +51,41 @@ def average_coverage_v1_v2_ratio_check(
     return check_result
 
 
-def average_coverage_completeness_v1_v2_check(
+def get_sample_object_key_prefix(sample_df: pd.DataFrame) -> str:
+    """
+    Get the prefix of the keys of the sample files on the S3 bucket.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :return: The prefix of the keys of the sample files.
+    :rtype: str
+    """
+    run_name = sample_df["Run"].iloc[0]
+    sample_id = sample_df["Sample sheet_Sample_ID"].iloc[0]
+
+    try:
+        sample_name_on_s3 = sample_id.split("-")[-1]
+    except IndexError as e:
+        raise ValueError("The sample id is not in the correct format.") from e
+
+    return f"{run_name}/{sample_name_on_s3}/output/"
+
+
+def get_low_coverage_completeness_versions(
     sample_df: pd.DataFrame,
     check_stage: dict,
-) -> dict:
+) -> list[str]:
     """
-    Check the values of the average coverage completeness v1 and v2.
-    If either value is less than the threshold, the check fails, otherwise it passes.
+    Get the panel versions (v1, v2) with the average coverage completeness
+    less than the threshold.
 
     :param sample_df: The data for the sample.
     :type sample_df: pd.DataFrame
     :param check_stage: The check stage.
     :type check_stage: dict
-    :return: The result of the check.
-    :rtype: dict
+    :return: The panel versions with the low average coverage completeness.
+    :rtype: list[str]
     """
-    check_result = {}
-    check_result["uid"] = check_stage["uid"]
-    check_result["name"] = check_stage["name"]
-
     # Get the average coverage completeness v1 and v2
     try:
         average_coverage_completeness_v1 = float(
@@ -86,98 +99,259 @@ def average_coverage_completeness_v1_v2_check(
             "The average coverage completeness v1 or v2 is not a number.",
         ) from e
 
-    # If either value is less than the threshold, the check fails
-    if (
-        average_coverage_completeness_v1 < check_stage["params"]["threshold"]
-        or average_coverage_completeness_v2 < check_stage["params"]["threshold"]
-    ):
-        run_name = sample_df["Run"].iloc[0]
-        sample_id = sample_df["Sample sheet_Sample_ID"].iloc[0]
-        tumor_normal = sample_df["Tumor/Normal"].iloc[0]
+    versions = []
+    if average_coverage_completeness_v1 < check_stage["params"]["threshold"]:
+        versions.append("v1")
+    if average_coverage_completeness_v2 < check_stage["params"]["threshold"]:
+        versions.append("v2")
+
+    return versions
+
+
+def get_coverage_stats_object_keys(
+    sample_df: pd.DataFrame,
+    check_stage: dict,
+) -> list[str]:
+    """
+    Get the keys of the coverage-stats.genes.txt files on the S3 bucket
+    needed by the average coverage completeness check.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :return: The keys of the files in the order of the panel versions.
+    :rtype: list[str]
+    """
+    versions = get_low_coverage_completeness_versions(sample_df, check_stage)
+
+    return [get_coverage_stats_object_key(sample_df, version) for version in versions]
+
+
+def get_coverage_stats_object_key(sample_df: pd.DataFrame, version: str) -> str:
+    """
+    Get the key of the coverage-stats.genes.txt file of a panel version on the S3 bucket.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param version: The panel version: v1 or v2.
+    :type version: str
+    :return: The key of the file.
+    :rtype: str
+    """
+    tumor_normal = sample_df["Tumor/Normal"].iloc[0]
+    # The path to the files on the S3 bucket
+    object_key_prefix = f"{get_sample_object_key_prefix(sample_df)}ROI_QC/"
+
+    return f"{object_key_prefix}cfDNA-{tumor_normal}.{version.upper()}.coverage-stats.genes.txt"
+
+
+def get_picard_output_object_keys(
+    sample_df: pd.DataFrame,
+    estimation_stage: dict,
+) -> list[str]:
+    """
+    Get the key of the picard output archive on the S3 bucket
+    needed by the insert size fraction estimation.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param estimation_stage: The estimation stage.
+    :type estimation_stage: dict
+    :return: The key of the archive.
+    :rtype: list[str]
+    """
+    tumor_normal = sample_df["Tumor/Normal"].iloc[0]
+    object_key_prefix = get_sample_object_key_prefix(sample_df)
+
+    return [f"{object_key_prefix}QC/cfDNA-{tumor_normal}.picard_output.tar.gz"]
+
+
+def _open_artifact(
+    object_key: str,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None,
+) -> BinaryIO:
+    """
+    Open the stream of a file from the S3 bucket with the artifact fetcher if it
+    is provided, otherwise with the shared S3 client of the process.
+
+    :param object_key: The key of the object.
+    :type object_key: str
+    :param artifact_fetcher: The fetcher with the prefetched files or an S3 client.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :return: The stream of the file.
+    :rtype: BinaryIO
+    """
+    if artifact_fetcher is None:
+        artifact_fetcher = get_s3_client()
+    return artifact_fetcher.open(BUCKET_NAME, object_key)
+
+
+def _head_artifact(
+    object_key: str,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None,
+) -> dict:
+    """
+    Get the ETag and the size of a file on the S3 bucket, shared with the other
+    requests for the sample if they have got them, see share_object_heads.
+
+    :param object_key: The key of the object.
+    :type object_key: str
+    :param artifact_fetcher: The fetcher with the prefetched files or an S3 client.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :return: The ETag and the size of the file.
+    :rtype: dict
+    """
+    if artifact_fetcher is None:
+        artifact_fetcher = get_s3_client()
+    return get_object_head(artifact_fetcher, BUCKET_NAME, object_key)
+
 
+def get_gene_coverage_table(
+    object_key: str,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+) -> GeneCoverageTable:
+    """
+    Read the gene coverage table from a coverage-stats.genes.txt file on the S3 bucket.
+
+    :param object_key: The key of the file.
+    :type object_key: str
+    :param artifact_fetcher: The fetcher with the prefetched files or an S3 client.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :return: The gene coverage table.
+    :rtype: GeneCoverageTable
+    """
+    with closing(_open_artifact(object_key, artifact_fetcher)) as genes_file:
+        return read_gene_coverage_table(genes_file)
+
+
+def get_low_coverage_genes(
+    sample_df: pd.DataFrame,
+    version: str,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+) -> list[str]:
+    """
+    Get the genes with low coverage of a panel version of a sample: from the gene
+    coverage index if the table of the current version of the file is there,
+    otherwise from the file on the S3 bucket; the table read from the file
+    is added to the index.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param version: The panel version: v1 or v2.
+    :type version: str
+    :param artifact_fetcher: The fetcher with the prefetched files or an S3 client.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :return: The genes marked as False in the good column.
+    :rtype: list[str]
+    """
+    object_key = get_coverage_stats_object_key(sample_df, version)
+    gene_coverage_index = get_gene_coverage_index()
+    if gene_coverage_index is None:
+        return get_gene_coverage_table(object_key, artifact_fetcher).low_coverage_genes
+
+    run_name = sample_df["Run"].iloc[0]
+    sample_id = sample_df["Sample sheet_Sample_ID"].iloc[0]
+    head = _head_artifact(object_key, artifact_fetcher)
+    low_coverage_genes = gene_coverage_index.get_low_coverage_genes(
+        run_name, sample_id, version, head
+    )
+    if low_coverage_genes is None:
+        gene_coverage_table = get_gene_coverage_table(object_key, artifact_fetcher)
+        gene_coverage_index.add(
+            run_name, sample_id, version, object_key, head, gene_coverage_table
+        )
+        low_coverage_genes = gene_coverage_table.low_coverage_genes
+
+    return low_coverage_genes
+
+
+def index_passed_gene_coverage_tables(
+    sample_df: pd.DataFrame,
+    failed_versions: list[str],
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+) -> None:
+    """
+    Add the tables of the panel versions that pass the average coverage completeness
+    check to the gene coverage index if it indexes them and the tables of the current
+    versions of the files are not there yet.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param failed_versions: The panel versions with the low average coverage completeness.
+    :type failed_versions: list[str]
+    :param artifact_fetcher: The fetcher with the prefetched files or an S3 client.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    """
+    gene_coverage_index = get_gene_coverage_index()
+    if gene_coverage_index is None or not gene_coverage_index.index_passed_panels:
+        return
+
+    run_name = sample_df["Run"].iloc[0]
+    sample_id = sample_df["Sample sheet_Sample_ID"].iloc[0]
+    for version in ("v1", "v2"):
+        if version in failed_versions:
+            continue
+        object_key = get_coverage_stats_object_key(sample_df, version)
+        # The result of the check does not depend on these tables, so a table
+        # that cannot be read is only left for the next run of the sample
         try:
-            sample_name_on_s3 = sample_id.split("-")[-1]
-        except IndexError as e:
-            raise ValueError("The sample id is not in the correct format.") from e
-
-        # Path to the temporaty directory for storing the files
-        files_dir = f"{Path(__file__).parent.resolve()}/tmp"
-        # The path to the files on the S3 bucket
-        object_key_prefix = f"{run_name}/{sample_name_on_s3}/output/ROI_QC/"
-
-        if (
-            average_coverage_completeness_v1 < check_stage["params"]["threshold"]
-            and average_coverage_completeness_v2 < check_stage["params"]["threshold"]
-        ):
-            # The path to the local files
-            v1_file_name = f"cfDNA-{tumor_normal}.V1.coverage-stats.genes.txt"
-            v2_file_name = f"cfDNA-{tumor_normal}.V2.coverage-stats.genes.txt"
-            # The path to the files on the S3 bucket
-            object_key_v1 = f"{object_key_prefix}{v1_file_name}"
-            object_key_v2 = f"{object_key_prefix}{v2_file_name}"
-            # Download the file from the S3 bucket
-            download_file_from_s3(
-                BUCKET_NAME,
-                object_key_v1,
-                f"{files_dir}/{v1_file_name}",
-            )
-            download_file_from_s3(
-                BUCKET_NAME,
-                object_key_v2,
-                f"{files_dir}/{v2_file_name}",
-            )
-            # Get the genes with low coverage
-            v1_genes = get_genes_list_with_low_coverage(f"{files_dir}/{v1_file_name}")
-            v2_genes = get_genes_list_with_low_coverage(f"{files_dir}/{v2_file_name}")
-            # Remove the files in the temporary directory
-            remove_files_in_dir(files_dir)
-
-            check_result["status"] = check_stage["failed_status"]
-            check_result["message"] = (
-                f"average_coverage_completeness_v1 and average_coverage_completeness_v2 are {check_stage['failed_message']}"
+            head = _head_artifact(object_key, artifact_fetcher)
+            if gene_coverage_index.has_table(run_name, sample_id, version, head):
+                continue
+            gene_coverage_table = get_gene_coverage_table(object_key, artifact_fetcher)
+        except Exception:
+            continue
+        gene_coverage_index.add(
+            run_name, sample_id, version, object_key, head, gene_coverage_table
+        )
+
+
+def average_coverage_completeness_v1_v2_check(
+    sample_df: pd.DataFrame,
+    check_stage: dict,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
+) -> dict:
+    """
+    Check the values of the average coverage completeness v1 and v2.
+    If either value is less than the threshold, the check fails, otherwise it passes.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param check_stage: The check stage.
+    :type check_stage: dict
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
+    :return: The result of the check.
+    :rtype: dict
+    """
+    check_result = {}
+    check_result["uid"] = check_stage["uid"]
+    check_result["name"] = check_stage["name"]
+
+    # If either value is less than the threshold, the check fails
+    versions = get_low_coverage_completeness_versions(sample_df, check_stage)
+    if versions:
+        check_result["status"] = check_stage["failed_status"]
+        columns = " and ".join(
+            f"average_coverage_completeness_{version}" for version in versions
+        )
+        verb = "are" if len(versions) > 1 else "is"
+        check_result["message"] = f"{columns} {verb} {check_stage['failed_message']}"
+        check_result["data"] = {}
+
+        for version in versions:
+            # Get the genes with low coverage from the index or the file
+            check_result["data"][f"{version}_genes"] = get_low_coverage_genes(
+                sample_df, version, artifact_fetcher
             )
-            check_result["data"] = {
-                "v1_genes": v1_genes,
-                "v2_genes": v2_genes,
-            }
-
-        elif average_coverage_completeness_v1 < check_stage["params"]["threshold"]:
-            # The path to the local file
-            file_name = f"cfDNA-{tumor_normal}.V1.coverage-stats.genes.txt"
-            # The path to the file on the S3 bucket
-            object_key = f"{object_key_prefix}{file_name}"
-            # Download the file from the S3 bucket
-            download_file_from_s3(BUCKET_NAME, object_key, f"{files_dir}/{file_name}")
-            # Get the genes with low coverage
-            v1_genes = get_genes_list_with_low_coverage(f"{files_dir}/{file_name}")
-
-            # Remove the files in the temporary directory
-            remove_files_in_dir(files_dir)
-
-            check_result["status"] = check_stage["failed_status"]
-            check_result["message"] = f"average_coverage_completeness_v1 is {check_stage['failed_message']}"
-            check_result["data"] = {"v1_genes": v1_genes}
-
-        elif average_coverage_completeness_v2 < check_stage["params"]["threshold"]:
-            # The path to the local file
-            file_name = f"cfDNA-{tumor_normal}.V2.coverage-stats.genes.txt"
-            # The path to the file on the S3 bucket
-            object_key = f"{object_key_prefix}{file_name}"
-            # Download the file from the S3 bucket
-            download_file_from_s3(BUCKET_NAME, object_key, f"{files_dir}/{file_name}")
-            # Get the genes with low coverage
-            v2_genes = get_genes_list_with_low_coverage(f"{files_dir}/{file_name}")
-            # Remove the files in the temporary directory
-            remove_files_in_dir(files_dir)
-
-            check_result["status"] = check_stage["failed_status"]
-            check_result["message"] = f"average_coverage_completeness_v2 is {check_stage['failed_message']}"
-            check_result["data"] = {"v2_genes": v2_genes}
 
     else:
         check_result["status"] = check_stage["passed_status"]
         check_result["message"] = check_stage["passed_message"]
 
+    index_passed_gene_coverage_tables(sample_df, versions, artifact_fetcher)
+
     return check_result
 
 
@@ -371,14 +545,18 @@ def vaf_lod_estimation(
 def insert_size_fraction_estimation(
     sample_df: pd.DataFrame,
     estimation_stage: dict,
+    artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None = None,
 ) -> dict:
     """
-    Reads fraction with insert_size < 150 bp estimation.
+    Reads fraction with insert_size below the cutoff (150 bp) estimation and
+    the other insert size metrics configured for the stage.
 
     :param sample_df: The data for the sample.
     :type sample_df: pd.DataFrame
     :param estimation_stage: The estimation stage.
     :type estimation_stage: dict
+    :param artifact_fetcher: The fetcher for the files on the S3 bucket.
+    :type artifact_fetcher: AsyncArtifactFetcher | S3ArtifactClient | None
     :return: The result of the estimation.
     :rtype: dict
     """
@@ -387,43 +565,21 @@ def insert_size_fraction_estimation(
     estimation_result["uid"] = estimation_stage["uid"]
     estimation_result["name"] = estimation_stage["name"]
 
-    # Path to the temporaty directory for storing the files
-    files_dir = f"{Path(__file__).parent.resolve()}/tmp"
-
-    run_name = sample_df["Run"].iloc[0]
-    sample_id = sample_df["Sample sheet_Sample_ID"].iloc[0]
-
-    try:
-        sample_name_on_s3 = sample_id.split("-")[-1]
-    except IndexError as e:
-        raise ValueError("The sample id is not in the correct format.") from e
-
-    tumor_normal = sample_df["Tumor/Normal"].iloc[0]
-
-    try:
-        average_coverage_v1 = float(sample_df["average_coverage_v1"].iloc[0])
-    except ValueError as e:
-        raise ValueError("The average coverage v1 is not a number.") from e
-
     # The path to the file on the S3 bucket
-    object_key = f"{run_name}/{sample_name_on_s3}/output/QC/cfDNA-{tumor_normal}.picard_output.tar.gz"
-    # The path to the local file
-    tar_name = "picard_output.tar.gz"
-
-    # Download the file from the S3 bucket
-    download_file_from_s3(BUCKET_NAME, object_key, f"{files_dir}/{tar_name}")
-    # Unarchive the file
-    unarchive_tar_gz_file(f"{files_dir}/{tar_name}", files_dir)
-    # Get the size count dictionary
-    size_count = get_size_count_dict(files_dir)
-    # Normalize the size count dictionary
-    normalized_size_count = normalize_size_count_dict(size_count, average_coverage_v1)
-    # Get the fraction of the fractions with insert_size < 150 bp
-    fraction = get_inset_size_fraction_below_150(normalized_size_count)
-    # Remove the files in the temporary directory
-    remove_files_in_dir(files_dir)
+    object_key = get_picard_output_object_keys(sample_df, estimation_stage)[0]
+
+    # Read the insert size histogram from the stream of the archive
+    with closing(_open_artifact(object_key, artifact_fetcher)) as tar_file:
+        histogram = read_insert_size_histogram(tar_file)
+    # Get the fraction of the fractions with insert_size below the cutoff
+    fraction = histogram.fraction_below(estimation_stage["params"]["cutoff"])
 
     estimation_result["status"] = estimation_stage["completed_status"]
     estimation_result["data"] = {"fraction": round(fraction, 4)}
+    # Get the other insert size metrics from the same histogram
+    if estimation_stage["params"].get("metrics"):
+        estimation_result["data"]["metrics"] = histogram.get_metrics(
+            estimation_stage["params"]["metrics"],
+        )
 
     return estimation_result
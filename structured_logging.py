@@ -0,0 +1,246 @@
+"""
+Module for the non-blocking logging of the service: the records are put into
+a queue by the threads and the processes that create them and are formatted
+and written by the listener threads of the main process into a single log.
+"""
+
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import zlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# The attributes of the standard log records, not added to the JSON records as extras
+STANDARD_RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))
+) | {"message", "asctime", "taskName"}
+
+# The listeners of the loggers by the logger name
+_listeners: dict[str, QueueListener] = {}
+# The listeners of the records sent by the worker processes and their queues,
+# by the logger name
+_worker_listeners: dict[str, QueueListener] = {}
+_worker_queues: dict[str, multiprocessing.Queue] = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter for writing the log records as JSON lines with the extra
+    attributes of the records, e.g. the sample id and the stage name.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        Format the record; the message is formatted here, in the listener thread.
+
+        :param record: The log record.
+        :type record: logging.LogRecord
+        :return: The JSON line.
+        :rtype: str
+        """
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class SampleDebugFilter(logging.Filter):
+    """
+    Filter for sampling the per-stage debug records: the debug records with
+    the sample_id attribute are kept for the fraction sample_rate of the samples.
+    The choice depends only on the sample id, so all debug records of a sample
+    are either kept or dropped, in every process.
+    """
+
+    def __init__(self, sample_rate: float = 1.0):
+        """
+        :param sample_rate: The fraction of the samples whose debug records are kept.
+        :type sample_rate: float
+        """
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        Check whether the record is kept.
+
+        :param record: The log record.
+        :type record: logging.LogRecord
+        :return: Whether the record is kept.
+        :rtype: bool
+        """
+        sample_id = getattr(record, "sample_id", None)
+        if record.levelno > logging.DEBUG or sample_id is None or self.sample_rate >= 1:
+            return True
+
+        return zlib.crc32(str(sample_id).encode()) / 0xFFFFFFFF < self.sample_rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Handler for putting the records into a queue without formatting their messages,
+    so the formatting is done by the listener thread and only for the records
+    that are written. Used within a process: the arguments of the records are
+    not pickled.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Prepare the record for the queue: only the exception is formatted,
+        as its traceback is not kept.
+
+        :param record: The log record.
+        :type record: logging.LogRecord
+        :return: The record.
+        :rtype: logging.LogRecord
+        """
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+def create_queue_logger(
+    name: str,
+    file_path: str | None = None,
+    file_name: str | None = None,
+    json_format: bool = True,
+    stage_debug_sample_rate: float = 1.0,
+) -> logging.Logger:
+    """
+    Create a logger whose records are written to the stream and the log file
+    by a listener thread. The logger is created once per name: the next calls
+    return it without adding handlers.
+
+    :param name: The name of the logger.
+    :type name: str
+    :param file_path: The path to the directory of the log file;
+        the records are not written to a file if it is not provided.
+    :type file_path: str | None
+    :param file_name: The name of the log file.
+    :type file_name: str | None
+    :param json_format: Whether the records are written as JSON lines.
+    :type json_format: bool
+    :param stage_debug_sample_rate: The fraction of the samples whose per-stage
+        debug records are written.
+    :type stage_debug_sample_rate: float
+    :return: The logger.
+    :rtype: logging.Logger
+    """
+    logger = logging.getLogger(name)
+    if name in _listeners:
+        return logger
+
+    logger.setLevel(logging.DEBUG)
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    handlers = [logging.StreamHandler()]
+    if file_path:
+        os.makedirs(file_path, exist_ok=True)
+        handlers.append(logging.FileHandler(os.path.join(file_path, file_name), mode="w"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SampleDebugFilter(stage_debug_sample_rate))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[name] = listener
+    # The records left in the queue are written on exit
+    atexit.register(stop_queue_logger, name)
+
+    return logger
+
+
+def get_worker_log_queue(name: str) -> multiprocessing.Queue:
+    """
+    Get the queue through which the worker processes send the records of a logger
+    created with create_queue_logger; pass it to configure_worker_logging in
+    the initializer of the process pool. The records from the queue are written
+    by a second listener thread with the handlers of the logger, so the records
+    of all processes go to the same stream and log file.
+
+    :param name: The name of the logger.
+    :type name: str
+    :return: The queue of the records of the worker processes.
+    :rtype: multiprocessing.Queue
+    """
+    if name not in _worker_queues:
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(
+            log_queue, *_listeners[name].handlers, respect_handler_level=True
+        )
+        listener.start()
+        _worker_queues[name] = log_queue
+        _worker_listeners[name] = listener
+
+    return _worker_queues[name]
+
+
+def configure_worker_logging(
+    log_queue: multiprocessing.Queue,
+    name: str,
+    stage_debug_sample_rate: float = 1.0,
+) -> logging.Logger:
+    """
+    Send the records of a logger in a worker process to the listener in the main
+    process; used as the initializer of the process pools.
+
+    :param log_queue: The queue from get_worker_log_queue.
+    :type log_queue: multiprocessing.Queue
+    :param name: The name of the logger.
+    :type name: str
+    :param stage_debug_sample_rate: The fraction of the samples whose per-stage
+        debug records are written.
+    :type stage_debug_sample_rate: float
+    :return: The logger.
+    :rtype: logging.Logger
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.handlers.clear()
+    # The records are pickled, so their messages are formatted before the queue
+    queue_handler = QueueHandler(log_queue)
+    # The sampled records are dropped before they are pickled
+    queue_handler.addFilter(SampleDebugFilter(stage_debug_sample_rate))
+    logger.addHandler(queue_handler)
+
+    return logger
+
+
+def stop_queue_logger(name: str) -> None:
+    """
+    Write the records left in the queues of a logger and stop its listeners.
+
+    :param name: The name of the logger.
+    :type name: str
+    """
+    worker_listener = _worker_listeners.pop(name, None)
+    if worker_listener is not None:
+        worker_listener.stop()
+        _worker_queues.pop(name).close()
+    listener = _listeners.pop(name, None)
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,8 @@
+"""
+Configuration of the tests: the modules of the service are imported from the repository root.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
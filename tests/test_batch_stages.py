@@ -0,0 +1,184 @@
+"""
+Tests of the vectorized sheet-only stages against the per-sample stages.
+"""
+
+import json
+import logging
+
+import pandas as pd
+import pytest
+
+from complete_stages import complete_batch_check_stages, get_stage_error_result
+from service_settings.service_config import QCToolConfig
+from spreadsheet.spreadsheet_client import build_sample_index, get_sample_data
+from values import MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID
+
+# The values of the numeric columns: numbers, non-numeric cells, NaN, inf, zero,
+# empty and missing cells
+EDGE_VALUES = ["350", "120.5", "abc", "nan", "NaN", "inf", "-inf", "0", "", " ", "1e3", "-5", "200", None]
+# The values of the numeric columns that can all be cast to floats, but None
+NUMERIC_EDGE_VALUES = ["350", "120.5", "0", "1e3", "-5", None]
+
+
+def get_edge_case_df(edge_values: list[str | None] = EDGE_VALUES) -> pd.DataFrame:
+    """
+    Get the sheet data with the edge cases of every column, the duplicated
+    and the malformed sample ids.
+
+    :param edge_values: The values of the numeric columns.
+    :type edge_values: list[str | None]
+    :return: The data.
+    :rtype: pd.DataFrame
+    """
+    rows = []
+    for index in range(len(edge_values) * 3):
+        tumor_normal = ("tumor", "normal", "other")[index % 3]
+        rows.append(
+            {
+                "Sample sheet_Sample_ID": f"S{index}-{tumor_normal}-{index}",
+                "Run": "run_1",
+                "Tumor/Normal": tumor_normal,
+                "average_coverage_v1": edge_values[index % len(edge_values)],
+                "average_coverage_v2": edge_values[(index * 5 + 3) % len(edge_values)],
+                "Total Deduplicated Percentage": edge_values[(index + 1) % len(edge_values)],
+                "Off-target, %": edge_values[(index + 2) % len(edge_values)],
+                "Number_of_Reads_mln": edge_values[(index + 4) % len(edge_values)],
+            }
+        )
+    # The malformed sample ids: without the tumor/normal part and with an unknown one
+    rows.append({**rows[0], "Sample sheet_Sample_ID": "malformed"})
+    rows.append({**rows[0], "Sample sheet_Sample_ID": "S-"})
+    # The duplicated sample ids: the stages use the first row of the sample
+    rows.append({**rows[5], "average_coverage_v1": "abc", "Number_of_Reads_mln": "1"})
+    rows.append({**rows[1], "Sample sheet_Sample_ID": rows[0]["Sample sheet_Sample_ID"]})
+
+    # The object dtype keeps None, as in the cells missing from the sheet data
+    return pd.DataFrame(rows, dtype=object)
+
+
+def complete_sample_stage(sample_df: pd.DataFrame, stage: dict, qctool_config: QCToolConfig) -> dict:
+    """
+    Complete a stage with its per-sample function, as complete_qc_stages does.
+
+    :param sample_df: The data for the sample.
+    :type sample_df: pd.DataFrame
+    :param stage: The stage.
+    :type stage: dict
+    :param qctool_config: The configuration for the qc_tool.
+    :type qctool_config: QCToolConfig
+    :return: The result of the stage.
+    :rtype: dict
+    """
+    stage_function = qctool_config.uid_stage_name_dict[stage["uid"]]
+    try:
+        if stage["uid"] == MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID:
+            return stage_function(sample_df, stage, qctool_config.regression_models)
+        return stage_function(sample_df, stage)
+    except Exception as e:
+        return get_stage_error_result(stage, e)
+
+
+def dumps(result: dict) -> str:
+    """
+    Serialize a result for the comparison; NaN is equal to NaN in the JSON.
+
+    :param result: The result.
+    :type result: dict
+    :return: The JSON.
+    :rtype: str
+    """
+    return json.dumps(result, sort_keys=True, default=float)
+
+
+@pytest.fixture(scope="module")
+def qctool_config() -> QCToolConfig:
+    return QCToolConfig()
+
+
+@pytest.mark.parametrize("edge_values", [EDGE_VALUES, NUMERIC_EDGE_VALUES])
+def test_batch_stages_match_per_sample_stages(qctool_config: QCToolConfig, edge_values: list):
+    df = get_edge_case_df(edge_values)
+    batch_checks = complete_batch_check_stages(df, qctool_config, logging.getLogger("test"))
+    sample_index = build_sample_index(df)
+
+    batch_stages = [
+        stage
+        for stage in qctool_config.check_stages + qctool_config.estimation_stages
+        if stage["uid"] in qctool_config.uid_batch_stage_dict
+    ]
+    assert batch_stages
+    for sample_id in sample_index:
+        sample_df = get_sample_data(sample_id, df, sample_index)
+        for stage in batch_stages:
+            assert stage["uid"] in batch_checks[sample_id], (sample_id, stage["name"])
+            expected = complete_sample_stage(sample_df, stage, qctool_config)
+            assert dumps(batch_checks[sample_id][stage["uid"]]) == dumps(expected), (
+                sample_id,
+                stage["name"],
+            )
+
+
+def test_batch_stages_use_first_row_of_duplicated_samples(qctool_config: QCToolConfig):
+    df = get_edge_case_df()
+    batch_checks = complete_batch_check_stages(df, qctool_config, logging.getLogger("test"))
+
+    sample_id = df["Sample sheet_Sample_ID"].iloc[0]
+    first_row_checks = complete_batch_check_stages(
+        df.iloc[[0]], qctool_config, logging.getLogger("test")
+    )
+    assert dumps(batch_checks[sample_id]) == dumps(first_row_checks[sample_id])
+
+
+def test_vaf_lod_batch_estimation_matches_per_sample_estimation(qctool_config: QCToolConfig):
+    vaf_model = qctool_config.regression_models["models"]["vaf"]
+    lod_model = qctool_config.regression_models["models"]["lod"]
+    # The coverages around the poles and the zeros of the hyperbolas, where the estimated
+    # values are negative, and a dense range for the rounding of the estimated values
+    coverages = [
+        -vaf_model[1],
+        -lod_model[1],
+        -lod_model[1] - lod_model[0] / lod_model[2],
+        -vaf_model[1] - vaf_model[0] / vaf_model[2],
+        1e7,
+        50,
+        0,
+        -1,
+    ]
+    coverages += [100 + index * 7.3 for index in range(200)]
+    rows = []
+    for index, coverage in enumerate(coverages):
+        for tumor_normal in ("tumor", "normal"):
+            rows.append(
+                {
+                    "Sample sheet_Sample_ID": f"S{index}-{tumor_normal}",
+                    "average_coverage_v1": repr(coverage),
+                    "average_coverage_v2": repr(coverages[(index * 7 + 1) % len(coverages)]),
+                }
+            )
+    for sample_id in ("malformed", "S-", "S-other", "S-Tumor", "S-tumor-extra"):
+        rows.append({**rows[-2], "Sample sheet_Sample_ID": sample_id})
+    df = pd.DataFrame(rows)
+
+    stage = next(
+        stage
+        for stage in qctool_config.estimation_stages
+        if stage["uid"] == MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID
+    )
+    batch_checks = complete_batch_check_stages(df, qctool_config, logging.getLogger("test"))
+    sample_index = build_sample_index(df)
+
+    statuses = set()
+    for sample_id in sample_index:
+        sample_df = get_sample_data(sample_id, df, sample_index)
+        expected = complete_sample_stage(sample_df, stage, qctool_config)
+        result = batch_checks[sample_id][stage["uid"]]
+        assert dumps(result) == dumps(expected), sample_id
+        statuses.add((result["status"], result.get("message", "")))
+
+    # Every branch of the estimation is compared
+    messages = " ".join(message for _, message in statuses)
+    assert stage["completed_status"] in {status for status, _ in statuses}
+    assert stage["skipped_message"] in messages
+    assert "negative" in messages
+    assert "not in the correct format" in messages
+    assert "not tumor or normal" in messages
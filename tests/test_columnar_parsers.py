@@ -0,0 +1,194 @@
+"""
+Tests comparing the columnar gene coverage table and the NumPy insert size
+histogram with the line-by-line implementations they replaced.
+"""
+
+import io
+import random
+import tarfile
+
+import pandas as pd
+import pytest
+
+from gene_coverage import read_gene_coverage_table
+from service_settings.service_config import QCToolConfig
+from stages import insert_size_fraction_estimation
+
+# The uid of the insert size fraction estimation stage
+INSERT_SIZE_STAGE_UID = "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500"
+
+
+def get_baseline_low_coverage_genes(text: str) -> list[str]:
+    """
+    Get the genes marked as False in the good column as the line parser did.
+
+    :param text: The content of the coverage-stats.genes.txt file.
+    :type text: str
+    :return: The genes with low coverage.
+    :rtype: list[str]
+    """
+    genes_list = []
+    for line in io.StringIO(text).readlines():
+        if line.split()[-1] == "False":
+            genes_list.append(line.split()[0])
+
+    return genes_list
+
+
+def get_baseline_insert_size_fraction(text: str, average_coverage_v1: float) -> float:
+    """
+    Get the fraction of the reads with the insert size below 150
+    as the dictionary-based implementation did.
+
+    :param text: The content of the insert_size_metrics_2 file.
+    :type text: str
+    :param average_coverage_v1: The average coverage for v1.
+    :type average_coverage_v1: float
+    :return: The fraction rounded as in the stage result.
+    :rtype: float
+    """
+    size_count = {}
+    for line in io.StringIO(text).readlines()[1:]:
+        line = line.strip()
+        size_count[int(line.split("\t")[1])] = int(line.split("\t")[2])
+
+    normalized_size_count = {
+        insert: count / average_coverage_v1 for insert, count in size_count.items()
+    }
+    total_count = sum(normalized_size_count.values())
+    count_below_150 = sum(
+        [count for insert, count in normalized_size_count.items() if insert < 150]
+    )
+
+    return round(count_below_150 / total_count, 4)
+
+
+def get_gene_coverage_text(rows: int, seed: int, header: bool, trailing_newline: bool) -> str:
+    """
+    Generate a coverage-stats.genes.txt file with random metrics and good flags.
+
+    :param rows: The number of the genes.
+    :type rows: int
+    :param seed: The seed of the random generator.
+    :type seed: int
+    :param header: Whether the file starts with a header.
+    :type header: bool
+    :param trailing_newline: Whether the file ends with a newline.
+    :type trailing_newline: bool
+    :return: The content of the file.
+    :rtype: str
+    """
+    generator = random.Random(seed)
+    lines = ["gene\tmean_coverage\tpct_20x\tgood"] if header else []
+    for index in range(rows):
+        lines.append(
+            f"GENE{index}\t{generator.uniform(0, 2000):.2f}\t"
+            f"{generator.uniform(0, 100):.1f}\t{generator.choice(['True', 'False'])}"
+        )
+    text = "\n".join(lines)
+
+    return text + "\n" if trailing_newline else text
+
+
+def get_insert_size_text(seed: int) -> str:
+    """
+    Generate an insert_size_metrics_2 file: the header and the rows of the read
+    orientation, the insert size and the count, with a repeated insert size.
+
+    :param seed: The seed of the random generator.
+    :type seed: int
+    :return: The content of the file.
+    :rtype: str
+    """
+    generator = random.Random(seed)
+    sizes = generator.sample(range(30, 800), 400)
+    lines = ["pair_orientation\tinsert_size\tAll_Reads.fr_count"]
+    for size in sizes:
+        lines.append(f"FR\t{size}\t{generator.randint(0, 50000)}")
+    # The count of a repeated insert size is the last one
+    lines.append(f"FR\t{sizes[0]}\t{generator.randint(1, 50000)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_picard_output_archive(insert_size_text: str) -> bytes:
+    """
+    Build a picard output archive with the insert_size_metrics_2 file.
+
+    :param insert_size_text: The content of the insert_size_metrics_2 file.
+    :type insert_size_text: str
+    :return: The content of the .tar.gz archive.
+    :rtype: bytes
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name, content in (
+            ("picard_output/alignment_summary_metrics", "CATEGORY\tTOTAL_READS\n"),
+            ("picard_output/cfDNA.insert_size_metrics_2", insert_size_text),
+        ):
+            data = content.encode()
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+
+    return archive.getvalue()
+
+
+class ArchiveFetcher:
+    """
+    Class returning the same archive for any object key, in place of the S3 client.
+    """
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def open(self, bucket_name: str, object_key: str) -> io.BytesIO:
+        return io.BytesIO(self.content)
+
+
+@pytest.mark.parametrize("header", [True, False])
+@pytest.mark.parametrize("trailing_newline", [True, False])
+@pytest.mark.parametrize("chunk_size", [7, 64 * 1024])
+def test_gene_coverage_table_matches_line_parser(header, trailing_newline, chunk_size):
+    text = get_gene_coverage_text(2000, 17, header, trailing_newline)
+
+    table = read_gene_coverage_table(io.BytesIO(text.encode()), chunk_size=chunk_size)
+
+    assert table.low_coverage_genes == get_baseline_low_coverage_genes(text)
+
+
+def test_gene_coverage_table_without_low_coverage_genes():
+    text = "gene\tmean_coverage\tgood\nBRCA1\t512.0\tTrue\nTP53\t480.5\tTrue\n"
+
+    table = read_gene_coverage_table(io.BytesIO(text.encode()), chunk_size=5)
+
+    assert table.low_coverage_genes == get_baseline_low_coverage_genes(text) == []
+
+
+@pytest.mark.parametrize("seed", [3, 11, 29])
+def test_insert_size_fraction_matches_dictionary_implementation(seed):
+    insert_size_text = get_insert_size_text(seed)
+    average_coverage_v1 = 1234.5
+    estimation_stage = next(
+        stage
+        for stage in QCToolConfig().estimation_stages
+        if stage["uid"] == INSERT_SIZE_STAGE_UID
+    )
+    sample_df = pd.DataFrame(
+        {
+            "Run": ["RUN1"],
+            "Sample sheet_Sample_ID": ["RUN1-S1"],
+            "Tumor/Normal": ["tumor"],
+            "average_coverage_v1": [str(average_coverage_v1)],
+        }
+    )
+
+    result = insert_size_fraction_estimation(
+        sample_df,
+        estimation_stage,
+        ArchiveFetcher(get_picard_output_archive(insert_size_text)),
+    )
+
+    assert result["data"]["fraction"] == get_baseline_insert_size_fraction(
+        insert_size_text, average_coverage_v1
+    )
@@ -0,0 +1,46 @@
+"""
+Tests of the order and the window of the samples completed in the thread pool.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import complete_stages
+
+
+class CountingThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Class of the thread pool counting the submitted samples.
+    """
+
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        CountingThreadPoolExecutor.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def test_samples_are_submitted_in_a_bounded_window(monkeypatch):
+    monkeypatch.setattr(
+        complete_stages,
+        "complete_sample_qc_stages",
+        lambda sample_id, **kwargs: {"sample_id": sample_id},
+    )
+    monkeypatch.setattr(complete_stages, "ThreadPoolExecutor", CountingThreadPoolExecutor)
+    sample_ids = [f"S{index}" for index in range(20)]
+    results = complete_stages.complete_qc_stages_for_samples(
+        sample_ids,
+        pd.DataFrame(),
+        None,
+        logging.getLogger("test"),
+        workers=2,
+        prefetch_samples=1,
+    )
+
+    assert next(results) == {"sample_id": "S0"}
+    # The samples in progress and the next prefetched one
+    assert CountingThreadPoolExecutor.submitted == 3
+    assert [result["sample_id"] for result in results] == sample_ids[1:]
+    assert CountingThreadPoolExecutor.submitted == len(sample_ids)
@@ -0,0 +1,80 @@
+"""
+Tests of the gene coverage index used by the average coverage completeness check.
+"""
+
+import io
+
+import pandas as pd
+import pytest
+
+from gene_coverage_index import GeneCoverageIndex, set_gene_coverage_index
+from s3_client import share_object_heads
+from stages import get_low_coverage_genes
+from values import BUCKET_NAME
+
+
+class FakeS3Client:
+    """
+    Class serving the files from memory in place of the S3 client, counting the requests.
+    """
+
+    def __init__(self, files: dict[str, bytes]):
+        self.files = files
+        self.heads = 0
+        self.opens = 0
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        self.heads += 1
+        content = self.files[object_key]
+        return {"etag": str(hash(content)), "size": len(content)}
+
+    def open(self, bucket_name: str, object_key: str) -> io.BytesIO:
+        self.opens += 1
+        return io.BytesIO(self.files[object_key])
+
+
+@pytest.fixture
+def gene_coverage_index(tmp_path):
+    gene_coverage_index = GeneCoverageIndex(str(tmp_path / "gene_coverage.sqlite"))
+    set_gene_coverage_index(gene_coverage_index)
+    yield gene_coverage_index
+    set_gene_coverage_index(None)
+    gene_coverage_index.close()
+
+
+def get_sample_df() -> pd.DataFrame:
+    return pd.DataFrame(
+        {"Run": ["RUN1"], "Sample sheet_Sample_ID": ["RUN1-S1"], "Tumor/Normal": ["tumor"]}
+    )
+
+
+def test_changed_file_is_read_again(gene_coverage_index):
+    object_key = "RUN1/S1/output/ROI_QC/cfDNA-tumor.V1.coverage-stats.genes.txt"
+    s3_client = FakeS3Client({object_key: b"gene\tgood\nBRCA1\tFalse\nTP53\tTrue\n"})
+
+    assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["BRCA1"]
+    assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["BRCA1"]
+    assert s3_client.opens == 1
+    assert gene_coverage_index.has_object_key(object_key)
+
+    # The file is replaced with a new version under the same key
+    s3_client.files[object_key] = b"gene\tgood\nBRCA1\tTrue\nTP53\tFalse\nKRAS\tFalse\n"
+
+    assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["TP53", "KRAS"]
+    assert s3_client.opens == 2
+    assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["TP53", "KRAS"]
+    assert s3_client.opens == 2
+
+
+def test_shared_object_heads_are_not_requested_again(gene_coverage_index):
+    object_key = "RUN1/S1/output/ROI_QC/cfDNA-tumor.V1.coverage-stats.genes.txt"
+    s3_client = FakeS3Client({object_key: b"BRCA1\t10.0\tFalse\n"})
+    object_heads = {(BUCKET_NAME, object_key): {"etag": "etag-1", "size": 17}}
+
+    # The memo store has requested the ETag and the size for the sample
+    with share_object_heads(object_heads):
+        assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["BRCA1"]
+        assert get_low_coverage_genes(get_sample_df(), "v1", s3_client) == ["BRCA1"]
+
+    assert s3_client.heads == 0
+    assert s3_client.opens == 1
@@ -0,0 +1,155 @@
+"""
+Tests of the I/O policy and the S3 client using it against the fault-injecting S3 stand-in.
+"""
+
+import io
+import os
+import time
+
+import pytest
+
+from benchmarks.synthetic_data import FaultInjectingS3Client
+from io_policy import CircuitOpenError, DeadlineExceededError, IOPolicy
+from s3_client import FIRST_READ_SIZE, PolicyS3Client
+
+BUCKET_NAME = "bucket"
+OBJECT_KEY = "RUN1/S1/output/file.bin"
+# Larger than the first read, so the body is read from the stream of the response
+CONTENT = bytes(range(256)) * 1024
+
+
+class MemoryS3Client:
+    """
+    Class serving a file from memory in place of the S3 client.
+    """
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        return {"etag": "etag", "size": len(CONTENT)}
+
+    def open(self, bucket_name: str, object_key: str) -> io.BytesIO:
+        return io.BytesIO(CONTENT)
+
+    def download(self, bucket_name: str, object_key: str, local_file_path: str) -> None:
+        with open(local_file_path, "wb") as local_file:
+            local_file.write(CONTENT)
+
+
+@pytest.fixture
+def io_policy():
+    io_policy = IOPolicy(
+        deadline=5,
+        max_attempts=3,
+        backoff_base=0.001,
+        backoff_max=0.01,
+        failure_threshold=3,
+        reset_timeout=60,
+        hedge_percentile=None,
+    )
+    yield io_policy
+    io_policy.close()
+
+
+def test_transient_errors_are_retried(io_policy):
+    io_policy.max_attempts = 10
+    io_policy.failure_threshold = 100
+    fault_client = FaultInjectingS3Client(MemoryS3Client(), error_rate=0.3)
+    s3_client = PolicyS3Client(fault_client, io_policy)
+
+    for _ in range(50):
+        assert s3_client.head(BUCKET_NAME, OBJECT_KEY)["size"] == len(CONTENT)
+
+    assert fault_client.faults > 0
+    assert io_policy.get_breaker(f"s3:{BUCKET_NAME}").failures == 0
+
+
+def test_circuit_opens_after_failures_in_a_row(io_policy):
+    io_policy.max_attempts = 1
+    fault_client = FaultInjectingS3Client(MemoryS3Client(), error_rate=1.0)
+    s3_client = PolicyS3Client(fault_client, io_policy)
+
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            s3_client.head(BUCKET_NAME, OBJECT_KEY)
+    with pytest.raises(CircuitOpenError):
+        s3_client.head(BUCKET_NAME, OBJECT_KEY)
+
+    # The open circuit does not let the request through to the endpoint
+    assert fault_client.faults == 3
+
+
+def test_hedge_wins_over_a_slow_attempt(io_policy, tmp_path):
+    io_policy.hedge_percentile = 95
+    io_policy.hedge_min_samples = 5
+    fault_client = FaultInjectingS3Client(
+        MemoryS3Client(), slow_latency=0.5, scripted_faults=[None] * 5 + ["slow"]
+    )
+    s3_client = PolicyS3Client(fault_client, io_policy)
+    # The latencies of the endpoint for the hedging
+    for _ in range(5):
+        s3_client.head(BUCKET_NAME, OBJECT_KEY)
+
+    local_file_path = str(tmp_path / "file.bin")
+    start_time = time.monotonic()
+    s3_client.download(BUCKET_NAME, OBJECT_KEY, local_file_path)
+
+    assert time.monotonic() - start_time < 0.5
+    assert io_policy.hedges == 1
+    with open(local_file_path, "rb") as local_file:
+        assert local_file.read() == CONTENT
+
+    # The file of the slow attempt is removed when it completes
+    time.sleep(0.7)
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_call_fails_at_the_deadline(io_policy):
+    fault_client = FaultInjectingS3Client(
+        MemoryS3Client(), hang_latency=1.0, scripted_faults=["hang"]
+    )
+    io_policy.deadline = 0.2
+    s3_client = PolicyS3Client(fault_client, io_policy)
+
+    start_time = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        s3_client.head(BUCKET_NAME, OBJECT_KEY)
+
+    assert time.monotonic() - start_time < 0.5
+
+
+def test_call_waits_for_a_free_slot():
+    io_policy = IOPolicy(max_attempts=1, hedge_percentile=None, max_in_flight=1)
+    fault_client = FaultInjectingS3Client(
+        MemoryS3Client(), hang_latency=0.3, scripted_faults=["hang"]
+    )
+
+    # The abandoned attempt keeps the only slot until it completes
+    with pytest.raises(DeadlineExceededError):
+        io_policy.call("s3", lambda: fault_client.head(BUCKET_NAME, OBJECT_KEY), deadline=0.1)
+    assert io_policy.call("s3", lambda: fault_client.head(BUCKET_NAME, OBJECT_KEY), deadline=2)
+    io_policy.close()
+
+
+def test_opened_body_is_streamed(io_policy):
+    s3_client = PolicyS3Client(FaultInjectingS3Client(MemoryS3Client()), io_policy)
+
+    with s3_client.open(BUCKET_NAME, OBJECT_KEY) as stream:
+        chunks = iter(lambda: stream.read(1000), b"")
+        assert b"".join(chunks) == CONTENT
+
+
+def test_stalled_body_read_fails_at_its_deadline(io_policy):
+    fault_client = FaultInjectingS3Client(
+        MemoryS3Client(),
+        hang_latency=1.0,
+        scripted_faults=["stall"],
+        stall_after=FIRST_READ_SIZE,
+    )
+    s3_client = PolicyS3Client(fault_client, io_policy, read_deadline=0.2)
+
+    with s3_client.open(BUCKET_NAME, OBJECT_KEY) as stream:
+        assert stream.read(FIRST_READ_SIZE) == CONTENT[:FIRST_READ_SIZE]
+        start_time = time.monotonic()
+        with pytest.raises(DeadlineExceededError):
+            stream.read(1000)
+
+    assert time.monotonic() - start_time < 0.5
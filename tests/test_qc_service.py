@@ -0,0 +1,161 @@
+"""
+Tests of the HTTP service driven through its socket with a fake worksheet.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import complete_stages
+from qc_pipeline import read_sheet_df
+from qc_service import QCService
+from service_settings.service_config import QCToolConfig, ServiceConfig
+
+
+class FakeWorksheet:
+    """
+    Class returning fixed rows in place of the Google Sheet and counting the reads.
+    """
+
+    def __init__(self, sample_ids: list[str]):
+        self.sample_ids = list(sample_ids)
+        self.reads = 0
+
+    def get_all_values(self) -> list[list[str]]:
+        self.reads += 1
+        header = [
+            "Sample sheet_Sample_ID",
+            "Run",
+            "Tumor/Normal",
+            "average_coverage_v1",
+            "average_coverage_v2",
+            "Total Deduplicated Percentage",
+            "Off-target, %",
+            "Number_of_Reads_mln",
+        ]
+        rows = [
+            [sample_id, "run_1", "tumor", "350", "340", "70", "20", "40"]
+            for sample_id in self.sample_ids
+        ]
+
+        return [header, *rows]
+
+
+@pytest.fixture
+def completed_sample_ids(monkeypatch) -> list[str]:
+    """
+    Replace the QC stages with a slow fake that records the completed samples.
+    """
+    sample_ids = []
+    lock = threading.Lock()
+
+    def complete_sample_qc_stages(sample_id, *args, **kwargs):
+        with lock:
+            sample_ids.append(sample_id)
+        # Long enough for the concurrent requests to arrive during the computation
+        time.sleep(0.2)
+        return {"meta": {"sample_id": sample_id}, "stages": {"checks": [], "estimations": []}}
+
+    monkeypatch.setattr(complete_stages, "complete_sample_qc_stages", complete_sample_qc_stages)
+
+    return sample_ids
+
+
+def create_service(worksheet: FakeWorksheet, sheet_min_refresh_interval: float) -> QCService:
+    """
+    Create the service reading the fake worksheet, without the memo store and the cache.
+    """
+    return QCService(
+        lambda: read_sheet_df(worksheet),
+        QCToolConfig(),
+        ServiceConfig(),
+        logging.getLogger("test_qc_service"),
+        s3_client=None,
+        use_artifact_cache=False,
+        sheet_min_refresh_interval=sheet_min_refresh_interval,
+    )
+
+
+async def send_request(port: int, method: str, path: str) -> tuple[int, dict]:
+    """
+    Send an HTTP request to the service and read the status and the JSON body.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    header, body = response.split(b"\r\n\r\n", 1)
+    status = int(header.split(b" ", 2)[1])
+
+    return status, json.loads(body)
+
+
+async def run_with_server(qc_service: QCService, requests: list[tuple[str, str]]) -> list:
+    """
+    Serve the requests on a free port, sending them at the same time.
+    """
+    qc_service._start()
+    await qc_service.get_sheet_state()
+    server = await asyncio.start_server(qc_service._handle_connection, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        return await asyncio.gather(
+            *(send_request(port, method, path) for method, path in requests)
+        )
+
+
+def test_concurrent_requests_share_one_computation(completed_sample_ids):
+    worksheet = FakeWorksheet(["S1-tumor-1", "S2-tumor-2"])
+    qc_service = create_service(worksheet, sheet_min_refresh_interval=60)
+
+    responses = asyncio.run(
+        run_with_server(
+            qc_service,
+            [("POST", "/samples/S1-tumor-1/qc")] * 5 + [("GET", "/samples/S2-tumor-2/qc")],
+        )
+    )
+
+    assert [status for status, _ in responses] == [200] * 6
+    assert all(body == responses[0][1] for _, body in responses[:5])
+    assert responses[5][1]["meta"]["sample_id"] == "S2-tumor-2"
+    assert sorted(completed_sample_ids) == ["S1-tumor-1", "S2-tumor-2"]
+
+
+def test_unknown_samples_do_not_reread_the_sheet_every_time(completed_sample_ids):
+    worksheet = FakeWorksheet(["S1-tumor-1"])
+    qc_service = create_service(worksheet, sheet_min_refresh_interval=60)
+
+    responses = asyncio.run(
+        run_with_server(
+            qc_service,
+            [("POST", f"/samples/S{index}-tumor-{index}/qc") for index in range(2, 7)],
+        )
+    )
+
+    assert [status for status, _ in responses] == [404] * 5
+    # Only the first read: the forced reads are limited by sheet_min_refresh_interval
+    assert worksheet.reads == 1
+    assert completed_sample_ids == []
+
+
+def test_new_sample_is_found_by_a_forced_read(completed_sample_ids):
+    worksheet = FakeWorksheet(["S1-tumor-1"])
+    qc_service = create_service(worksheet, sheet_min_refresh_interval=0)
+
+    async def add_sample_and_request() -> list:
+        qc_service._start()
+        await qc_service.get_sheet_state()
+        worksheet.sample_ids.append("S2-tumor-2")
+        return await run_with_server(qc_service, [("POST", "/samples/S2-tumor-2/qc")])
+
+    [(status, body)] = asyncio.run(add_sample_and_request())
+
+    assert status == 200
+    assert body["meta"]["sample_id"] == "S2-tumor-2"
+    assert completed_sample_ids == ["S2-tumor-2"]
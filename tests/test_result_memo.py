@@ -0,0 +1,146 @@
+"""
+Tests of the ETags and the sizes shared by the memo store and the artifact cache.
+"""
+
+import io
+
+import pandas as pd
+import pytest
+
+from artifact_cache import ArtifactCache
+from result_memo import ResultMemoStore
+from s3_client import share_object_heads
+from values import BUCKET_NAME
+
+OBJECT_KEYS = ["RUN1/S1/output/a.txt", "RUN1/S1/output/b.txt"]
+
+
+class FakeS3Client:
+    """
+    Class serving the files from memory in place of the S3 client, counting the requests.
+    """
+
+    def __init__(self, files: dict[str, bytes]):
+        self.files = files
+        self.heads = 0
+        self.downloads = 0
+
+    def head(self, bucket_name: str, object_key: str) -> dict:
+        self.heads += 1
+        content = self.files[object_key]
+        return {"etag": str(hash(content)), "size": len(content)}
+
+    def download(self, bucket_name: str, object_key: str, local_file_path: str) -> None:
+        self.downloads += 1
+        with open(local_file_path, "wb") as local_file:
+            local_file.write(self.files[object_key])
+
+    def open(self, bucket_name: str, object_key: str) -> io.BytesIO:
+        return io.BytesIO(self.files[object_key])
+
+
+@pytest.fixture
+def s3_client() -> FakeS3Client:
+    return FakeS3Client({object_key: object_key.encode() for object_key in OBJECT_KEYS})
+
+
+def get_sample_df() -> pd.DataFrame:
+    return pd.DataFrame({"Run": ["RUN1"], "Sample sheet_Sample_ID": ["RUN1-S1"]})
+
+
+def read_files(artifact_cache: ArtifactCache) -> list[bytes]:
+    contents = []
+    for object_key in OBJECT_KEYS:
+        with artifact_cache.open(BUCKET_NAME, object_key) as cached_file:
+            contents.append(cached_file.read())
+
+    return contents
+
+
+def test_stages_use_the_heads_of_the_memo_key(tmp_path, s3_client):
+    memo_store = ResultMemoStore(str(tmp_path / "memo"), BUCKET_NAME, s3_client)
+    artifact_cache = ArtifactCache(str(tmp_path / "cache"), 1 << 20, s3_client)
+
+    # The prefetching looks the sample up first, in another thread
+    key, _ = memo_store.lookup("RUN1-S1", get_sample_df(), {}, OBJECT_KEYS)
+    assert s3_client.heads == len(OBJECT_KEYS)
+
+    # The stages of the sample consume the lookup and read the files through the cache
+    with share_object_heads():
+        consumed_key, _ = memo_store.lookup(
+            "RUN1-S1", get_sample_df(), {}, OBJECT_KEYS, consume=True
+        )
+        assert read_files(artifact_cache) == [object_key.encode() for object_key in OBJECT_KEYS]
+
+    assert consumed_key == key
+    assert s3_client.heads == len(OBJECT_KEYS)
+    assert s3_client.downloads == len(OBJECT_KEYS)
+
+
+def test_cache_requests_the_heads_of_every_sample(tmp_path, s3_client):
+    artifact_cache = ArtifactCache(str(tmp_path / "cache"), 1 << 20, s3_client)
+
+    with share_object_heads():
+        read_files(artifact_cache)
+        read_files(artifact_cache)
+    assert s3_client.heads == len(OBJECT_KEYS)
+
+    # The file is replaced; the next sample gets the new version
+    s3_client.files[OBJECT_KEYS[0]] = b"new content"
+    with share_object_heads():
+        assert read_files(artifact_cache)[0] == b"new content"
+
+    assert s3_client.heads == 2 * len(OBJECT_KEYS)
+    assert s3_client.downloads == len(OBJECT_KEYS) + 1
+
+
+def test_changed_file_changes_the_memo_key(tmp_path, s3_client):
+    memo_store = ResultMemoStore(str(tmp_path / "memo"), BUCKET_NAME, s3_client)
+
+    key, _ = memo_store.lookup("RUN1-S1", get_sample_df(), {}, OBJECT_KEYS, consume=True)
+    s3_client.files[OBJECT_KEYS[1]] = b"new content"
+    new_key, _ = memo_store.lookup("RUN1-S1", get_sample_df(), {}, OBJECT_KEYS, consume=True)
+
+    assert new_key != key
+    assert s3_client.heads == 2 * len(OBJECT_KEYS)
+
+
+def test_hits_are_counted_without_keeping_the_samples(tmp_path, s3_client):
+    memo_store = ResultMemoStore(str(tmp_path / "memo"), BUCKET_NAME, s3_client)
+    key, result = memo_store.lookup("RUN1-S1", get_sample_df(), {}, OBJECT_KEYS, consume=True)
+    assert result is None
+    memo_store.put(key, {"meta": {"sample_id": "RUN1-S1"}, "stages": {"checks": [], "estimations": []}})
+
+    for _ in range(2):
+        memo_store.forget("RUN1-S1")
+        _, result = memo_store.lookup("RUN1-S1", get_sample_df(), {}, OBJECT_KEYS, consume=True)
+        assert result["meta"]["sample_id"] == "RUN1-S1"
+
+    assert (memo_store.hits, memo_store.misses) == (2, 1)
+    assert not memo_store._lookups
+
+
+def test_cache_scans_the_files_only_when_it_is_full(tmp_path, monkeypatch):
+    s3_client = FakeS3Client({f"RUN1/S1/output/{index}.txt": b"x" * 100 for index in range(4)})
+    dir_path = str(tmp_path / "cache")
+    artifact_cache = ArtifactCache(dir_path, 250, s3_client)
+    scans = []
+    evict = artifact_cache._evict
+    monkeypatch.setattr(artifact_cache, "_evict", lambda: scans.append(1) or evict())
+
+    for index in range(2):
+        artifact_cache.download(BUCKET_NAME, f"RUN1/S1/output/{index}.txt", str(tmp_path / "file"))
+    assert not scans
+    assert artifact_cache._read_total_size() == 200
+
+    # The third file does not fit, so the least recently used file is evicted
+    for index in (0, 2):
+        artifact_cache.download(BUCKET_NAME, f"RUN1/S1/output/{index}.txt", str(tmp_path / "file"))
+    assert len(scans) == 1
+    assert artifact_cache._read_total_size() == 200
+    assert s3_client.downloads == 3
+
+    # Another process sharing the directory sees the same total
+    assert ArtifactCache(dir_path, 250, s3_client)._read_total_size() == 200
+    artifact_cache.download(BUCKET_NAME, "RUN1/S1/output/1.txt", str(tmp_path / "file"))
+    assert s3_client.downloads == 4
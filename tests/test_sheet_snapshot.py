@@ -0,0 +1,90 @@
+"""
+Tests of the local snapshot of the Google Sheet against a sheet kept in memory.
+"""
+
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from spreadsheet.sheet_snapshot import SheetSnapshot
+
+COLUMNS = ["Sample sheet_Sample_ID", "Run"]
+
+
+class MemorySheet:
+    """
+    Class serving the columns of a sheet from memory in place of the gspread worksheet,
+    counting the data rows read.
+    """
+
+    def __init__(self, rows: list[list[str]], row_count: int):
+        self.rows = rows
+        self.row_count = row_count
+        self.update_time = 0
+        self.rows_read = 0
+        self.spreadsheet = SimpleNamespace(get_lastUpdateTime=lambda: str(self.update_time))
+
+    def update(self, position: int, row: list[str]) -> None:
+        self.rows[position] = row
+        self.update_time += 1
+
+    def row_values(self, row: int) -> list[str]:
+        return COLUMNS
+
+    def batch_get(self, ranges: list[str]) -> list[list[list[str]]]:
+        value_ranges = []
+        for cell_range in ranges:
+            column, start_row, end_row = re.fullmatch(r"([A-Z]+)(\d+):[A-Z]+(\d*)", cell_range).groups()
+            end_position = int(end_row) - 1 if end_row else len(self.rows)
+            values = [row[ord(column) - ord("A")] for row in self.rows[int(start_row) - 2 : end_position]]
+            self.rows_read += len(values)
+            # The empty cells at the end of the range are not returned
+            while values and not values[-1]:
+                values.pop()
+            value_ranges.append([[value] if value else [] for value in values])
+
+        return value_ranges
+
+
+def get_sample_ids(snapshot: SheetSnapshot) -> list[str]:
+    return snapshot.load()[0]["Sample sheet_Sample_ID"].tolist()
+
+
+def test_full_sync_reads_past_empty_blocks(tmp_path):
+    rows = [[f"S{index}-tumor", "run_1"] for index in range(5)]
+    rows += [["", ""]] * 25 + [["S30-tumor", "run_2"]]
+    sheet = MemorySheet(rows, row_count=40)
+    snapshot = SheetSnapshot(str(tmp_path / "sheet.feather"), chunk_rows=10)
+
+    df = snapshot.sync(sheet, COLUMNS)
+
+    assert df["Sample sheet_Sample_ID"].tolist()[-1] == "S30-tumor"
+    assert len(df) == 31
+
+
+def test_full_sync_reads_rows_appended_after_the_grid_size(tmp_path):
+    sheet = MemorySheet([[f"S{index}-tumor", "run_1"] for index in range(25)], row_count=10)
+    snapshot = SheetSnapshot(str(tmp_path / "sheet.feather"), chunk_rows=10)
+
+    assert len(snapshot.sync(sheet, COLUMNS)) == 25
+
+
+@pytest.mark.parametrize("fresh", [False, True])
+def test_fresh_sync_reads_the_rows_not_rechecked(tmp_path, fresh):
+    sheet = MemorySheet([[f"S{index}-tumor", "run_1"] for index in range(20)], row_count=20)
+    snapshot = SheetSnapshot(str(tmp_path / "sheet.feather"), recheck_rows=5)
+    snapshot.sync(sheet, COLUMNS)
+
+    # The edit of an old row is not picked up by the incremental sync
+    sheet.update(0, ["S0-normal", "run_1"])
+    snapshot.sync(sheet, COLUMNS)
+    assert get_sample_ids(snapshot)[0] == "S0-tumor"
+    assert snapshot.load()[1]["stale_rows"] == 15
+
+    # The unchanged sheet is not read again unless the fresh rows are needed
+    sheet.rows_read = 0
+    snapshot.sync(sheet, COLUMNS, fresh=fresh)
+    assert get_sample_ids(snapshot)[0] == ("S0-normal" if fresh else "S0-tumor")
+    assert sheet.rows_read == (40 if fresh else 0)
+    assert snapshot.load()[1]["stale_rows"] == (0 if fresh else 15)
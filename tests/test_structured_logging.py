@@ -0,0 +1,39 @@
+"""
+Tests of the queue logging of the threads and the worker processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+
+from structured_logging import (
+    configure_worker_logging,
+    create_queue_logger,
+    get_worker_log_queue,
+    stop_queue_logger,
+)
+
+LOGGER_NAME = "test_structured_logging"
+
+
+def log_sample(sample_id: str) -> None:
+    logging.getLogger(LOGGER_NAME).info("Sample processed.", extra={"sample_id": sample_id})
+
+
+def test_records_of_the_worker_processes_are_written_to_the_log_file(tmp_path):
+    logger = create_queue_logger(LOGGER_NAME, str(tmp_path), "service.log")
+    log_queue = get_worker_log_queue(LOGGER_NAME)
+
+    logger.info("Run started.")
+    with ProcessPoolExecutor(
+        max_workers=2,
+        initializer=configure_worker_logging,
+        initargs=(log_queue, LOGGER_NAME),
+    ) as executor:
+        list(executor.map(log_sample, ["S1", "S2", "S3"]))
+    stop_queue_logger(LOGGER_NAME)
+
+    with open(tmp_path / "service.log") as log_file:
+        records = [json.loads(line) for line in log_file]
+    assert records[0]["message"] == "Run started."
+    assert sorted(record.get("sample_id") for record in records[1:]) == ["S1", "S2", "S3"]
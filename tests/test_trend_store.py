@@ -0,0 +1,106 @@
+"""
+Tests of the baselines of the QC metrics kept between the runs.
+"""
+
+import json
+import os
+
+from trend_store import TREND_STORE_VERSION, TrendStore
+
+
+def test_every_sample_is_added_once(tmp_path):
+    trend_store = TrendStore(str(tmp_path / "trends.json"), tracked_runs=2)
+
+    trend_store.observe("S1", "run_1", {"off_target": 10.0})
+    trend_store.observe("S1", "run_1", {"off_target": 50.0})
+    trend_store.observe("S2", "run_1", {"off_target": 20.0}, is_memoized=True)
+    trend_store.observe("S3", "run_2", {"off_target": 30.0})
+
+    assert trend_store._baselines["off_target"].count == 2
+
+
+def test_sample_ids_of_old_runs_are_dropped(tmp_path):
+    file_path = str(tmp_path / "trends.json")
+    trend_store = TrendStore(file_path, tracked_runs=2)
+
+    for run_index in range(5):
+        for sample_index in range(3):
+            trend_store.observe(
+                f"S{run_index}-{sample_index}", f"run_{run_index}", {"off_target": 10.0}
+            )
+    trend_store.save()
+
+    with open(file_path) as store_file:
+        state = json.load(store_file)
+    assert list(state["run_sample_ids"]) == ["run_3", "run_4"]
+    assert state["baselines"]["off_target"]["count"] == 15
+
+    # The restored store does not add the samples of the tracked runs again
+    restored_trend_store = TrendStore(file_path, tracked_runs=2)
+    restored_trend_store.observe("S4-0", "run_4", {"off_target": 10.0})
+    assert restored_trend_store._baselines["off_target"].count == 15
+
+
+def test_unchanged_store_is_not_saved_again(tmp_path):
+    file_path = str(tmp_path / "trends.json")
+    trend_store = TrendStore(file_path)
+
+    trend_store.save()
+    assert not os.path.exists(file_path)
+
+    trend_store.observe("S1", "run_1", {"off_target": 10.0})
+    trend_store.save()
+    modified_time = os.stat(file_path).st_mtime_ns
+    trend_store.observe("S1", "run_1", {"off_target": 10.0}, is_memoized=True)
+    trend_store.save()
+
+    assert os.stat(file_path).st_mtime_ns == modified_time
+
+
+def test_baselines_of_the_first_version_are_loaded(tmp_path):
+    file_path = str(tmp_path / "trends.json")
+    trend_store = TrendStore(file_path)
+    trend_store.observe("S1", "run_1", {"off_target": 10.0})
+    trend_store.save()
+
+    with open(file_path) as store_file:
+        state = json.load(store_file)
+    assert state["version"] == TREND_STORE_VERSION
+    state.pop("run_sample_ids")
+    state.update({"version": 1, "sample_ids": ["S1"], "run_baselines": {}})
+    with open(file_path, "w") as store_file:
+        json.dump(state, store_file)
+
+    assert TrendStore(file_path)._baselines["off_target"].count == 1
+
+
+def test_shifted_run_is_flagged_against_the_other_runs(tmp_path):
+    file_path = str(tmp_path / "trends.json")
+    trend_store = TrendStore(file_path, min_baseline_samples=10)
+    for run_index in range(4):
+        for sample_index in range(10):
+            trend_store.observe(
+                f"S{run_index}-{sample_index}",
+                f"run_{run_index}",
+                {"off_target": 20.0 + sample_index % 5},
+            )
+
+    # Every sample of the shifted run is within the limits of the overall baseline
+    for sample_index in range(5):
+        drift = trend_store.observe(
+            f"S4-{sample_index}", "run_4", {"off_target": 24.0 + sample_index % 2}
+        )
+        assert not drift["metrics"]["off_target"]["out_of_control"]
+    run_trend = drift["metrics"]["off_target"]["run"]
+    assert run_trend["run_samples"] == 5
+    assert run_trend["mean"] == 24.4
+    assert run_trend["other_runs_mean"] == 22.0
+    assert run_trend["out_of_control"]
+    assert drift["drift"]
+
+    # The runs of the usual samples are not flagged, and the baselines of the runs are restored
+    trend_store.save()
+    restored_trend_store = TrendStore(file_path, min_baseline_samples=10)
+    drift = restored_trend_store.observe("S0-0", "run_0", {"off_target": 20.0}, is_memoized=True)
+    assert drift["metrics"]["off_target"]["run"]["run_samples"] == 10
+    assert not drift["metrics"]["off_target"]["run"]["out_of_control"]
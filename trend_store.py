@@ -0,0 +1,561 @@
+"""
+Module for the historical baselines of the QC metrics: the running statistics,
+the quantile sketches and the control-chart limits of every metric, overall
+and per sequencing run, updated in constant time per sample and kept between
+the runs, and the drift flags of the new results against them.
+"""
+
+import json
+import math
+import os
+import tempfile
+import threading
+
+# The metrics of the samples from the Google Sheet followed over time,
+# see run_summary.get_sheet_metrics
+TREND_METRICS = ("coverage_ratio", "deduplicated_percentage", "off_target", "number_of_reads_mln")
+# The quantiles estimated for every metric
+TREND_QUANTILES = (0.05, 0.5, 0.95)
+# The version of the format of the file of the store; the baselines of the files
+# of the previous versions are loaded as well
+TREND_STORE_VERSION = 2
+# The number of the last runs whose sample ids are kept to add every sample once
+TREND_TRACKED_RUNS = 20
+
+
+class P2Quantile:
+    """
+    Class for estimating a quantile of a stream of values with the P-square
+    algorithm (Jain and Chlamtac, 1985): five markers are kept and adjusted
+    on every value, so the memory and the time per value are constant.
+    """
+
+    def __init__(
+        self,
+        quantile: float,
+        heights: list[float] | None = None,
+        positions: list[float] | None = None,
+        desired_positions: list[float] | None = None,
+    ):
+        """
+        :param quantile: The quantile, from 0 to 1.
+        :type quantile: float
+        :param heights: The heights of the markers, for a restored sketch.
+        :type heights: list[float] | None
+        :param positions: The positions of the markers, for a restored sketch.
+        :type positions: list[float] | None
+        :param desired_positions: The desired positions of the markers, for a restored sketch.
+        :type desired_positions: list[float] | None
+        """
+        self.quantile = quantile
+        self.heights = heights if heights is not None else []
+        self.positions = positions if positions is not None else [1, 2, 3, 4, 5]
+        self.desired_positions = (
+            desired_positions
+            if desired_positions is not None
+            else [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        )
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value: float) -> None:
+        """
+        Add a value to the sketch.
+
+        :param value: The value.
+        :type value: float
+        """
+        heights = self.heights
+        positions = self.positions
+        # The first five values are the markers themselves
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = next(index for index in range(4) if value < heights[index + 1])
+
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired_positions[index] += self._increments[index]
+
+        # Move the middle markers towards their desired positions
+        for index in range(1, 4):
+            offset = self.desired_positions[index] - positions[index]
+            if (offset >= 1 and positions[index + 1] - positions[index] > 1) or (
+                offset <= -1 and positions[index - 1] - positions[index] < -1
+            ):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = heights[index] + step * (
+                        heights[index + step] - heights[index]
+                    ) / (positions[index + step] - positions[index])
+                heights[index] = height
+                positions[index] += step
+
+    def _parabolic(self, index: int, step: int) -> float:
+        """
+        Get the height of a marker moved by one position with the piecewise-parabolic formula.
+
+        :param index: The index of the marker.
+        :type index: int
+        :param step: The direction of the move: 1 or -1.
+        :type step: int
+        :return: The new height.
+        :rtype: float
+        """
+        heights = self.heights
+        positions = self.positions
+
+        return heights[index] + step / (positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step)
+            * (heights[index + 1] - heights[index])
+            / (positions[index + 1] - positions[index])
+            + (positions[index + 1] - positions[index] - step)
+            * (heights[index] - heights[index - 1])
+            / (positions[index] - positions[index - 1])
+        )
+
+    @property
+    def value(self) -> float | None:
+        """
+        Get the estimate of the quantile.
+
+        :return: The estimate, or None if there are no values.
+        :rtype: float | None
+        """
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            # The nearest-rank quantile of the few values
+            rank = max(math.ceil(len(self.heights) * self.quantile) - 1, 0)
+            return self.heights[rank]
+
+        return self.heights[2]
+
+    def to_dict(self) -> dict:
+        """
+        Get the state of the sketch for the file of the store.
+
+        :return: The state.
+        :rtype: dict
+        """
+        return {
+            "quantile": self.quantile,
+            "heights": self.heights,
+            "positions": self.positions,
+            "desired_positions": self.desired_positions,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "P2Quantile":
+        """
+        Restore a sketch from its state.
+
+        :param state: The state from to_dict.
+        :type state: dict
+        :return: The sketch.
+        :rtype: P2Quantile
+        """
+        return cls(
+            state["quantile"], state["heights"], state["positions"], state["desired_positions"]
+        )
+
+
+class MetricBaseline:
+    """
+    Class for the running statistics of a metric: the count, the mean and
+    the sum of the squared deviations (Welford's algorithm), the exponentially
+    weighted moving average and the quantile sketches.
+    """
+
+    def __init__(self, state: dict | None = None):
+        """
+        :param state: The state from to_dict, for a restored baseline.
+        :type state: dict | None
+        """
+        state = state or {}
+        self.count: int = state.get("count", 0)
+        self.mean: float = state.get("mean", 0.0)
+        self.m2: float = state.get("m2", 0.0)
+        self.ewma: float | None = state.get("ewma")
+        self.quantiles = {
+            quantile: P2Quantile.from_dict(state["quantiles"][str(quantile)])
+            if str(quantile) in state.get("quantiles", {})
+            else P2Quantile(quantile)
+            for quantile in TREND_QUANTILES
+        }
+
+    @property
+    def std(self) -> float:
+        """
+        Get the sample standard deviation.
+
+        :return: The standard deviation, or 0 if there are fewer than two values.
+        :rtype: float
+        """
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def next_ewma(self, value: float, ewma_lambda: float) -> float:
+        """
+        Get the moving average after a value, without adding it.
+
+        :param value: The value.
+        :type value: float
+        :param ewma_lambda: The weight of the value.
+        :type ewma_lambda: float
+        :return: The moving average.
+        :rtype: float
+        """
+        if self.ewma is None:
+            return value
+        return ewma_lambda * value + (1 - ewma_lambda) * self.ewma
+
+    def add(self, value: float, ewma_lambda: float) -> None:
+        """
+        Add a value to the statistics.
+
+        :param value: The value.
+        :type value: float
+        :param ewma_lambda: The weight of the value in the moving average.
+        :type ewma_lambda: float
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.ewma = self.next_ewma(value, ewma_lambda)
+        for sketch in self.quantiles.values():
+            sketch.add(value)
+
+    def to_dict(self) -> dict:
+        """
+        Get the state of the baseline for the file of the store.
+
+        :return: The state.
+        :rtype: dict
+        """
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "std": self.std,
+            "ewma": self.ewma,
+            "quantiles": {
+                str(quantile): sketch.to_dict() for quantile, sketch in self.quantiles.items()
+            },
+        }
+
+
+class TrendStore:
+    """
+    Class for the baselines of the QC metrics over all samples seen so far and
+    per run, kept in a JSON file. Every sample is added once, when its result is
+    first completed: the stored results of the unchanged samples are not counted
+    again, and the ids of the samples of the last tracked_runs runs are kept for
+    the samples completed again, so the store does not grow with the history.
+
+    A result is flagged against the overall baseline before its sample is added:
+    a metric is out of control if it is outside the Shewhart limits
+    (the mean plus or minus control_limit_sigma standard deviations) and drifts
+    if the moving average with it is outside the limits of the EWMA chart.
+    The run of the sample is flagged against the other runs once the sample is added:
+    the mean of the run is out of control if it is outside the limits of the X-bar
+    chart (the mean of the other runs plus or minus control_limit_sigma standard
+    errors of the mean of the run's samples).
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        control_limit_sigma: float = 3.0,
+        ewma_lambda: float = 0.2,
+        min_baseline_samples: int = 20,
+        tracked_runs: int = TREND_TRACKED_RUNS,
+    ):
+        """
+        :param file_path: The path to the JSON file of the store.
+        :type file_path: str
+        :param control_limit_sigma: The width of the control limits in standard deviations.
+        :type control_limit_sigma: float
+        :param ewma_lambda: The weight of a new value in the moving average.
+        :type ewma_lambda: float
+        :param min_baseline_samples: The minimal number of the samples of a baseline
+            for the results to be flagged against it.
+        :type min_baseline_samples: int
+        :param tracked_runs: The number of the last runs whose sample ids are kept.
+        :type tracked_runs: int
+        """
+        self.file_path = file_path
+        self.control_limit_sigma = control_limit_sigma
+        self.ewma_lambda = ewma_lambda
+        self.min_baseline_samples = min_baseline_samples
+        self.tracked_runs = tracked_runs
+
+        # The ids of the added samples of the last runs, the oldest run first
+        self._run_sample_ids: dict[str, set[str]] = {}
+        self._baselines: dict[str, MetricBaseline] = {}
+        self._run_baselines: dict[str, dict[str, MetricBaseline]] = {}
+        # Whether a sample has been added since the store was loaded or saved
+        self._changed = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        """
+        Load the store from its file, if there is one of the current or a previous version.
+        """
+        try:
+            with open(self.file_path) as store_file:
+                state = json.load(store_file)
+        except (FileNotFoundError, ValueError):
+            return
+        if state.get("version") not in range(1, TREND_STORE_VERSION + 1):
+            return
+
+        self._baselines = {
+            metric: MetricBaseline(metric_state)
+            for metric, metric_state in state["baselines"].items()
+        }
+        self._run_baselines = {
+            run_name: {
+                metric: MetricBaseline(metric_state)
+                for metric, metric_state in run_state.items()
+            }
+            for run_name, run_state in state.get("run_baselines", {}).items()
+        }
+        # The files of the first version have the sample ids without the runs;
+        # the samples with the stored results are not added again anyway
+        self._run_sample_ids = {
+            run_name: set(sample_ids)
+            for run_name, sample_ids in state.get("run_sample_ids", {}).items()
+        }
+
+    def _get_metric_trend(self, metric: str, value: float) -> dict:
+        """
+        Compare a value of a metric with its overall baseline.
+
+        :param metric: The name of the metric.
+        :type metric: str
+        :param value: The value.
+        :type value: float
+        :return: The value, the baseline, the control limits and the flags.
+        :rtype: dict
+        """
+        baseline = self._baselines.get(metric) or MetricBaseline()
+        trend = {"value": round(value, 4), "baseline_samples": baseline.count}
+        std = baseline.std
+        if baseline.count < self.min_baseline_samples or std == 0:
+            return trend
+
+        limit = self.control_limit_sigma * std
+        # The asymptotic limits of the EWMA chart
+        ewma_limit = limit * math.sqrt(self.ewma_lambda / (2 - self.ewma_lambda))
+        ewma = baseline.next_ewma(value, self.ewma_lambda)
+        trend.update(
+            {
+                "mean": round(baseline.mean, 4),
+                "std": round(std, 4),
+                "z_score": round((value - baseline.mean) / std, 2),
+                "lower_limit": round(baseline.mean - limit, 4),
+                "upper_limit": round(baseline.mean + limit, 4),
+                "ewma": round(ewma, 4),
+                "out_of_control": abs(value - baseline.mean) > limit,
+                "drift": abs(ewma - baseline.mean) > ewma_limit,
+            }
+        )
+
+        return trend
+
+    def _get_run_trend(self, metric: str, run_name: str) -> dict:
+        """
+        Compare the mean of a metric over the samples of a run with the baseline
+        of the samples of the other runs.
+
+        :param metric: The name of the metric.
+        :type metric: str
+        :param run_name: The name of the run.
+        :type run_name: str
+        :return: The statistics of the run, the control limits of its mean and the flag.
+        :rtype: dict
+        """
+        baseline = self._baselines.get(metric) or MetricBaseline()
+        run_baseline = self._run_baselines.get(run_name, {}).get(metric) or MetricBaseline()
+        trend = {"run_samples": run_baseline.count}
+        if run_baseline.count == 0:
+            return trend
+        trend.update(
+            {
+                "mean": round(run_baseline.mean, 4),
+                "std": round(run_baseline.std, 4),
+                "quantiles": {
+                    str(quantile): round(sketch.value, 4)
+                    for quantile, sketch in run_baseline.quantiles.items()
+                },
+            }
+        )
+
+        # The statistics of the other runs: the samples of the run are removed
+        # from the overall ones with the parallel form of Welford's algorithm
+        other_count = baseline.count - run_baseline.count
+        if other_count < max(self.min_baseline_samples, 2):
+            return trend
+        other_mean = (
+            baseline.count * baseline.mean - run_baseline.count * run_baseline.mean
+        ) / other_count
+        delta = run_baseline.mean - other_mean
+        other_m2 = (
+            baseline.m2
+            - run_baseline.m2
+            - delta**2 * run_baseline.count * other_count / baseline.count
+        )
+        other_std = math.sqrt(max(other_m2, 0.0) / (other_count - 1))
+        if other_std == 0:
+            return trend
+
+        limit = self.control_limit_sigma * other_std / math.sqrt(run_baseline.count)
+        trend.update(
+            {
+                "other_runs_mean": round(other_mean, 4),
+                "lower_limit": round(other_mean - limit, 4),
+                "upper_limit": round(other_mean + limit, 4),
+                "out_of_control": abs(delta) > limit,
+            }
+        )
+
+        return trend
+
+    def observe(
+        self,
+        sample_id: str,
+        run_name: str,
+        metrics: dict[str, float],
+        is_memoized: bool = False,
+    ) -> dict:
+        """
+        Flag the metrics of a sample against the overall baselines, add the sample
+        to the baselines if it has not been added yet and flag its run against
+        the other runs.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param run_name: The name of the run of the sample.
+        :type run_name: str
+        :param metrics: The values of the metrics by the metric name; the missing
+            values (NaN) are skipped.
+        :type metrics: dict[str, float]
+        :param is_memoized: Whether the result of the sample is the stored one;
+            the sample was added when the result was completed.
+        :type is_memoized: bool
+        :return: Whether any metric of the sample or of its run is out of control
+            or drifts and the trends of the metrics by the metric name.
+        :rtype: dict
+        """
+        metrics = {
+            metric: float(value)
+            for metric, value in metrics.items()
+            if value is not None and not math.isnan(value)
+        }
+
+        run_name = str(run_name)
+
+        with self._lock:
+            trends = {
+                metric: self._get_metric_trend(metric, value) for metric, value in metrics.items()
+            }
+            if not is_memoized and self._track_sample(sample_id, run_name):
+                run_baselines = self._run_baselines.setdefault(run_name, {})
+                for metric, value in metrics.items():
+                    self._baselines.setdefault(metric, MetricBaseline()).add(
+                        value, self.ewma_lambda
+                    )
+                    run_baselines.setdefault(metric, MetricBaseline()).add(
+                        value, self.ewma_lambda
+                    )
+                self._changed = True
+            for metric, trend in trends.items():
+                trend["run"] = self._get_run_trend(metric, run_name)
+
+        return {
+            "drift": any(
+                trend.get("out_of_control", False)
+                or trend.get("drift", False)
+                or trend["run"].get("out_of_control", False)
+                for trend in trends.values()
+            ),
+            "metrics": trends,
+        }
+
+    def _track_sample(self, sample_id: str, run_name: str) -> bool:
+        """
+        Add the id of a sample to the ids of its run, dropping the ids of the oldest
+        run if there are more than tracked_runs runs. Must be called with the lock held.
+
+        :param sample_id: The id of the sample.
+        :type sample_id: str
+        :param run_name: The name of the run of the sample.
+        :type run_name: str
+        :return: Whether the sample has not been added yet.
+        :rtype: bool
+        """
+        sample_ids = self._run_sample_ids.get(run_name)
+        if sample_ids is None:
+            sample_ids = self._run_sample_ids[run_name] = set()
+            while len(self._run_sample_ids) > self.tracked_runs:
+                del self._run_sample_ids[next(iter(self._run_sample_ids))]
+        if sample_id in sample_ids:
+            return False
+
+        sample_ids.add(sample_id)
+        return True
+
+    def save(self) -> None:
+        """
+        Save the store with an atomic rename if a sample has been added since
+        the last save.
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            state = {
+                "version": TREND_STORE_VERSION,
+                "control_limit_sigma": self.control_limit_sigma,
+                "ewma_lambda": self.ewma_lambda,
+                "run_sample_ids": {
+                    run_name: list(sample_ids)
+                    for run_name, sample_ids in self._run_sample_ids.items()
+                },
+                "baselines": {
+                    metric: baseline.to_dict() for metric, baseline in self._baselines.items()
+                },
+                "run_baselines": {
+                    run_name: {
+                        metric: baseline.to_dict() for metric, baseline in run_baselines.items()
+                    }
+                    for run_name, run_baselines in self._run_baselines.items()
+                },
+            }
+            self._changed = False
+
+        dir_path = os.path.dirname(self.file_path) or "."
+        os.makedirs(dir_path, exist_ok=True)
+        try:
+            file_descriptor, tmp_file_path = tempfile.mkstemp(dir=dir_path)
+            with os.fdopen(file_descriptor, "w") as store_file:
+                json.dump(state, store_file)
+            os.replace(tmp_file_path, self.file_path)
+        except Exception:
+            # The samples are saved by the next save
+            with self._lock:
+                self._changed = True
+            raise
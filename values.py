@@ -4,3 +4,4 @@ Values used in the pipeline.
 
 MINIMAL_VAF_AND_LOD_ESTIMATION_STAGE_UID = "e9a5fe97-d7b9-4bb9-917d-1d5b6396236c"
 BUCKET_NAME = "cfDNA_samples"
+INSERT_SIZE_FRACTION_ESTIMATION_STAGE_UID = "1dbf8a3d-5b7b-42c3-bbb5-4b9f40823500"